@@ -1,6 +1,7 @@
 from django.db import models
 from django.db.models.signals import post_init
 from django.contrib.auth.models import User, Group
+from django.core.urlresolvers import reverse
 
 from biogps.utils.fields.jsonfield import JSONField
 
@@ -36,6 +37,32 @@ def clean_username(fqu):
             break
     return username
 
+def format_valid_name(first_name, last_name, username):
+    '''Return the full name or the clean username, the same as
+       user.get_valid_name(), from the field values of a User.
+       Useful for values() queries, without loading User objects.
+    '''
+    return ('%s %s' % (first_name, last_name)).strip() or clean_username(username)
+
+def get_profile_url(user_id, username):
+    '''Return the url of a user's profile page, the same as
+       user.get_absolute_url(), from the field values of a User.
+    '''
+    return reverse('apps.bgprofile.view', args=[str(user_id), clean_username(username)])
+
+def get_owner_names(sid_li):
+    '''Return a dictionary of {sid: (user_id, valid_name, profile_url)} for
+       given user profiles, all from one query.
+    '''
+    owner_d = {}
+    if sid_li:
+        for d in UserProfile.objects.filter(sid__in=sid_li).values('sid', 'user_id', 'user__username',
+                                                                     'user__first_name', 'user__last_name'):
+            owner_d[d['sid']] = (d['user_id'],
+                                 format_valid_name(d['user__first_name'], d['user__last_name'], d['user__username']),
+                                 get_profile_url(d['user_id'], d['user__username']))
+    return owner_d
+
 def expanded_username_list(username):
     for affix in ['@lj.gnf.org', '_nov']:
         if username.lower().endswith(affix):
@@ -132,7 +159,7 @@ def _extend_user(user):
 
     def get_valid_name(user):
         '''Return user's full name or username if fullname is not available.'''
-        return user.get_full_name() or clean_username(user.username)
+        return format_valid_name(user.first_name, user.last_name, user.username)
     setattr(user, 'get_valid_name', MethodType(get_valid_name, user))
 
     def save_uiprofile(user, uiprofile):
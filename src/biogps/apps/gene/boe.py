@@ -1,34 +1,154 @@
 import requests
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from urllib import parse as urlparse
-from shlex import shlex
+import os
 import re
 import json
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from django.conf import settings
 from django.utils.http import urlencode
 
 
 from biogps.utils import alwayslist
+from biogps.utils.jsonstream import JSONItemStream
 from biogps.utils.const import species_d, taxid_d, assembly_d
+from .cache import gene_cache, gene_singleflight, query_cache
+from .localstore import SNAPSHOT_FIELDS, get_local_store
+
+
+# the attributes of a gene object in get_geneidentifiers output and the
+# gene doc fields they come from, see MyGeneInfo._parse_a_gene.
+XREF_ATTRS = ["entrezgene", "symbol", "name", "alias", "unigene", "pdb", "pharmgkb",
+              "FLYBASE", "HGNC", "HPRD", "MGI", "MIM", "RATMAP", "RGD",
+              "TAIR", "WormBase", "ZFIN", "Xenbase"]
+GENEOBJ_FIELDS = {'species': [],
+                  'ensemblgene': ['ensembl.gene'],
+                  'ensemblprotein': ['ensembl.protein'],
+                  'ensembltranscript': ['ensembl.transcript'],
+                  'uniprot': ['uniprot.Swiss-Prot'],
+                  'refseqmrna': ['refseq.rna'],
+                  'refseqprotein': ['refseq.protein'],
+                  'chr': ['genomic_pos'],
+                  'gstart': ['genomic_pos'],
+                  'gend': ['genomic_pos'],
+                  'genomelocation': ['genomic_pos'],
+                  'assembly': ['genomic_pos']}
+GENEOBJ_FIELDS.update([(attr.lower(), [attr]) for attr in XREF_ATTRS])
+
+
+def get_geneobj_fields(attrs):
+    '''return the list of gene doc fields needed for given attributes of
+       gene objects, to be passed as "fields" to get_geneidentifiers.
+       Return None (all fields) if any of attrs is unknown.
+    '''
+    fields = set()
+    for attr in attrs:
+        if attr not in GENEOBJ_FIELDS:
+            return None
+        fields.update(GENEOBJ_FIELDS[attr])
+    return sorted(fields)
 
 
 class MyGeneInfo404(Exception):
     pass
 
 
+class MyGeneInfoError(Exception):
+    '''raised with the error dictionary returned from the service.'''
+    pass
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''return the process-wide thread pool used for concurrent MyGeneInfo
+       calls. A new pool is created after a fork (e.g. in each uwsgi worker),
+       since threads do not survive across processes.
+    '''
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'BOE_POOL_SIZE', 20))
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _close_result(future):
+    '''close the result of a done future, if it succeeded.'''
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+_sessions = {}          # url_root --> requests.Session
+_session_stats = {}     # url_root --> connection pool usage counters
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session(url_root):
+    '''return the process-wide requests.Session for given url_root, shared
+       by all MyGeneInfo instances and threads. Its connection pool size,
+       retries and backoff are set by BOE_POOL_* and BOE_RETRY_* settings.
+       New sessions are created after a fork, so that pooled keep-alive
+       connections are never shared across processes.
+    '''
+    global _session_pid
+    with _session_lock:
+        if _session_pid != os.getpid():
+            _sessions.clear()
+            _session_stats.clear()
+            _session_pid = os.getpid()
+
+        s = _sessions.get(url_root, None)
+        if s is None:
+            pool_maxsize = getattr(settings, 'BOE_POOL_MAXSIZE', 20)
+            retries = Retry(total=getattr(settings, 'BOE_RETRY_TOTAL', 3),
+                            backoff_factor=getattr(settings, 'BOE_RETRY_BACKOFF', 0.2),
+                            status_forcelist=(502, 503, 504))
+            s = requests.Session()
+            s.mount(url_root, HTTPAdapter(pool_connections=getattr(settings, 'BOE_POOL_CONNECTIONS', 10),
+                                          pool_maxsize=pool_maxsize,
+                                          max_retries=retries))
+            _sessions[url_root] = s
+            _session_stats[url_root] = {'pool_maxsize': pool_maxsize,
+                                        'requests': 0,
+                                        'inflight': 0,
+                                        'max_inflight': 0,
+                                        'saturated': 0}
+        return s
+
+
+def get_session_stats():
+    '''return connection pool usage counters of current process for each
+       url_root. "saturated" counts the requests started when all pooled
+       connections were already in use.
+    '''
+    with _session_lock:
+        return dict([(k, dict(v)) for k, v in _session_stats.items()])
+
+
 class MyGeneInfo():
     def __init__(self, url=settings.BOESERVICE_URL):
         self.url = url
         if self.url[-1] == '/':
             self.url = self.url[:-1]
         self.url_root = self._get_url_root(self.url)
-        self.s = requests.Session()
-        # set max_retries
-        self.s.mount(self.url, HTTPAdapter(max_retries=5))
+        self.timeout = getattr(settings, 'BOE_TIMEOUT', (3.05, 30))   # (connect, read) timeout in seconds
         self.max_query = 10000
-        self.step = 10000
+        self.step = 10000         # max. number of terms sent in one querymany request
+        self.max_inflight = getattr(settings, 'BOE_MAX_INFLIGHT_CHUNKS', 2)   # max. querymany chunks requested at once
         self.userfilter = None   # optional predefined userfilter
+        self.cache = gene_cache  # a GeneDocCache instance, or None to disable caching
+        self.singleflight = gene_singleflight   # coalesce concurrent identical calls, or None
+        self.max_workers = getattr(settings, 'BOE_MAX_WORKERS', 8)   # max. concurrent calls in *_many methods
+        self.local_store = get_local_store()   # a LocalGeneStore snapshot, or None to always query remotely
 
         self.default_species = ','.join([str(x) for x in taxid_d.values()])
         self.default_fields = ','.join(['symbol', 'name', 'taxid', 'entrezgene', 'ensemblgene', 'homologene'])
@@ -67,6 +187,14 @@ class MyGeneInfo():
             "zfin"
         ])
 
+    @property
+    def s(self):
+        '''the pooled session of current process, see get_session. Not
+           bound at __init__, since instances like Gene._ds are created
+           at import time, before the workers are forked.
+        '''
+        return get_session(self.url_root)
+
     def _get_url_root(self, url):
         scheme, netloc, url, query, fragment = urlparse.urlsplit(self.url)
         return urlparse.urlunsplit((scheme, netloc, '', '', ''))
@@ -78,15 +206,38 @@ class MyGeneInfo():
             _out = a_list     # a_list is already a comma separated string
         return _out
 
+    def _request(self, method, url, **kwargs):
+        '''make a request with the shared session, and track pool usage.'''
+        s = self.s      # creates the session and its stats entry if needed
+        with _session_lock:
+            stats = _session_stats.get(self.url_root, None)
+            if stats:
+                stats['requests'] += 1
+                if stats['inflight'] >= stats['pool_maxsize']:
+                    stats['saturated'] += 1
+                stats['inflight'] += 1
+                stats['max_inflight'] = max(stats['max_inflight'], stats['inflight'])
+        try:
+            return s.request(method, url, timeout=self.timeout, **kwargs)
+        finally:
+            if stats:
+                with _session_lock:
+                    stats['inflight'] -= 1
+
+    def _stream_json(self, res):
+        '''return a JSONItemStream decoding hits of response body one by one.'''
+        return JSONItemStream(res.iter_content(chunk_size=65536), items_key='hits', close=res.close)
+
     def _get(self, url, params={}):
         debug = params.pop('debug', False)
         return_raw = params.pop('return_raw', False)
+        stream = params.pop('stream', False)
         headers = {'user-agent': "Python-requests_biogps/%s (gzip)" % requests.__version__}
         if params:
             _url = url + '?' + urlencode(params)
         else:
             _url = url
-        res = self.s.get(_url, headers=headers)
+        res = self._request('GET', _url, headers=headers, stream=stream)
         if debug:
             return _url, res
         if res.status_code == 404:
@@ -95,15 +246,18 @@ class MyGeneInfo():
             assert res.status_code == 200, (_url, res)
         if return_raw:
             return res.content
+        elif stream:
+            return self._stream_json(res)
         else:
             return res.json()
 
     def _post(self, url, params):
         debug = params.pop('debug', False)
         return_raw = params.pop('return_raw', False)
+        stream = params.pop('stream', False)
         headers = {'content-type': 'application/x-www-form-urlencoded',
                    'user-agent': "Python-requests_biogps/%s (gzip)" % requests.__version__}
-        res = self.s.post(url, data=urlencode(params), headers=headers)
+        res = self._request('POST', url, data=urlencode(params), headers=headers, stream=stream)
         if debug:
             return url, res
         if res.status_code == 404:
@@ -112,9 +266,81 @@ class MyGeneInfo():
             assert res.status_code == 200, (url, res)
         if return_raw:
             return res.content
+        elif stream:
+            return self._stream_json(res)
         else:
             return res.json()
 
+    def _cached(self, method, args, fn):
+        '''return the result of fn() through self.cache, keyed by method name
+           and args (together with the settings affecting the result).
+           Concurrent calls with the same key share one call to fn().
+        '''
+        args = [self.url, self.default_species, self.userfilter] + list(args)
+        _fn = fn
+        if self.singleflight is not None:
+            _key = json.dumps([method, args])
+            _fn = lambda: self.singleflight.do(_key, fn)
+        if self.cache is None:
+            return _fn()
+        return self.cache.get_or_call(self, method, args, _fn)
+
+    def _map(self, fn, items):
+        '''return [fn(x) for x in items], with the calls made concurrently
+           in the shared thread pool, but at most self.max_workers at a time.
+           The first exception raised by fn is re-raised.
+        '''
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [fn(x) for x in items]
+
+        executor = get_executor()
+        results = [None] * len(items)
+        pending = {}    # future --> index in items
+        todo = iter(enumerate(items))
+
+        def _submit_next():
+            for idx, x in todo:
+                pending[executor.submit(fn, x)] = idx
+                break
+
+        for i in range(self.max_workers):
+            _submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+                _submit_next()
+        return results
+
+    def _has_local_store(self):
+        '''return True if requests can be served from self.local_store.'''
+        # userfilter is applied by the remote service only.
+        return self.local_store is not None and not self.userfilter
+
+    def _use_local(self, fields=None):
+        '''return True if a request with given fields can be served from
+           self.local_store. A request for all fields (fields=None) is always
+           sent to the service, since the store keeps SNAPSHOT_FIELDS only.
+        '''
+        if not self._has_local_store() or not fields:
+            return False
+        fields = fields.split(',') if isinstance(fields, str) else fields
+        return all([f.split('.')[0] in SNAPSHOT_FIELDS for f in fields])
+
+    def _local_genes(self, geneid_li, fields=None):
+        '''return a list of gene objects from self.local_store aligned with
+           input geneid_li (None for genes not in the store), trimmed to
+           given fields as the remote service does.
+        '''
+        gene_li = self.local_store.get_many(geneid_li)
+        if fields:
+            fields = fields.split(',') if isinstance(fields, str) else fields
+            _fields = set([f.split('.')[0] for f in fields] + ['_id'])
+            gene_li = [dict([(k, v) for k, v in gene.items() if k in _fields]) if gene else None
+                       for gene in gene_li]
+        return self._homologene_trimming(gene_li)
+
     def _homologene_trimming(self, gdoc_li):
         '''A special step to remove species not included in <species_li>
            from "homologene" attributes.
@@ -137,7 +363,7 @@ class MyGeneInfo():
                 gdoc_li[idx] = gdoc
         return gdoc_li
 
-    def _querymany(self, qterms, scopes=None, fields=None, size=1000, species=None):
+    def _querymany_chunk(self, qterms, scopes=None, fields=None, size=1000, species=None):
         _url = self.url + '/query'
         kwargs = {}
         if isinstance(qterms, (list, tuple)):
@@ -151,53 +377,142 @@ class MyGeneInfo():
         kwargs['species'] = self._format_list(species or self.default_species)
         if self.userfilter:
             kwargs['userfilter'] = self.userfilter
+        kwargs['stream'] = True
         _res = self._post(_url, kwargs)
         return _res
 
+    def _querymany_iter(self, qterms, scopes=None, fields=None, size=1000, species=None):
+        '''A generator yielding hits of a querymany request one chunk at a time.
+           A list of qterms is split into chunks of self.step terms, each sent
+           as a separate POST request, and up to self.max_inflight chunks are
+           requested concurrently. Hits are always yielded in input order.
+           Raise MyGeneInfoError if the service returns an error for a chunk.
+        '''
+        if isinstance(qterms, (list, tuple)):
+            chunk_li = [qterms[i:i + self.step] for i in range(0, len(qterms), self.step)]
+        else:
+            chunk_li = [qterms]
+
+        def _query(chunk):
+            return self._querymany_chunk(chunk, scopes=scopes, fields=fields, size=size, species=species)
+
+        if len(chunk_li) <= 1 or self.max_inflight <= 1:
+            res_iter = (_query(chunk) for chunk in chunk_li)
+        else:
+            res_iter = self._iter_inflight(_query, chunk_li)
+
+        try:
+            for _res in res_iter:
+                # hits are decoded one by one as the response body arrives.
+                try:
+                    for hit in _res:
+                        yield hit
+                finally:
+                    _res.close()
+                if _res.meta.get('error', False):
+                    raise MyGeneInfoError(_res.meta)
+        finally:
+            # release the responses of chunks requested ahead, if stopped early.
+            res_iter.close()
+
+    def _iter_inflight(self, fn, items):
+        '''yield fn(x) for each of items in order, with up to self.max_inflight
+           calls running in the shared thread pool ahead of the consumer.
+        '''
+        executor = get_executor()
+        pending = deque()
+        todo = iter(items)
+        for x in todo:
+            pending.append(executor.submit(fn, x))
+            if len(pending) >= self.max_inflight:
+                break
+        try:
+            while pending:
+                res = pending.popleft().result()
+                for x in todo:
+                    pending.append(executor.submit(fn, x))
+                    break
+                yield res
+        finally:
+            for future in pending:
+                if not future.cancel():
+                    future.add_done_callback(_close_result)
+
+    def _querymany(self, qterms, scopes=None, fields=None, size=1000, species=None):
+        '''return all hits of _querymany_iter as a list, or the error
+           dictionary returned from the service.
+        '''
+        try:
+            return list(self._querymany_iter(qterms, scopes=scopes, fields=fields, size=size, species=species))
+        except MyGeneInfoError as err:
+            return err.args[0]
+
     def querygenelist(self, geneid_li):
         '''return a list of gene objects for given gene ids (support entrez/ensembl/retired geneids).
            e.g. used in genelist.genelist module
            notfound input geneids will be ignored.
         '''
-        _res = self._querymany(geneid_li,
-                               scopes=['entrezgene', 'ensemblgene', 'retired'],
-                               fields=['symbol', 'name', 'taxid'])
+        if self._has_local_store():
+            # no need for caching when served from local store.
+            return self._querygenelist(geneid_li)
+        return self._cached('querygenelist', [[str(x) for x in geneid_li]],
+                            lambda: self._querygenelist(geneid_li))
+
+    def _querygenelist(self, geneid_li):
+        fields = ['symbol', 'name', 'taxid']
+        geneid_li = [str(x) for x in geneid_li]
+        local_d = {}     # geneid --> list of gene objects from local store
+        if self._use_local(fields):
+            hit_d = self.local_store.query(geneid_li)
+            _ids = sorted(set([_id for _id_li in hit_d.values() for _id in _id_li]))
+            gene_d = dict(zip(_ids, self._local_genes(_ids, fields)))
+            for geneid, _id_li in hit_d.items():
+                local_d[geneid] = [dict(gene_d[_id], query=geneid) for _id in _id_li if gene_d[_id]]
+
+        # only those not in local store are queried remotely.
+        remote_li = [x for x in geneid_li if x not in local_d]
+        if remote_li:
+            _res = self._querymany_iter(remote_li,
+                                        scopes=['entrezgene', 'ensemblgene', 'retired'],
+                                        fields=fields)
+            for hit in _res:
+                if not hit.get('notfound', False) and not hit.get('error', False):
+                    local_d.setdefault(str(hit['query']), []).extend(self._homologene_trimming([hit]))
+
         gene_list = []
-        for hit in _res:
-            if not hit.get('notfound', False) and not hit.get('error', False):
-                gene_list.append(hit)
-        self._homologene_trimming(gene_list)
+        for geneid in geneid_li:
+            gene_list.extend(local_d.pop(geneid, []))
         return gene_list
 
     def query_by_id(self, query):
         if query:
             #_query = re.split('[\s\r\n+|,]+', query)
-            _res = self._querymany(query, self.id_scopes)
-            if isinstance(_res, dict) and _res.get('error', False):
-                out = _res
-                if out['error'] == 'timeout':
-                    #give a nicer timeout error msg
-                    out['error'] = "Your query times out now. Consider modify it and try again."
-            else:
-                gene_list = []
-                notfound_list = []
-                error_list = []
-                for hit in _res:
+            gene_list = []
+            notfound_list = []
+            error_list = []
+            try:
+                for hit in self._querymany_iter(query, self.id_scopes):
                     if hit.get('notfound', False):
                         notfound_list.append(hit['query'])
                     elif hit.get('error', False):
                         error_list.append(hit['error'])
                     else:
-                        gene_list.append(hit)
-                self._homologene_trimming(gene_list)
-                out = {"data": {"geneList": gene_list,
-                                "totalCount": len(gene_list),
-                                "qtype": "id"},
-                       "success": True}
-                if len(notfound_list) > 0:
-                    out["data"]["notfound"] = notfound_list
-                if len(error_list) > 0:
-                    out["data"]["error"] = error_list
+                        gene_list.extend(self._homologene_trimming([hit]))
+            except MyGeneInfoError as err:
+                out = err.args[0]
+                if out['error'] == 'timeout':
+                    #give a nicer timeout error msg
+                    out['error'] = "Your query times out now. Consider modify it and try again."
+                return out
+
+            out = {"data": {"geneList": gene_list,
+                            "totalCount": len(gene_list),
+                            "qtype": "id"},
+                   "success": True}
+            if len(notfound_list) > 0:
+                out["data"]["notfound"] = notfound_list
+            if len(error_list) > 0:
+                out["data"]["error"] = error_list
 
             return out
 
@@ -210,12 +525,13 @@ class MyGeneInfo():
             kwargs['size'] = 1000   # max 1000 hits returned
             if self.userfilter:
                 kwargs['userfilter'] = self.userfilter
+            kwargs['stream'] = True
             _url = self.url + '/query'
             res = self._get(_url, kwargs)
-            if 'error' in res:
-                return res
+            gene_list = [self._homologene_trimming([hit])[0] for hit in res]
+            if 'error' in res.meta:
+                return res.meta
 
-            gene_list = self._homologene_trimming(res['hits'])
             out = {'data': {'query': query,
                             'geneList': gene_list,
                             'totalCount': len(gene_list),
@@ -223,26 +539,65 @@ class MyGeneInfo():
                    'success': True}
             return out
 
-    def query_by_interval(self, query, species):
+    def query_by_interval(self, query, species, skip=0, size=1000):
+        '''return genes overlapping given interval query, e.g. "chr1:1000-2000",
+           one page of (max 1000) hits at a time, starting from "skip".
+           "total" in returned data is the number of all matching genes.
+        '''
         if query and species:
+            size = min(size, 1000)   # max 1000 hits returned
+            if self._has_local_store():
+                return self._query_by_interval_local(query, species, skip, size)
             kwargs = {}
             kwargs['q'] = query
             kwargs['species'] = species
             kwargs['fields'] = self.default_fields
-            kwargs['size'] = 1000   # max 1000 hits returned
+            kwargs['size'] = size
+            if skip:
+                kwargs['from'] = skip
             if self.userfilter:
                 kwargs['userfilter'] = self.userfilter
+            kwargs['stream'] = True
             _url = self.url + '/query'
             res = self._get(_url, kwargs)
-            gene_list = self._homologene_trimming(res['hits'])
+            gene_list = [self._homologene_trimming([hit])[0] for hit in res]
             out = {'data': {'query': query,
                             'geneList': gene_list,
                             'totalCount': len(gene_list),
+                            'total': res.meta.get('total', len(gene_list)),
+                            'from': skip,
                             'qtype': "interval"},
                    'success': True}
             return out
 
+    def _query_by_interval_local(self, query, species, skip=0, size=1000):
+        '''same as query_by_interval, but served from the interval index of
+           self.local_store.
+        '''
+        interval = _parse_interval_query(query)
+        geneid_li = self.local_store.query_interval(species, interval['chr'],
+                                                    int(interval['gstart'].replace(',', '')),
+                                                    int(interval['gend'].replace(',', '')))
+        fields = [f for f in self.default_fields.split(',') if f in SNAPSHOT_FIELDS]
+        gene_list = [g for g in self._local_genes(geneid_li[skip:skip + size], fields) if g]
+        out = {'data': {'query': query,
+                        'geneList': gene_list,
+                        'totalCount': len(gene_list),
+                        'total': len(geneid_li),
+                        'from': skip,
+                        'qtype': "interval"},
+               'success': True}
+        return out
+
     def get_gene(self, geneid, fields=None):
+        if self._use_local(fields):
+            gene = self._local_genes([geneid], fields)[0]
+            if gene:
+                return gene
+        return self._cached('get_gene', [str(geneid), self._format_list(fields) if fields else None],
+                            lambda: self._get_gene(geneid, fields))
+
+    def _get_gene(self, geneid, fields=None):
         _url = u'{}/gene/{}'.format(self.url, geneid)
         params = {'species': self.default_species}
         if fields:
@@ -261,6 +616,52 @@ class MyGeneInfo():
 
         return gene
 
+    def get_genes(self, geneid_li, fields=None):
+        '''return a list of gene objects for given gene ids, fetched in one
+           batched POST request instead of one get_gene call per id.
+           The returned list is aligned with input geneid_li, and None is
+           returned for any geneid not found.
+        '''
+        if not geneid_li:
+            return []
+        if self._use_local(fields):
+            gene_li = self._local_genes(geneid_li, fields)
+            remote_li = [geneid for geneid, gene in zip(geneid_li, gene_li) if gene is None]
+            if remote_li:
+                remote_d = dict(zip(remote_li, self._get_genes(remote_li, fields)))
+                gene_li = [gene or remote_d[geneid] for geneid, gene in zip(geneid_li, gene_li)]
+            return gene_li
+        return self._get_genes(geneid_li, fields)
+
+    def _get_genes(self, geneid_li, fields=None):
+        _url = self.url + '/gene'
+        params = {'ids': self._format_list(geneid_li),
+                  'species': self.default_species}
+        if fields:
+            params['fields'] = self._format_list(fields)
+        _res = self._post(_url, params)
+
+        # group hits by query term, one query may match more than one gene.
+        hit_d = {}
+        for hit in _res:
+            if hit.get('notfound', False) or hit.get('error', False):
+                continue
+            hit_d.setdefault(str(hit.get('query', hit.get('_id'))), []).append(hit)
+
+        gene_li = []
+        for geneid in geneid_li:
+            hits = hit_d.get(str(geneid), None)
+            if hits:
+                gene = hits[0]
+                if len(hits) > 1:
+                    # same as get_gene, only the first one is returned.
+                    gene[u'warning'] = u"Matching {} genes and only the first one is returned.".format(len(hits))
+                gene = self._homologene_trimming([gene])[0]
+            else:
+                gene = None
+            gene_li.append(gene)
+        return gene_li
+
     def _get_value(self, value, fn=None):
         if value:
             if isinstance(value, list):
@@ -288,11 +689,8 @@ class MyGeneInfo():
 
         attr_li = [('ensemblgene', 'ensembl', lambda x: x['gene']),
                    ('uniprot', 'uniprot', lambda x:x.get('Swiss-Prot', None))]
-        xref_attrs = ["entrezgene", "symbol", "name", "alias", "unigene", "pdb", "pharmgkb",
-                      "FLYBASE", "HGNC", "HPRD", "MGI", "MIM", "RATMAP", "RGD",
-                      "TAIR", "WormBase", "ZFIN", "Xenbase"]
 
-        attr_li.extend([(attr.lower(), attr, None) for attr in xref_attrs])
+        attr_li.extend([(attr.lower(), attr, None) for attr in XREF_ATTRS])
         for attr_out, attr_src, fn in attr_li:
             value = _gene.get(attr_src, None)
             if value:
@@ -349,49 +747,138 @@ class MyGeneInfo():
 
         return geneobj
 
-    def get_geneidentifiers(self, geneid):
-        gdoc = self.get_gene(geneid)
+    def _geneidentifiers_fields(self, fields):
+        '''add the fields always needed by get_geneidentifiers.'''
+        if fields is not None:
+            fields = sorted(set(fields) | set(['taxid', 'homologene']))
+        return fields
+
+    def get_geneidentifiers(self, geneid, fields=None):
+        '''return all identifiers of given gene and its homologous genes.
+           fields is an optional list of gene doc fields to fetch (see
+           get_geneobj_fields), e.g. only those used by the plugins to be
+           rendered, otherwise full gene docs are fetched.
+        '''
+        fields = self._geneidentifiers_fields(fields)
+        if self._use_local(fields):
+            return self._get_geneidentifiers(geneid, fields)
+        return self._cached('get_geneidentifiers', [str(geneid), fields],
+                            lambda: self._get_geneidentifiers(geneid, fields))
+
+    def _get_geneidentifiers(self, geneid, fields=None):
+        gdoc = self.get_gene(geneid, fields)
         if gdoc:
             if isinstance(gdoc, list):     # in few cases, one id might returns multiple gdoc as a list
                 gdoc = gdoc[0]             # in this case, we just take the first one
 
-            out = {}
-            #base
-            taxid = int(gdoc['taxid'])
-            out['EntrySpecies'] = species_d[taxid]
-            out['EntryGeneID'] = gdoc['_id']
-
-            #homologene
-            hgene = gdoc.get('homologene', None)
-            if hgene:
-                out['HomoloGene'] = hgene['id']
-                gene_li = hgene['genes']  # [(taxid, geneid),...]
+            #fetch all homologous genes in one batched request
+            homolog_li = self._get_homolog_ids(gdoc)
+            homolog_d = dict(zip(homolog_li, self.get_genes(homolog_li, fields)))
+            return self._parse_geneidentifiers(gdoc, homolog_d)
+
+    def _get_homolog_ids(self, gdoc):
+        '''return the ids of homologous genes of given gene in other species.'''
+        taxid = int(gdoc['taxid'])
+        hgene = gdoc.get('homologene', None)
+        gene_li = hgene['genes'] if hgene else []
+        return [gid for tid, gid in gene_li if tid != taxid and tid in species_d]
+
+    def _parse_geneidentifiers(self, gdoc, homolog_d):
+        '''return the output of get_geneidentifiers for given gene, with its
+           homologous genes looked up from homolog_d ({geneid: gene object}).
+        '''
+        out = {}
+        #base
+        taxid = int(gdoc['taxid'])
+        out['EntrySpecies'] = species_d[taxid]
+        out['EntryGeneID'] = gdoc['_id']
+
+        #homologene
+        hgene = gdoc.get('homologene', None)
+        if hgene:
+            out['HomoloGene'] = hgene['id']
+            gene_li = hgene['genes']  # [(taxid, geneid),...]
+        else:
+            gene_li = [(taxid, gdoc['_id'])]
+
+        #handle each gene in hgene
+        species_list = []
+        for tid, gid in gene_li:
+            if tid == taxid:
+                _gene = gdoc
+            elif tid in species_d:
+                _gene = homolog_d.get(gid, None)
+                if _gene is None:
+                    continue
             else:
-                gene_li = [(taxid, gdoc['_id'])]
-
-            #handle each gene in hgene
-            species_list = []
-            for tid, gid in gene_li:
-                if tid == taxid:
-                    _gene = gdoc
-                elif tid in species_d:
-                    _gene = self.get_gene(gid)
-                    if _gene is None:
-                        continue
+                continue
+
+            species = species_d[tid]
+            geneobj = self._parse_a_gene(_gene)
+
+            if geneobj:
+                if species in out:
+                    out[species].append(geneobj)
                 else:
-                    continue
+                    out[species] = [geneobj]   # temp to make it compatible with current sl
+                species_list.append(species)
+        out['SpeciesList'] = species_list
+        return out
 
-                species = species_d[tid]
-                geneobj = self._parse_a_gene(_gene)
+    def get_geneidentifiers_many(self, geneid_li):
+        '''return a list of get_geneidentifiers outputs for given gene ids,
+           fetched concurrently. The returned list is aligned with input
+           geneid_li, and None is returned for any geneid not found.
+        '''
+        return self._map(self.get_geneidentifiers, geneid_li)
 
-                if geneobj:
-                    if species in out:
-                        out[species].append(geneobj)
-                    else:
-                        out[species] = [geneobj]   # temp to make it compatible with current sl
-                    species_list.append(species)
-            out['SpeciesList'] = species_list
-            return out
+    def get_geneidentifiers_batch(self, geneid_li, fields=None):
+        '''same as get_geneidentifiers_many, but instead of two calls per
+           gene, all genes are fetched in one batched request, and then all
+           of their homologous genes in another one.
+        '''
+        fields = self._geneidentifiers_fields(fields)
+        gdoc_li = self.get_genes_many(geneid_li, fields)
+        homolog_li = []
+        for gdoc in gdoc_li:
+            if gdoc:
+                homolog_li.extend(self._get_homolog_ids(gdoc))
+        homolog_li = list(OrderedDict.fromkeys(homolog_li))
+        homolog_d = dict(zip(homolog_li, self.get_genes_many(homolog_li, fields)))
+        return [self._parse_geneidentifiers(gdoc, homolog_d) if gdoc else None
+                for gdoc in gdoc_li]
+
+    def get_genes_many(self, geneid_li, fields=None, chunk_size=1000):
+        '''same as get_genes, but a long list of gene ids is split into
+           chunks of chunk_size, which are fetched concurrently.
+        '''
+        chunk_li = [geneid_li[i:i + chunk_size] for i in range(0, len(geneid_li), chunk_size)]
+        gene_li = []
+        for _gene_li in self._map(lambda x: self.get_genes(x, fields=fields), chunk_li):
+            gene_li.extend(_gene_li)
+        return gene_li
+
+    def fetch_all(self, species, fields):
+        '''A generator yielding all gene objects of given species with given
+           fields, retrieved with the service's scroll api, one page of
+           hits at a time. Used to build the local gene store.
+        '''
+        _url = self.url + '/query'
+        kwargs = {'q': '__all__',
+                  'species': self._format_list(species),
+                  'fields': self._format_list(fields),
+                  'fetch_all': 'true',
+                  'stream': True}
+        while True:
+            _res = self._get(_url, kwargs)
+            cnt = 0
+            for hit in _res:
+                cnt += 1
+                yield hit
+            scroll_id = _res.meta.get('_scroll_id', None)
+            if not cnt or not scroll_id:
+                break
+            kwargs = {'scroll_id': scroll_id, 'stream': True}
 
     @property
     def metadata(self):
@@ -421,23 +908,65 @@ def _parse_interval_query(query):
     return interval_query
 
 
+_queryterm_separator = re.compile(r'[\t\n\x0b\x0c\r|,+]+')
+_queryterm_token = re.compile(r'''
+    (?P<sep>[\t\n\x0b\x0c\r|,+]+) |
+    (?P<word>[^\t\n\x0b\x0c\r|,+'"\\]+) |
+    '(?P<single>[^']*)' |
+    "(?P<double>(?:[^"\\]|\\.)*)" |
+    \\(?P<escaped>.)
+''', re.VERBOSE | re.DOTALL)
+_queryterm_unescape = re.compile(r'\\(["\\])')
+_queryterm_open_quote = re.compile(r'"(?:[^"\\]|\\.)*', re.DOTALL)
+
+
 def split_queryterms(q):
     '''split input query string into list of ids.
        any of "\t\n\x0b\x0c\r|,+" as the separator,
         but perserving a phrase if quoted
         (either single or double quoted)
-        more detailed rules see:
+        It follows the same rules as shlex in posix mode, see:
         http://docs.python.org/2/library/shlex.html#parsing-rules
+        but scans the input in one pass, a run of characters at a time.
 
         e.g. split_ids('CDK2, CDK3') --> ['CDK2', 'CDK3']
              split_ids('"CDK2, CDK3"\n CDk4')  --> ['CDK2, CDK3', 'CDK4']
         note that plain space is not a separator.
+        Raise ValueError on a dangling quote or backslash, as shlex does.
     '''
-    lex = shlex(q, posix=True)
-    lex.whitespace = '\t\n\x0b\x0c\r|,+'
-    lex.whitespace_split = True
-    lex.commenters = ''
-    terms = [x.strip() for x in list(lex)]
+    if '"' not in q and "'" not in q and '\\' not in q:
+        # the common case of a pasted list of ids.
+        terms = [x.strip() for x in _queryterm_separator.split(q)]
+        return [x for x in terms if x]
+
+    terms = []
+    token = []
+    quoted = False
+    pos = 0
+    while pos < len(q):
+        mat = _queryterm_token.match(q, pos)
+        if not mat:
+            # only an unclosed quote or a backslash at the end of input left.
+            if q[pos] == '\\' or (q[pos] == '"' and _queryterm_open_quote.match(q, pos).end() < len(q)):
+                raise ValueError("No escaped character")
+            raise ValueError("No closing quotation")
+        pos = mat.end()
+        kind = mat.lastgroup
+        if kind == 'sep':
+            if token or quoted:
+                terms.append(''.join(token))
+            token = []
+            quoted = False
+        elif kind == 'double':
+            token.append(_queryterm_unescape.sub(r'\1', mat.group(kind)))
+            quoted = True
+        else:
+            token.append(mat.group(kind))
+            quoted = quoted or kind == 'single'
+    if token or quoted:
+        terms.append(''.join(token))
+
+    terms = [x.strip() for x in terms]
     terms = [x for x in terms if x]
     return terms
 
@@ -457,34 +986,58 @@ def do_query(params):
                 res = {'success': False, 'error': 'Need to specify a valid "species" parameter, e.g., "species:human".'}
             else:
                 query = 'chr%(chr)s:%(gstart)s-%(gend)s' % interval_query_params
-                res = bs.query_by_interval(query, interval_query_params['species'])
-                res['_log'] = {'qtype': 'interval', 'species': interval_query_params['species']}
+                try:
+                    skip = max(int(params.get('from', 0)), 0)
+                    size = max(int(params.get('size', 1000)), 1)
+                except ValueError:
+                    skip, size = 0, 1000
+                species = interval_query_params['species']
+                key = query_cache.make_key('interval', [query, skip, size], species, _userfilter)
+                res, cache_hit = query_cache.get_or_call(
+                    key, lambda: bs.query_by_interval(query, species, skip=skip, size=size))
+                res['_log'] = {'qtype': 'interval', 'species': species}
+                if cache_hit:
+                    res['_log']['cache_hit'] = 1
         else:
             with_wildcard = _query.find('*') != -1 or _query.find('?') != -1
             # num_terms = len(re.split(u'[\t\n\x0b\x0c\r]+', _query))    # split on whitespace but not on plain space.
             try:
                 terms = split_queryterms(_query)
             except ValueError as e:
-                _msg = e.message
-                if e.message.find('quotation') != -1:
+                _msg = str(e)
+                if _msg.find('quotation') != -1:
                     _msg += '! Or just remove the dangling quote.'
-                elif e.message.find('escaped') != -1:
+                elif _msg.find('escaped') != -1:
                     _msg += '! You probably want to remove the "\\" (backslash) from your query.'
                 res = {'success': False, 'error': 'Malformed input query: {}'.format(_msg)}
                 terms = None
+            cache_hit = False
             if terms:
                 multi_terms = len(terms) > 1
                 if with_wildcard and multi_terms:
                     res = {'success': False, 'error': "Please do wildcard query one at a time."}
                 elif multi_terms:
-                    #do id query
-                    res = bs.query_by_id(terms)
+                    #do id query, large ones are not worth caching.
+                    if len(terms) <= query_cache.max_terms:
+                        key = query_cache.make_key('id', terms, bs.default_species, _userfilter)
+                        res, cache_hit = query_cache.get_or_call(key, lambda: bs.query_by_id(terms))
+                    else:
+                        res = bs.query_by_id(terms)
                     res['_log'] = {'qtype': 'id', 'qlen': len(_query), 'num_terms': len(terms)}
 
                 else:
                     #do keyword query
-                    res = bs.query_by_keyword(_query)
+                    #the query (not the term) is sent as is, since quotes make
+                    #a phrase query, and operators and field names are
+                    #case-sensitive, so only whitespaces are normalized.
+                    key = query_cache.make_key('keyword', [' '.join(_query.split())],
+                                               bs.default_species, _userfilter)
+                    res, cache_hit = query_cache.get_or_call(key, lambda: bs.query_by_keyword(_query))
+                    if cache_hit:
+                        res['data']['query'] = _query
                     res['_log'] = {'qtype': 'keyword', 'qlen': len(_query)}
+                if cache_hit:
+                    res['_log']['cache_hit'] = 1
     else:
         res = {'success': False, 'error': 'Invalid input parameters!'}
 
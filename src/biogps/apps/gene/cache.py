@@ -0,0 +1,321 @@
+'''
+A two-tier cache for gene documents retrieved from BOESERVICE_URL
+(mygene.info), used by MyGeneInfo in boe.py:
+
+    * the first tier is an in-process LRU cache bounded by size;
+    * the second tier is shared by all processes, stored in the "default"
+      Django cache backend (memcached, see settings.CACHES).
+
+Cache keys include the build version reported by the "metadata" service,
+so all cached items are invalidated at once when a new mygene.info release
+is deployed. Genes not found (404) are cached as well, with a shorter
+timeout.
+
+Concurrent identical lookups missing the cache are coalesced into one
+backend call by SingleFlight.
+
+The results of search queries (see do_query in boe.py) are cached in an
+in-process LRU cache as well, for a shorter time.
+'''
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from biogps.utils import log
+
+
+NOTFOUND = '__notfound__'    # the placeholder value cached for a 404 result
+
+
+class LRUCache(object):
+    '''A thread-safe, size-bounded in-process cache. Each item expires
+       after its own timeout (in seconds), and the least recently used
+       item is evicted when maxsize is reached.
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()     # key --> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''return a tuple of (found, value).'''
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is None:
+                return False, None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (time.time() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class GeneDocCache(object):
+    '''The two-tier cache for the results of MyGeneInfo calls.
+
+       @param maxsize: max. number of items kept in the in-process tier.
+       @param timeout: timeout (in seconds) for a cached gene document.
+       @param notfound_timeout: timeout (in seconds) for a cached 404 result.
+       @param version_timeout: how often (in seconds) the build version is
+                               re-checked against the "metadata" service.
+       @param version_retry: how long (in seconds) to wait before retrying
+                             after the "metadata" service fails, doubled on
+                             each failure up to version_timeout.
+       @param cache_alias: the Django cache backend used as the shared tier,
+                           or None to use the in-process tier only.
+    '''
+    version_key = 'boe:build_version'
+
+    def __init__(self, maxsize=None, timeout=None, notfound_timeout=None,
+                 version_timeout=None, version_retry=None, cache_alias='default'):
+        self.local = LRUCache(maxsize or getattr(settings, 'BOE_CACHE_SIZE', 10000))
+        self.timeout = timeout or getattr(settings, 'BOE_CACHE_TIMEOUT', settings.CACHE_DAY)
+        self.notfound_timeout = notfound_timeout or getattr(settings, 'BOE_CACHE_NOTFOUND_TIMEOUT', 3600)
+        self.version_timeout = version_timeout or getattr(settings, 'BOE_CACHE_VERSION_TIMEOUT', 600)
+        self.version_retry = version_retry or getattr(settings, 'BOE_CACHE_VERSION_RETRY', 5)
+        self._version_backoff = self.version_retry
+        self.cache_alias = cache_alias
+        self._version = None
+        self._version_checked = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def shared(self):
+        if self.cache_alias:
+            return caches[self.cache_alias]
+
+    def reset_stats(self):
+        with self._lock:
+            self.counters = {'local_hits': 0,
+                             'shared_hits': 0,
+                             'misses': 0,
+                             'notfound_hits': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        '''return a dictionary of hit/miss counters of this process.'''
+        out = dict(self.counters)
+        out['local_size'] = len(self.local)
+        out['version'] = self._version
+        return out
+
+    #==========================================================================
+    # build version handling
+    #==========================================================================
+    def get_version(self, ds):
+        '''return current build version of the gene service, checked at most
+           once every version_timeout seconds (or with a backoff while the
+           "metadata" service fails). "ds" is the MyGeneInfo instance whose
+           "metadata" is used.
+        '''
+        now = time.time()
+        if now - self._version_checked < (self.version_timeout if self._version else self._version_backoff):
+            return self._version or 'unknown'
+
+        version = self._shared_get(self.version_key)
+        if not version:
+            try:
+                metadata = ds.metadata
+                version = str(metadata.get('build_version', None) or
+                              metadata.get('build_date', None) or '')
+            except Exception as e:
+                log.warning('action=boe_cache error="fail to get build version: %s"', e)
+                version = None
+            if version:
+                self._shared_set(self.version_key, version, self.version_timeout)
+
+        with self._lock:
+            if version and version != self._version:
+                if self._version:
+                    # a new release deployed, drop everything cached locally.
+                    self.local.clear()
+                self._version = version
+            if version:
+                self._version_backoff = self.version_retry
+            else:
+                self._version_backoff = min(self._version_backoff * 2, self.version_timeout)
+            self._version_checked = now
+        return self._version or 'unknown'
+
+    def invalidate(self):
+        '''force to re-check build version and drop the in-process tier.'''
+        with self._lock:
+            self._version = None
+            self._version_checked = 0
+            self._version_backoff = self.version_retry
+        self.local.clear()
+        self._shared_delete(self.version_key)
+
+    #==========================================================================
+    # shared tier, errors from cache backend should never fail a request.
+    #==========================================================================
+    def _shared_get(self, key):
+        if self.shared is not None:
+            try:
+                return self.shared.get(key)
+            except Exception as e:
+                log.warning('action=boe_cache error="%s"', e)
+
+    def _shared_set(self, key, value, timeout):
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, timeout)
+            except Exception as e:
+                log.warning('action=boe_cache error="%s"', e)
+
+    def _shared_delete(self, key):
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception as e:
+                log.warning('action=boe_cache error="%s"', e)
+
+    #==========================================================================
+    # main entry
+    #==========================================================================
+    def make_key(self, version, method, args):
+        '''return a memcached-safe key for given method and its arguments.'''
+        _hash = hashlib.md5(json.dumps([method, args], sort_keys=True).encode('utf-8')).hexdigest()
+        return 'boe:{}:{}:{}'.format(version.replace(' ', '_'), method, _hash)
+
+    def get_or_call(self, ds, method, args, fn):
+        '''return the cached result for (method, args), or call fn() and
+           cache its result. A result of None is treated as notfound.
+        '''
+        key = self.make_key(self.get_version(ds), method, args)
+
+        found, value = self.local.get(key)
+        if found:
+            self._count('local_hits')
+        else:
+            value = self._shared_get(key)
+            if value is not None:
+                self._count('shared_hits')
+                self.local.set(key, value, self.notfound_timeout if value == NOTFOUND else self.timeout)
+            else:
+                self._count('misses')
+                value = fn()
+                if value is None:
+                    self.local.set(key, NOTFOUND, self.notfound_timeout)
+                    self._shared_set(key, NOTFOUND, self.notfound_timeout)
+                else:
+                    self.local.set(key, copy.deepcopy(value), self.timeout)
+                    self._shared_set(key, value, self.timeout)
+                return value
+
+        if value == NOTFOUND:
+            self._count('notfound_hits')
+            return None
+        # return a copy so that callers can modify it safely.
+        return copy.deepcopy(value)
+
+
+class SingleFlight(object):
+    '''Coalesce concurrent calls for the same key into one in-flight call,
+       e.g. many threads asking for the same popular gene at the same
+       moment. The first caller (the leader) makes the actual call, the
+       others wait and receive a copy of its result (or its exception).
+    '''
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}     # key --> _Call in flight
+        self.coalesced = 0   # number of calls served by another in-flight call
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key, None)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+
+        if is_leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        else:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+
+class QueryCache(object):
+    '''An in-process cache for search results, keyed by the query type and
+       the normalized query (see boe.do_query). Only successful results are
+       cached, and id queries of more than max_terms terms are not cached
+       at all, so that the memory used is bounded by maxsize.
+    '''
+    def __init__(self, maxsize=None, timeout=None, max_terms=None):
+        self.local = LRUCache(maxsize or getattr(settings, 'BOE_QUERY_CACHE_SIZE', 1000))
+        self.timeout = timeout or getattr(settings, 'BOE_QUERY_CACHE_TIMEOUT', 600)
+        self.max_terms = max_terms or getattr(settings, 'BOE_QUERY_CACHE_MAX_TERMS', 100)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, qtype, terms, species=None, userfilter=None):
+        return json.dumps([qtype, terms, species, userfilter or None])
+
+    def get_or_call(self, key, fn):
+        '''return a tuple of (result, cache_hit).'''
+        found, res = self.local.get(key)
+        if found:
+            self.hits += 1
+            return copy.deepcopy(res), True
+        self.misses += 1
+        res = fn()
+        if res and res.get('success', False):
+            self.local.set(key, copy.deepcopy(res), self.timeout)
+        return res, False
+
+    def clear(self):
+        self.local.clear()
+
+
+gene_cache = GeneDocCache()
+gene_singleflight = SingleFlight()
+query_cache = QueryCache()
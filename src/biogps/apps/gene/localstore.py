@@ -0,0 +1,289 @@
+'''
+An optional local store of gene documents, a SQLite snapshot of the fields
+BioGPS needs from BOESERVICE_URL for all species in utils/const.py. When
+settings.BOE_LOCAL_STORE points to a snapshot file, MyGeneInfo serves
+get_gene, get_genes, get_geneidentifiers and querygenelist from it without
+any network round trip, falling back to the remote service only for the
+genes missing from the snapshot.
+
+It also keeps an in-memory index of the genomic positions of all genes in
+the snapshot, used by MyGeneInfo.query_by_interval.
+
+The snapshot is built (or refreshed) by the management command:
+    python manage.py biogps_build_genestore
+'''
+import os
+import json
+import sqlite3
+import threading
+import zlib
+from array import array
+
+from django.conf import settings
+
+from biogps.utils import alwayslist
+from biogps.utils.const import species_d, assembly_d
+
+
+# fields kept in the snapshot, enough for get_geneidentifiers and plugin
+# url rendering.
+SNAPSHOT_FIELDS = ['symbol', 'name', 'taxid', 'entrezgene', 'alias', 'retired',
+                   'ensembl', 'refseq', 'genomic_pos', 'homologene',
+                   'uniprot', 'unigene', 'pdb', 'pharmgkb',
+                   'FLYBASE', 'HGNC', 'HPRD', 'MGI', 'MIM', 'RATMAP', 'RGD',
+                   'TAIR', 'WormBase', 'ZFIN', 'Xenbase']
+
+# the scopes of querygenelist which can be resolved locally
+LOCAL_SCOPES = ['entrezgene', 'ensemblgene', 'retired']
+
+
+def _encode(doc):
+    return zlib.compress(json.dumps(doc, separators=(',', ':')).encode('utf-8'))
+
+
+def _decode(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def _get_xrefs(doc):
+    '''return a list of (scope, term) pairs a gene doc can be looked up by.'''
+    xrefs = [('entrezgene', str(doc['_id']))]
+    for ensembl in alwayslist(doc.get('ensembl', None) or []):
+        if ensembl.get('gene', None):
+            xrefs.append(('ensemblgene', ensembl['gene']))
+    for retired in alwayslist(doc.get('retired', None) or []):
+        xrefs.append(('retired', str(retired)))
+    return xrefs
+
+
+def _get_intervals(doc):
+    '''return a list of (chr, start, end) tuples of a gene doc.'''
+    intervals = []
+    for gpos in alwayslist(doc.get('genomic_pos', None) or []):
+        try:
+            intervals.append((str(gpos['chr']), int(gpos['start']), int(gpos['end'])))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return intervals
+
+
+class IntervalIndex(object):
+    '''A static interval index for one chromosome, answering overlap
+       queries in O(log n + k).
+
+       Intervals are kept in arrays sorted by start, laid out as an implicit
+       binary search tree (the middle of each sub-array is its root, as in
+       the "cgranges" library), where each node also keeps the max. end of
+       its subtree. Subtrees ending before the query start are skipped
+       entirely. Coordinates are closed, i.e. [start, end].
+    '''
+    def __init__(self, intervals):
+        '''intervals is a list of (start, end, id) tuples.'''
+        intervals = sorted(intervals)
+        self.starts = array('q', [x[0] for x in intervals])
+        self.ends = array('q', [x[1] for x in intervals])
+        self.ids = [x[2] for x in intervals]
+        self.maxends = array('q', self.ends)
+        self.max_level = self._build()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _build(self):
+        n = len(self.ids)
+        if n == 0:
+            return -1
+        ends, maxends = self.ends, self.maxends
+        last_i = last = 0     # the rightmost node and its max. end
+        for i in range(0, n, 2):
+            last_i, last = i, ends[i]
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                er = maxends[i + x] if i + x < n else last
+                maxends[i] = max(ends[i], maxends[i - x], er)
+            last_i = last_i - x if last_i >> k & 1 else last_i + x
+            if last_i < n and maxends[last_i] > last:
+                last = maxends[last_i]
+            k += 1
+        return k - 1
+
+    def overlap(self, start, end):
+        '''return the positions (in sorted order) of all intervals
+           overlapping [start, end].
+        '''
+        n = len(self.ids)
+        starts, ends, maxends = self.starts, self.ends, self.maxends
+        out = []
+        if n == 0:
+            return out
+        stack = [(self.max_level, (1 << self.max_level) - 1, False)]
+        while stack:
+            k, x, left_done = stack.pop()
+            if k <= 3:
+                # a small subtree, just scan it.
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                for i in range(i0, i1):
+                    if starts[i] > end:
+                        break
+                    if ends[i] >= start:
+                        out.append(i)
+            elif not left_done:
+                stack.append((k, x, True))
+                y = x - (1 << (k - 1))      # the left child, may be out of range
+                if y >= n or maxends[y] >= start:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] <= end:
+                if ends[x] >= start:
+                    out.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        out.sort()
+        return out
+
+    def query(self, start, end):
+        '''return the ids of all intervals overlapping [start, end], sorted
+           by their start positions.
+        '''
+        return [self.ids[i] for i in self.overlap(start, end)]
+
+
+class LocalGeneStore(object):
+    '''Read access to a snapshot file. Each thread (and each process after a
+       fork) opens its own read-only SQLite connection, which is re-opened
+       when the file is replaced by a new build.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._intervals = None     # (inode, {(assembly, chr): IntervalIndex})
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        _key = (os.getpid(), os.stat(self.path).st_ino)
+        if getattr(self._local, 'key', None) != _key:
+            if getattr(self._local, 'conn', None) is not None and self._local.key[0] == _key[0]:
+                self._local.conn.close()
+            self._local.conn = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+            self._local.key = _key
+        return self._local.conn
+
+    @property
+    def version(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key='build_version'").fetchone()
+        return row[0] if row else None
+
+    def get(self, geneid):
+        '''return the gene doc for given gene id, or None.'''
+        return self.get_many([geneid])[0]
+
+    def get_many(self, geneid_li):
+        '''return a list of gene docs aligned with input geneid_li, with None
+           for any gene id not in the store.
+        '''
+        doc_d = {}
+        geneid_li = [str(x) for x in geneid_li]
+        # stay under SQLite's limit of 999 variables per statement.
+        for i in range(0, len(geneid_li), 900):
+            _ids = geneid_li[i:i + 900]
+            sql = 'SELECT id, doc FROM gene WHERE id IN ({})'.format(','.join('?' * len(_ids)))
+            for _id, doc in self.conn.execute(sql, _ids):
+                doc_d[_id] = doc
+        return [_decode(doc_d[x]) if x in doc_d else None for x in geneid_li]
+
+    def query(self, term_li, scopes=LOCAL_SCOPES):
+        '''resolve each term against given scopes, return a dictionary of
+           {term: [gene_id, ...]} for the terms found.
+        '''
+        out = {}
+        term_li = [str(x) for x in term_li]
+        for i in range(0, len(term_li), 900):
+            _terms = term_li[i:i + 900]
+            sql = 'SELECT term, id FROM xref WHERE term IN ({}) AND scope IN ({}) ORDER BY rowid'.format(
+                ','.join('?' * len(_terms)), ','.join('?' * len(scopes)))
+            for term, _id in self.conn.execute(sql, _terms + list(scopes)):
+                _ids = out.setdefault(term, [])
+                if _id not in _ids:
+                    _ids.append(_id)
+        return out
+
+    def get_interval_index(self):
+        '''return a dictionary of {(assembly, chr): IntervalIndex} for all
+           genes in the store, loaded once per process (and again after the
+           store is rebuilt).
+        '''
+        inode = os.stat(self.path).st_ino
+        with self._lock:
+            if self._intervals is None or self._intervals[0] != inode:
+                interval_d = {}
+                sql = 'SELECT taxid, chr, start, end, id FROM interval'
+                try:
+                    for taxid, chr, start, end, _id in self.conn.execute(sql):
+                        key = (assembly_d[species_d[taxid]], chr)
+                        interval_d.setdefault(key, []).append((start, end, _id))
+                except sqlite3.OperationalError:
+                    # the store was built before interval table was added.
+                    pass
+                self._intervals = (inode, dict([(k, IntervalIndex(v)) for k, v in interval_d.items()]))
+            return self._intervals[1]
+
+    def query_interval(self, species, chr, start, end):
+        '''return the ids of all genes of given species overlapping
+           chr:start-end, sorted by their start positions.
+        '''
+        index = self.get_interval_index().get((assembly_d[species], str(chr)), None)
+        return index.query(start, end) if index else []
+
+
+def build_store(path, doc_iter, build_version=None):
+    '''build a new snapshot file at path from an iterable of gene docs.
+       The snapshot is written to a temp file first and then moved into
+       place, so that running processes never see a partial file.
+       Return the number of genes stored.
+    '''
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE gene (id TEXT PRIMARY KEY, taxid INTEGER, doc BLOB)')
+        conn.execute('CREATE TABLE xref (term TEXT, scope TEXT, id TEXT)')
+        conn.execute('CREATE TABLE interval (taxid INTEGER, chr TEXT, start INTEGER, end INTEGER, id TEXT)')
+        cnt = 0
+        for doc in doc_iter:
+            doc = dict([(k, v) for k, v in doc.items() if k == '_id' or k in SNAPSHOT_FIELDS])
+            conn.execute('INSERT OR REPLACE INTO gene VALUES (?, ?, ?)',
+                         (str(doc['_id']), doc.get('taxid', None), _encode(doc)))
+            conn.executemany('INSERT INTO xref VALUES (?, ?, ?)',
+                             [(term, scope, str(doc['_id'])) for scope, term in _get_xrefs(doc)])
+            if doc.get('taxid', None) in species_d:
+                conn.executemany('INSERT INTO interval VALUES (?, ?, ?, ?, ?)',
+                                 [(doc['taxid'], chr, start, end, str(doc['_id']))
+                                  for chr, start, end in _get_intervals(doc)])
+            cnt += 1
+        conn.execute('CREATE INDEX xref_term ON xref (term, scope)')
+        conn.execute('INSERT INTO meta VALUES (?, ?)', ('build_version', build_version or ''))
+        conn.commit()
+    finally:
+        conn.close()
+    os.rename(tmp_path, path)
+    return cnt
+
+
+_store = None
+
+
+def get_local_store():
+    '''return the LocalGeneStore set by settings.BOE_LOCAL_STORE, or None if
+       not set or the snapshot file does not exist yet.
+    '''
+    global _store
+    path = getattr(settings, 'BOE_LOCAL_STORE', None)
+    if not path or not os.path.exists(path):
+        return None
+    if _store is None or _store.path != path:
+        _store = LocalGeneStore(path)
+    return _store
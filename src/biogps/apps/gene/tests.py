@@ -1,5 +1,5 @@
 from django.test import Client
-from biogps.test.utils import ok_, eq_, json_ok, ext_ok
+from biogps.test.utils import nottest, ok_, eq_, json_ok, ext_ok
 
 
 def test_gene():
@@ -23,4 +23,624 @@ def test_redirect():
     # ref for adding extra headers to test client:
     #     http://djangosnippets.org/snippets/850/
     res = c.get('/gene/1017/', **{'HTTP_USER_AGENT': "Googlebot/2.1"})
-    eq_(res.status_code, 200)
\ No newline at end of file
+    eq_(res.status_code, 200)
+
+
+def test_gene_cache():
+    from .cache import GeneDocCache
+
+    class _DS(object):
+        metadata = {'build_version': '20170101'}
+
+    ds = _DS()
+    calls = []
+
+    def _load(geneid):
+        calls.append(geneid)
+        return {'_id': geneid} if geneid != 'xxx' else None
+
+    gc = GeneDocCache(maxsize=2, cache_alias=None)
+    eq_(gc.get_or_call(ds, 'get_gene', ['1017'], lambda: _load('1017')), {'_id': '1017'})
+    eq_(gc.get_or_call(ds, 'get_gene', ['1017'], lambda: _load('1017')), {'_id': '1017'})
+    eq_(calls, ['1017'])
+
+    #404 is cached as well
+    eq_(gc.get_or_call(ds, 'get_gene', ['xxx'], lambda: _load('xxx')), None)
+    eq_(gc.get_or_call(ds, 'get_gene', ['xxx'], lambda: _load('xxx')), None)
+    eq_(calls, ['1017', 'xxx'])
+    eq_(gc.stats()['misses'], 2)
+    eq_(gc.stats()['local_hits'], 2)
+    eq_(gc.stats()['notfound_hits'], 1)
+
+    #least recently used "1017" is evicted
+    gc.get_or_call(ds, 'get_gene', ['1018'], lambda: _load('1018'))
+    gc.get_or_call(ds, 'get_gene', ['1017'], lambda: _load('1017'))
+    eq_(calls, ['1017', 'xxx', '1018', '1017'])
+
+    #new build version invalidates all cached items, once re-checked
+    ds.metadata = {'build_version': '20170201'}
+    gc.get_or_call(ds, 'get_gene', ['1017'], lambda: _load('1017'))
+    eq_(calls, ['1017', 'xxx', '1018', '1017'])
+    gc._version_checked -= gc.version_timeout
+    gc.get_or_call(ds, 'get_gene', ['1017'], lambda: _load('1017'))
+    eq_(calls, ['1017', 'xxx', '1018', '1017', '1017'])
+    eq_(gc.stats()['version'], '20170201')
+    eq_(gc.stats()['misses'], 5)
+
+    #a failing metadata service is not called on every lookup
+    class _FailingDS(object):
+        metadata_calls = 0
+
+        @property
+        def metadata(self):
+            self.metadata_calls += 1
+            raise IOError('metadata is down')
+
+    failing_ds = _FailingDS()
+    gc = GeneDocCache(maxsize=2, cache_alias=None, version_timeout=600, version_retry=60)
+    for i in range(3):
+        eq_(gc.get_or_call(failing_ds, 'get_gene', ['1017'], lambda: _load('1017')), {'_id': '1017'})
+    eq_(failing_ds.metadata_calls, 1)
+    eq_(gc.stats()['version'], None)
+    gc._version_checked -= 120
+    gc.get_or_call(failing_ds, 'get_gene', ['1017'], lambda: _load('1017'))
+    eq_(failing_ds.metadata_calls, 2)
+    eq_(gc._version_backoff, 240)
+
+
+
+def test_gene_singleflight():
+    '''N parallel get_gene calls for the same gene make one upstream call.'''
+    import threading
+    import time
+    from .boe import MyGeneInfo
+
+    n = 20
+    calls = []
+    barrier = threading.Barrier(n)
+
+    def _get(url, params={}):
+        calls.append(url)
+        time.sleep(0.2)
+        return {'_id': '1017', 'taxid': 9606, 'symbol': 'CDK2'}
+
+    mg = MyGeneInfo()
+    mg.cache = None
+    mg._get = _get
+    results = []
+
+    def _worker():
+        barrier.wait()
+        results.append(mg.get_gene(1017))
+
+    threads = [threading.Thread(target=_worker) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    eq_(len(calls), 1)
+    eq_(len(results), n)
+    ok_(all([g['symbol'] == 'CDK2' for g in results]))
+
+    #a different "fields" parameter is a different upstream call
+    mg.get_gene(1017, fields='symbol')
+    eq_(len(calls), 2)
+
+
+
+def test_gene_concurrent():
+    '''*_many methods run concurrently, but no more than max_workers at a time.'''
+    import threading
+    import time
+    from .boe import MyGeneInfo
+
+    lock = threading.Lock()
+    running = [0, 0]    # [current, max]
+
+    def _get_geneidentifiers(geneid):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return None if geneid == 'xxx' else {'EntryGeneID': geneid}
+
+    mg = MyGeneInfo()
+    mg.max_workers = 3
+    mg.get_geneidentifiers = _get_geneidentifiers
+    geneid_li = ['1017', '1018', 'xxx', '1019', '1020', '1021', '1022']
+    t0 = time.time()
+    res = mg.get_geneidentifiers_many(geneid_li)
+    eq_([g['EntryGeneID'] if g else None for g in res],
+        ['1017', '1018', None, '1019', '1020', '1021', '1022'])
+    eq_(running[1], 3)
+    ok_(time.time() - t0 < 0.05 * len(geneid_li))
+
+
+
+def test_gene_geneidentifiers_batch():
+    '''get_geneidentifiers_batch makes one request for all genes and one
+       for all homologs.
+    '''
+    from .boe import MyGeneInfo
+
+    homologene = {'id': 74409, 'genes': [[9606, 1017], [10090, 12566]]}
+    docs = {'1017': {'_id': '1017', 'taxid': 9606, 'symbol': 'CDK2', 'homologene': homologene},
+            '12566': {'_id': '12566', 'taxid': 10090, 'symbol': 'Cdk2', 'homologene': homologene},
+            '1018': {'_id': '1018', 'taxid': 9606, 'symbol': 'CDK3'}}
+    calls = []
+
+    def get_genes(geneid_li, fields=None):
+        calls.append(list(geneid_li))
+        return [docs.get(str(x), None) for x in geneid_li]
+
+    mg = MyGeneInfo()
+    mg.local_store = None
+    mg.get_genes = get_genes
+    res = mg.get_geneidentifiers_batch(['1017', 'xxx', '1018'])
+    eq_(calls, [['1017', 'xxx', '1018'], [12566]])
+    eq_(res[0]['SpeciesList'], ['human', 'mouse'])
+    eq_(res[0]['mouse'][0]['symbol'], 'Cdk2')
+    eq_(res[1], None)
+    eq_(res[2]['SpeciesList'], ['human'])
+
+
+def test_gene_geneidentifiers_fields():
+    '''only the fields used by given gene object attributes are fetched.'''
+    from .boe import MyGeneInfo, get_geneobj_fields
+
+    eq_(get_geneobj_fields(['symbol', 'mgi', 'ensemblgene', 'gstart', 'chr']),
+        ['MGI', 'ensembl.gene', 'genomic_pos', 'symbol'])
+    eq_(get_geneobj_fields([]), [])
+    eq_(get_geneobj_fields(['symbol', 'unknown']), None)
+
+    calls = []
+    mg = MyGeneInfo()
+    mg.local_store = None
+    mg.cache = None
+    mg.get_gene = lambda geneid, fields=None: calls.append(fields) or \
+        {'_id': '1017', 'taxid': 9606, 'symbol': 'CDK2'}
+    g = mg.get_geneidentifiers(1017, fields=['symbol'])
+    eq_(g['human'][0]['symbol'], 'CDK2')
+    eq_(calls, [['homologene', 'symbol', 'taxid']])
+    mg.get_geneidentifiers(1017)
+    eq_(calls[-1], None)
+
+
+def test_gene_querymany_chunks():
+    '''a long id list is sent in chunks of "step" terms, and hits are
+       returned in input order.
+    '''
+    import json
+    from biogps.utils.jsonstream import JSONItemStream
+    from .boe import MyGeneInfo
+
+    posted = []
+    closed = []
+
+    def _post(url, params):
+        terms = json.loads(params['q'])
+        posted.append(terms)
+        if 'timeout' in terms:
+            res = {'success': False, 'error': 'timeout'}
+        else:
+            res = [{'query': t, 'notfound': True} if t.startswith('x') else
+                   {'query': t, '_id': t, 'taxid': 9606} for t in terms]
+        return JSONItemStream([json.dumps(res).encode('utf-8')], close=lambda: closed.append(terms))
+
+    mg = MyGeneInfo()
+    mg.cache = None
+    mg.step = 3
+    mg._post = _post
+    terms = ['1017', 'x1', '1018', '1019', '1020', 'x2', '1021']
+    res = mg.query_by_id(terms)
+    eq_(posted, [terms[0:3], terms[3:6], terms[6:]])
+    eq_([g['_id'] for g in res['data']['geneList']], ['1017', '1018', '1019', '1020', '1021'])
+    eq_(res['data']['notfound'], ['x1', 'x2'])
+
+    eq_(len(mg.querygenelist(terms)), 5)
+
+    res = mg.query_by_id(terms + ['timeout'])
+    eq_(res['success'], False)
+    ok_(res['error'].startswith('Your query times out'))
+
+    # responses requested ahead are closed too after an error.
+    import time
+    del posted[:], closed[:]
+    mg.max_inflight = 2
+    res = mg.query_by_id(['timeout'] + terms)
+    eq_(res['success'], False)
+    for i in range(100):
+        if len(closed) == len(posted):
+            break
+        time.sleep(0.01)
+    eq_(sorted(closed), sorted(posted))
+
+
+def test_gene_shared_session():
+    '''all MyGeneInfo instances reuse one pooled session per url_root.'''
+    from . import boe
+    from .boe import MyGeneInfo, get_session_stats
+
+    mg1 = MyGeneInfo()
+    mg2 = MyGeneInfo()
+    ok_(mg1.s is mg2.s)
+    stats = get_session_stats()[mg1.url_root]
+    eq_(stats['inflight'], 0)
+    ok_(stats['pool_maxsize'] > 0)
+
+    # an existing instance gets a new session after a fork.
+    s = mg1.s
+    boe._session_pid = None
+    ok_(mg1.s is not s)
+    ok_(mg1.s is mg2.s)
+
+
+def test_gene_localstore():
+    '''genes in the local store are served without calling the service.'''
+    import os
+    import tempfile
+    from .boe import MyGeneInfo
+    from .localstore import LocalGeneStore, build_store
+
+    docs = [{'_id': '1017', 'taxid': 9606, 'symbol': 'CDK2', 'name': 'cyclin dependent kinase 2',
+             'ensembl': {'gene': 'ENSG00000123374'}, 'retired': 1018, 'pathway': {},
+             'homologene': {'id': 74409, 'genes': [[9606, 1017], [10090, 12566], [9999, 1]]}},
+            {'_id': '12566', 'taxid': 10090, 'symbol': 'Cdk2', 'name': 'cyclin-dependent kinase 2',
+             'homologene': {'id': 74409, 'genes': [[9606, 1017], [10090, 12566]]}}]
+    path = os.path.join(tempfile.mkdtemp(), 'genes.db')
+    eq_(build_store(path, iter(docs), build_version='20260101'), 2)
+    store = LocalGeneStore(path)
+    eq_(store.version, '20260101')
+    ok_('pathway' not in store.get('1017'))
+    eq_(store.get_many(['12566', 'x'])[1], None)
+    eq_(store.query(['ENSG00000123374', '1018', 'x']), {'ENSG00000123374': ['1017'], '1018': ['1017']})
+
+    remote_calls = []
+    mg = MyGeneInfo()
+    mg.local_store = store
+    mg.cache = None
+    mg._get_gene = lambda geneid, fields=None: remote_calls.append(geneid)
+    mg._get_genes = lambda geneid_li, fields=None: remote_calls.append(geneid_li) or [None] * len(geneid_li)
+    mg._querymany_iter = lambda qterms, **kwargs: remote_calls.append(qterms) or iter([])
+
+    gene = mg.get_gene(1017, fields='symbol,taxid')
+    eq_(sorted(gene.keys()), ['_id', 'id', 'symbol', 'taxid'])
+    eq_(mg.get_gene(1017, fields='homologene')['homologene']['genes'], [[9606, 1017], [10090, 12566]])
+    g = mg.get_geneidentifiers(1017, ['symbol'])
+    eq_(g['SpeciesList'], ['human', 'mouse'])
+    eq_(g['mouse'][0]['symbol'], 'Cdk2')
+    eq_(remote_calls, [])
+
+    # full gene docs are not in the store.
+    eq_(mg.get_gene(1017), None)
+    eq_(remote_calls, [1017])
+    del remote_calls[:]
+
+    eq_([x['_id'] for x in mg.querygenelist(['12566', 'ENSG00000123374', 'unknown'])], ['12566', '1017'])
+    eq_(remote_calls, [['unknown']])
+    eq_(mg.get_genes(['1017', 'unknown'], 'symbol')[1], None)
+    eq_(remote_calls[-1], ['unknown'])
+
+    # requests with a userfilter are never served locally.
+    mg.userfilter = 'bgps_default'
+    mg.get_genes(['1017'], 'symbol')
+    eq_(remote_calls[-1], ['1017'])
+
+
+def test_gene_interval_index():
+    '''interval queries served from the local store's interval index.'''
+    import os
+    import random
+    import tempfile
+    from .boe import MyGeneInfo
+    from .localstore import IntervalIndex, LocalGeneStore, build_store
+
+    # compare against a linear scan, including very long intervals.
+    intervals = []
+    for i in range(2000):
+        start = random.randint(0, 10 ** 6)
+        intervals.append((start, start + random.choice([100, 5000, 300000]), str(i)))
+    index = IntervalIndex(intervals)
+    for i in range(200):
+        start = random.randint(0, 10 ** 6)
+        end = start + random.randint(0, 20000)
+        eq_(index.query(start, end),
+            [x[2] for x in sorted(intervals) if x[0] <= end and x[1] >= start])
+    eq_(IntervalIndex([]).query(1, 2), [])
+
+    docs = [{'_id': str(i), 'taxid': 9606, 'symbol': 'G{}'.format(i),
+             'genomic_pos': {'chr': '1', 'start': i * 100, 'end': i * 100 + 150}}
+            for i in range(1, 2501)]
+    docs.append({'_id': '1017', 'taxid': 10090, 'symbol': 'Cdk2',
+                 'genomic_pos': [{'chr': '1', 'start': 100, 'end': 200}, {'chr': 'X', 'start': 1}]})
+    path = os.path.join(tempfile.mkdtemp(), 'genes.db')
+    build_store(path, iter(docs))
+    mg = MyGeneInfo()
+    mg.local_store = LocalGeneStore(path)
+    mg._get = None      # never called
+
+    res = mg.query_by_interval('chr1:1,000-2000', 'human')
+    eq_([g['_id'] for g in res['data']['geneList']], [str(i) for i in range(9, 21)])
+    eq_(res['data']['total'], 12)
+    eq_(mg.query_by_interval('chr1:100-100', 'mouse')['data']['geneList'][0]['symbol'], 'Cdk2')
+
+    # pagination past the first 1000 hits.
+    res = mg.query_by_interval('chr1:1-1000000', 'human')
+    eq_(res['data']['total'], 2500)
+    eq_(res['data']['totalCount'], 1000)
+    res = mg.query_by_interval('chr1:1-1000000', 'human', skip=2000)
+    eq_(res['data']['totalCount'], 500)
+    eq_(res['data']['geneList'][-1]['_id'], '2500')
+
+
+def test_gene_query_cache():
+    '''repeated searches are served from query_cache.'''
+    from . import boe
+    from .cache import query_cache
+
+    calls = []
+
+    def query_by_keyword(self, query):
+        calls.append(query)
+        return {'data': {'query': query, 'geneList': [{'_id': '1017'}], 'totalCount': 1,
+                         'qtype': 'keyword'}, 'success': True}
+
+    def query_by_id(self, terms):
+        calls.append(terms)
+        if terms[0] == 'CDK4':
+            return {'data': {'geneList': [], 'totalCount': 0, 'qtype': 'id'}, 'success': True}
+        return {'error': 'timeout'}
+
+    _orig = boe.MyGeneInfo.query_by_keyword, boe.MyGeneInfo.query_by_id
+    boe.MyGeneInfo.query_by_keyword, boe.MyGeneInfo.query_by_id = query_by_keyword, query_by_id
+    query_cache.clear()
+    try:
+        res = boe.do_query({'query': 'CDK2'})
+        ok_('cache_hit' not in res['_log'])
+        res = boe.do_query({'query': ' CDK2 '})
+        eq_(res['_log']['cache_hit'], 1)
+        eq_(res['data']['query'], 'CDK2')
+        eq_(calls, ['CDK2'])
+
+        # the query is case-sensitive, e.g. "AND" vs. "and".
+        boe.do_query({'query': 'cdk2'})
+        eq_(calls, ['CDK2', 'cdk2'])
+
+        # userfilter is part of the key.
+        boe.do_query({'query': 'cdk2', 'userfilter': 'bgps_default'})
+        eq_(len(calls), 3)
+
+        # an error is never cached.
+        boe.do_query({'query': 'CDK2, CDK3'})
+        res = boe.do_query({'query': 'CDK2\nCDK3'})
+        ok_('cache_hit' not in res['_log'])
+        eq_(calls[3:], [['CDK2', 'CDK3'], ['CDK2', 'CDK3']])
+
+        # nor a large id query.
+        cnt = len(query_cache.local)
+        terms = ['CDK4'] + ['G%d' % i for i in range(query_cache.max_terms)]
+        boe.do_query({'query': '\n'.join(terms)})
+        boe.do_query({'query': '\n'.join(terms)})
+        eq_(calls[5:], [terms, terms])
+        eq_(len(query_cache.local), cnt)
+    finally:
+        boe.MyGeneInfo.query_by_keyword, boe.MyGeneInfo.query_by_id = _orig
+        query_cache.clear()
+
+
+@nottest
+def _split_queryterms_shlex(q):
+    '''the reference implementation of split_queryterms.'''
+    from shlex import shlex
+    lex = shlex(q, posix=True)
+    lex.whitespace = '\t\n\x0b\x0c\r|,+'
+    lex.whitespace_split = True
+    lex.commenters = ''
+    terms = [x.strip() for x in list(lex)]
+    return [x for x in terms if x]
+
+
+@nottest
+def _split_both(q):
+    from .boe import split_queryterms
+    out = []
+    for fn in [split_queryterms, _split_queryterms_shlex]:
+        try:
+            out.append(fn(q))
+        except ValueError as e:
+            out.append(str(e))
+    return out
+
+
+def test_gene_split_queryterms():
+    '''split_queryterms behaves exactly as shlex does.'''
+    import random
+    from .boe import split_queryterms
+
+    eq_(split_queryterms('CDK2, CDK3'), ['CDK2', 'CDK3'])
+    eq_(split_queryterms('"CDK2, CDK3"\n CDK4'), ['CDK2, CDK3', 'CDK4'])
+    corpus = ['', ' ', 'cdk2', 'cdk2 cdk3', 'a|b+c,d\te\rf\x0bg\x0ch', ',,a,,', 'a b, c d',
+              '"a, b"', "'a, b'", 'x"a, b"y', "x'a|b'y", '""', "''", '"" , a', '"a"\'b\'',
+              '"a\\"b"', '"a\\\\b"', '"a\\nb"', "'a\\b'", 'a\\,b', 'a\\ b', '\\"a',
+              '"unclosed', "'unclosed", 'a"b', 'a\\', '"a\\', '"a\\"', "'a\\", '\\',
+              '"a" "b"', '  "a b"  ,  c  ', '\u00e9t\u00e9, "\u4e2d\u6587"']
+    for q in corpus:
+        res, expected = _split_both(q)
+        eq_(res, expected, q)
+
+    # random inputs drawn from the characters with a special meaning.
+    random.seed(0)
+    chars = 'ab \t\n\r|,+"\'\\'
+    for i in range(5000):
+        q = ''.join(random.choice(chars) for j in range(random.randint(0, 12)))
+        res, expected = _split_both(q)
+        eq_(res, expected, repr(q))
+
+
+#==============================================================================
+# Benchmarks, not run as part of the test suite. To run them manually:
+#   python manage.py shell
+#   >>> from biogps.apps.gene.tests import benchmark_homolog_fetch
+#   >>> benchmark_homolog_fetch()
+#   >>> benchmark_interval_index()
+#   >>> benchmark_split_queryterms()
+#==============================================================================
+_bench_homologene = [[9606, 1017], [10090, 12566], [10116, 362817],
+                     [7227, 42453], [6239, 172677], [7955, 406715],
+                     [3702, 837405], [8364, 493498], [9823, 100127490]]
+
+
+@nottest
+def _bench_gene_doc(taxid, geneid):
+    return {'_id': str(geneid), 'taxid': taxid, 'symbol': 'CDK2',
+            'name': 'cyclin-dependent kinase 2', 'entrezgene': geneid,
+            'homologene': {'id': 74409, 'genes': _bench_homologene}}
+
+
+@nottest
+def _start_bench_server(latency):
+    '''start a local stand-in server for the gene service, which sleeps
+       "latency" seconds before answering each request.
+    '''
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+
+    taxid_by_geneid = dict([(str(gid), tid) for tid, gid in _bench_homologene])
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, data):
+            time.sleep(latency)
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            geneid = self.path.split('?')[0].rstrip('/').split('/')[-1]
+            self._reply(_bench_gene_doc(taxid_by_geneid[geneid], int(geneid)))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            params = parse_qs(self.rfile.read(length).decode('utf-8'))
+            out = []
+            for geneid in params['ids'][0].split(','):
+                doc = _bench_gene_doc(taxid_by_geneid[geneid], int(geneid))
+                doc['query'] = geneid
+                out.append(doc)
+            self._reply(out)
+
+        def log_message(self, *args):
+            pass
+
+    svr = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=svr.serve_forever)
+    t.daemon = True
+    t.start()
+    return svr
+
+
+@nottest
+def benchmark_homolog_fetch(repeat=20, latency=0.01):
+    '''compare fetching all homologs of CDK2 with one get_gene call per
+       homolog (the old path) against one batched get_genes call.
+    '''
+    import time
+    from .boe import MyGeneInfo
+
+    svr = _start_bench_server(latency)
+    try:
+        mg = MyGeneInfo('http://127.0.0.1:{}/v3'.format(svr.server_port))
+        mg.cache = None
+        homolog_li = [gid for tid, gid in _bench_homologene if tid != 9606]
+
+        t0 = time.time()
+        for i in range(repeat):
+            old = [mg.get_gene(gid) for gid in homolog_li]
+        t_old = (time.time() - t0) / repeat
+
+        t0 = time.time()
+        for i in range(repeat):
+            new = mg.get_genes(homolog_li)
+        t_new = (time.time() - t0) / repeat
+
+        eq_([g['_id'] for g in old], [g['_id'] for g in new])
+        print('sequential get_gene: {:.1f} ms'.format(t_old * 1000))
+        print('batched get_genes:   {:.1f} ms'.format(t_new * 1000))
+        print('speedup:             {:.1f}x'.format(t_old / t_new))
+
+        t0 = time.time()
+        for i in range(repeat):
+            mg.get_geneidentifiers(1017)
+        print('get_geneidentifiers: {:.1f} ms'.format((time.time() - t0) / repeat * 1000))
+    finally:
+        svr.shutdown()
+        svr.server_close()
+
+
+@nottest
+def benchmark_interval_index(n=500000, repeat=1000, window=100000):
+    '''compare the interval index against a linear scan over n genes
+       with random windows.
+    '''
+    import random
+    import time
+    from .localstore import IntervalIndex
+
+    chr_len = 250 * 10 ** 6
+    intervals = []
+    for i in range(n):
+        start = random.randint(0, chr_len)
+        intervals.append((start, start + int(random.expovariate(1.0 / 30000)), i))
+    t0 = time.time()
+    index = IntervalIndex(intervals)
+    print('index built:  {:.1f} s ({} genes)'.format(time.time() - t0, n))
+
+    windows = []
+    for i in range(repeat):
+        start = random.randint(0, chr_len)
+        windows.append((start, start + random.randint(1, window)))
+
+    t0 = time.time()
+    cnt = sum([len(index.query(start, end)) for start, end in windows])
+    t_index = (time.time() - t0) / repeat
+
+    t0 = time.time()
+    for start, end in windows[:20]:
+        [x for x in intervals if x[0] <= end and x[1] >= start]
+    t_scan = (time.time() - t0) / 20
+
+    print('avg. hits:    {:.1f}'.format(cnt / float(repeat)))
+    print('linear scan:  {:.3f} ms'.format(t_scan * 1000))
+    print('index query:  {:.3f} ms'.format(t_index * 1000))
+    print('speedup:      {:.0f}x'.format(t_scan / t_index))
+
+
+@nottest
+def benchmark_split_queryterms(n=10000, repeat=10):
+    '''compare split_queryterms against shlex on a paste of n ids.'''
+    import time
+    from .boe import split_queryterms
+
+    paste = '\n'.join(['ENSG{:011d}'.format(i) for i in range(n)])
+    quoted = ', '.join(['"CDK{} kinase"'.format(i) if i % 10 == 0 else 'CDK{}'.format(i)
+                        for i in range(n)])
+    for name, q in [('plain ids', paste), ('with quotes', quoted)]:
+        t0 = time.time()
+        for i in range(repeat):
+            expected = _split_queryterms_shlex(q)
+        t_shlex = (time.time() - t0) / repeat
+        t0 = time.time()
+        for i in range(repeat):
+            res = split_queryterms(q)
+        t_new = (time.time() - t0) / repeat
+        eq_(res, expected)
+        print('{}: shlex {:.1f} ms, split_queryterms {:.2f} ms, speedup {:.0f}x'.format(
+              name, t_shlex * 1000, t_new * 1000, t_shlex / t_new))
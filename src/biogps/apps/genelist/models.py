@@ -3,7 +3,7 @@ from django.db import models
 from django_extensions.db.fields import AutoSlugField
 from tagging.registry import register
 
-from biogps.utils.models import BioGPSModel
+from biogps.utils.models import BioGPSModel, set_listing_cache_invalidation
 from biogps.utils.fields.jsonfield import JSONField
 from biogps.apps.auth2.models import UserProfile
 from biogps.apps.search.build_index import set_on_the_fly_indexing
@@ -53,3 +53,4 @@ class BiogpsGeneList(BioGPSModel):
 register(BiogpsGeneList)
 
 set_on_the_fly_indexing(BiogpsGeneList)
+set_listing_cache_invalidation(BiogpsGeneList)
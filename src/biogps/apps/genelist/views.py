@@ -10,6 +10,7 @@ from rest_framework.response import Response
 from biogps.utils import log, cvtPermission, formatDateTime, setObjectPermission
 from biogps.utils.http import APIError, JSONResponse
 from biogps.apps.genelist.models import BiogpsGeneList
+from biogps.apps.auth2.models import get_owner_names
 from biogps.apps.gene.boe import MyGeneInfo
 
 
@@ -306,7 +307,7 @@ class GeneListViewSet(viewsets.ViewSet):
             children = [dict(text='Saved Lists', id='/mygenelist', cls='folder'),
                         dict(text='Shared Lists', id='/sharedgenelist', cls='folder')]
         elif node.split('/') == ['', 'mygenelist']:
-            query_result = self._get_my_genelists(request.user)
+            query_result = BiogpsGeneList.objects.prefetch_permissions(self._get_my_genelists(request.user))
             for _genelist in query_result:
                 child = dict(text='%s (%s)' % (_genelist.name, _genelist.size),
                              id='/mygenelist/genelist_' + str(_genelist.id),
@@ -322,18 +323,22 @@ class GeneListViewSet(viewsets.ViewSet):
                              )
                 children.append(child)
         elif node.split('/') == ['', 'sharedgenelist']:
-            query_result = self._get_shared_genelists(request.user)
-            for _genelist in query_result:
-                child = dict(text='%s (%s)' % (_genelist.name, _genelist.size),
-                             id='/sharedgenelist/genelist_' + str(_genelist.id),
+            rows = BiogpsGeneList.objects.get_shared_listing(request.user,
+                                                             ['id', 'name', 'size', 'description', 'lastmodified', 'created'],
+                                                             ['name'])
+            owner_d = get_owner_names(set([row['ownerprofile'] for row in rows]))
+            perm_d = BiogpsGeneList.objects.get_permissions([row['id'] for row in rows])
+            for row in rows:
+                child = dict(text='%s (%s)' % (row['name'], row['size']),
+                             id='/sharedgenelist/genelist_' + str(row['id']),
                              cls='folder',
-                             genelist_id=_genelist.id,
-                             genelist_name=_genelist.layout_name,
-                             author=_genelist.owner.get_valid_name(),
-                             description=_genelist.description,
-                             rolepermission=cvtPermission(_genelist.permission).get('R', None),
-                             lastmodified=formatDateTime(_genelist.lastmodified),
-                             created=formatDateTime(_genelist.created),
+                             genelist_id=row['id'],
+                             genelist_name=row['name'],
+                             author=owner_d[row['ownerprofile']][1] if row['ownerprofile'] in owner_d else '',
+                             description=row['description'],
+                             rolepermission=cvtPermission(perm_d.get(row['id'], [])).get('R', None),
+                             lastmodified=formatDateTime(row['lastmodified']),
+                             created=formatDateTime(row['created']),
                              genelist_scope='shared',
                              )
                 children.append(child)
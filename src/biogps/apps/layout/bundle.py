@@ -0,0 +1,59 @@
+'''
+A precomputed bundle of the default layouts for anonymous visitors: the
+layouts in DEFAULT_UIPROFILE with all their plugin details, stored in cache
+as one gzipped JSON document, served by /layout/default/ with an ETag.
+
+The bundle's cache key is derived from the versions of the default layouts
+(see get_layouts_version in models.py), so it is invalidated by the same
+signals as the cached layouts, and re-built on the next request. It can be
+pre-built after each deployment by the management command:
+    python manage.py biogps_build_layout_bundle
+'''
+import gzip
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from biogps.utils import log
+from biogps.apps.auth2.models import DEFAULT_UIPROFILE
+from biogps.apps.layout.models import get_cached_layouts, get_layouts_version
+
+
+def build_default_bundle():
+    '''return a tuple of (etag, gzipped json) of the default layouts bundle.'''
+    layout_ids = DEFAULT_UIPROFILE['sharedlayouts']
+    items = []
+    for owner_id, item in get_cached_layouts(layout_ids, loadplugin=True):
+        item['fields']['is_shared'] = True
+        items.append(item)
+    bundle = {'defaultlayout': DEFAULT_UIPROFILE['defaultlayout'],
+              'sharedlayouts': layout_ids,
+              'layouts': {'totalCount': len(items),
+                          'items': items}}
+    data = gzip.compress(json.dumps(bundle, separators=(',', ':'), cls=DjangoJSONEncoder).encode('utf-8'), mtime=0)
+    return hashlib.md5(data).hexdigest(), data
+
+
+def get_default_bundle(rebuild=False):
+    '''return a tuple of (etag, gzipped json) of the default layouts bundle,
+       from cache if it is still valid, or built and cached otherwise.
+    '''
+    bundle = None
+    try:
+        key = 'layout_default_bundle:' + get_layouts_version(DEFAULT_UIPROFILE['sharedlayouts'], loadplugin=True)
+        if not rebuild:
+            bundle = cache.get(key)
+    except Exception as e:
+        log.warning('action=layout_bundle error="%s"', e)
+        key = None
+
+    if bundle is None:
+        bundle = build_default_bundle()
+        if key:
+            try:
+                cache.set(key, bundle, None)
+            except Exception as e:
+                log.warning('action=layout_bundle error="%s"', e)
+    return bundle
@@ -1,10 +1,22 @@
 '''Models definition for BioGPS plugins.'''
-from django.db import models
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+from django.contrib.contenttypes.models import ContentType
+from tagging.models import TaggedItem
 from tagging.registry import register
 
-from biogps.utils.models import BioGPSModel
+from biogps.utils import log
+from biogps.utils.models import (BioGPSModel, BiogpsPermission, permission_changed,
+                                 set_listing_cache_invalidation, invalidate_listing_cache,
+                                 get_cache_versions, bump_cache_version)
 from biogps.utils.fields.jsonfield import JSONField
-from biogps.apps.auth2.models import UserProfile
+from biogps.utils.jsonserializer import serialize_objects
+from biogps.apps.auth2.models import UserProfile, GLOBAL_DEFAULT_SHARED_LAYOUT, get_owner_names
 from biogps.apps.plugin.models import BiogpsPlugin
 from biogps.apps.search.build_index import set_on_the_fly_indexing
 
@@ -63,7 +75,9 @@ class BiogpsGenereportLayout(BioGPSModel):
             e.g., [{'width': 838, 'id': 10, 'top': 28, 'left': 10, 'useroptions': None, 'height': 435}]
         """
         if loadplugin or self.loadplugin:
-            return [dict(id=p.plugin.id,
+            layoutplugin_li = list(self.biogpslayoutplugin_set.order_by('top', 'left').select_related('plugin'))
+            owner_d = get_owner_names(set([p.plugin.ownerprofile_id for p in layoutplugin_li]))
+            return [dict(id=p.plugin_id,
                          height=p.height,
                          width=p.width,
                          left=p.left,
@@ -73,58 +87,114 @@ class BiogpsGenereportLayout(BioGPSModel):
                          #more details about the plugin
                          title=p.plugin.title,
                          url=p.plugin.url,
-                         author=p.plugin.owner.get_valid_name(),
-                         author_url=p.plugin.owner.get_absolute_url(),
+                         author=owner_d[p.plugin.ownerprofile_id][1],
+                         author_url=owner_d[p.plugin.ownerprofile_id][2],
                          type=p.plugin.type,
                          description=p.plugin.description,
                          lastmodified=p.plugin.lastmodified,
                          species=p.plugin.species,
                          options=p.plugin.options
                          )
-                    #for p in self.biogpslayoutplugin_set.order_by('top', 'left')]
-                    #for p in self.biogpslayoutplugin_set.select_related().order_by('top', 'left')]
-                    for p in self.biogpslayoutplugin_set.order_by('top', 'left').select_related(
-                        "plugin__id",
-                        "plugin__url",
-                        "plugin__type",
-                        "plugin__description",
-                        "plugin__lastmodified",
-                        "plugin__species",
-                        "plugin__options",
-
-                        "plugin__ownerprofile__user",
-                        "plugin__ownerprofile",
-                       )]
-
+                    for p in layoutplugin_li]
 
         else:
-            return [dict(id=p.plugin.id,
+            return [dict(id=p.plugin_id,
                          height=p.height,
                          width=p.width,
                          left=p.left,
                          top=p.top,
                          useroptions=p.useroptions)
-                    #for p in self.biogpslayoutplugin_set.select_related().order_by('top', 'left')]
-                    for p in self.biogpslayoutplugin_set.order_by('top', 'left').select_related(
-                        "plugin__id",
-                        )]
+                    for p in self.biogpslayoutplugin_set.order_by('top', 'left')]
 
     def save_layout_data(self, layout_data):
         """save layout_data (a list of dictionaries).
             e.g. layout_data = [{'width': 838, 'id': 10, 'top': 28, 'left': 10, 'useroptions': None, 'height': 435}]
+           Only the difference from existing layout_data is written, in one
+           transaction: new plugins are bulk-created, moved/resized ones
+           are updated in one query and removed ones are deleted.
+           No ES reindexing is triggered here: on-the-fly indexing hangs off
+           the layout's own save only (never BiogpsLayoutPlugin), and the
+           indexed layout doc does not include layout_data, so a caller's
+           single layout.save() covers a whole layout_data change.
         """
         if isinstance(layout_data, (list, tuple)):
-            self.plugins.clear()
-
-            for d in layout_data:
-                p = BiogpsPlugin.objects.get(id=d['id'])
-                _d = BiogpsLayoutPlugin.objects.create(layout=self, plugin=p)
-                for attr in ['height', 'width', 'left', 'top']:
-                    if d.get(attr, None) is not None:
-                        setattr(_d, attr, max(0, int(d[attr])))
-                if d.get('useroptions', None):
-                    _d.useroptions = d['useroptions']
-                _d.save()
+            plugin_ids = set([int(d['id']) for d in layout_data])
+            with transaction.atomic():
+                if plugin_ids - set(BiogpsPlugin.objects.filter(id__in=plugin_ids).values_list('id', flat=True)):
+                    raise BiogpsPlugin.DoesNotExist('BiogpsPlugin matching query does not exist.')
+
+                existing_d = {}
+                for _d in self.biogpslayoutplugin_set.order_by('id'):
+                    existing_d.setdefault(_d.plugin_id, []).append(_d)
+
+                new_li, changed_li = [], []
+                for d in layout_data:
+                    _d = BiogpsLayoutPlugin(layout=self, plugin_id=int(d['id']))
+                    for attr in ['height', 'width', 'left', 'top']:
+                        if d.get(attr, None) is not None:
+                            setattr(_d, attr, max(0, int(d[attr])))
+                    #new instances default useroptions to '', while loaded ones get None
+                    _d.useroptions = d.get('useroptions', None) or None
+
+                    if existing_d.get(_d.plugin_id, None):
+                        _existing = existing_d[_d.plugin_id].pop(0)
+                        _d.id = _existing.id
+                        _existing.useroptions = _existing.useroptions or None
+                        if any([getattr(_d, attr) != getattr(_existing, attr) for attr in BiogpsLayoutPlugin.LAYOUT_ATTRS]):
+                            changed_li.append(_d)
+                    else:
+                        new_li.append(_d)
+
+                removed_ids = [_d.id for _li in existing_d.values() for _d in _li]
+                if removed_ids:
+                    BiogpsLayoutPlugin.objects.filter(id__in=removed_ids).delete()
+                if new_li:
+                    BiogpsLayoutPlugin.objects.bulk_create(new_li)
+                if changed_li:
+                    values = {}
+                    for attr in BiogpsLayoutPlugin.LAYOUT_ATTRS:
+                        field = BiogpsLayoutPlugin._meta.get_field(attr)
+                        values[attr] = Case(*[When(id=_d.id, then=Value(getattr(_d, attr), output_field=field))
+                                              for _d in changed_li], output_field=field)
+                    BiogpsLayoutPlugin.objects.filter(id__in=[_d.id for _d in changed_li]).update(**values)
+
+            #bulk_create and update do not send signals
+            invalidate_layout_cache(BiogpsGenereportLayout, instance=self)
+
+    def patch_layout_data(self, add=None, update=None, remove=None):
+        """apply only the changes to layout_data, touching affected rows only.
+            @param add: a list of new plugins, in the same format as layout_data.
+            @param update: a list of moved/resized plugins, each containing
+                           "id" and only the changed attributes, e.g.
+                           [{'id': 10, 'top': 28, 'left': 10}]
+            @param remove: a list of plugin ids to remove.
+           Raise BiogpsPlugin.DoesNotExist for any plugin in "add" not
+           existing, or BiogpsLayoutPlugin.DoesNotExist for any plugin in
+           "update" not in this layout. Layout's lastmodified is updated.
+        """
+        add, update, remove = add or [], update or [], remove or []
+        with transaction.atomic():
+            if remove:
+                self.biogpslayoutplugin_set.filter(plugin_id__in=[int(pid) for pid in remove]).delete()
+
+            for d in update:
+                values = _cvt_layout_attrs(d)
+                if values and self.biogpslayoutplugin_set.filter(plugin_id=int(d['id'])).update(**values) == 0:
+                    raise BiogpsLayoutPlugin.DoesNotExist('Plugin {} is not in this layout.'.format(d['id']))
+
+            if add:
+                plugin_ids = set([int(d['id']) for d in add])
+                if plugin_ids - set(BiogpsPlugin.objects.filter(id__in=plugin_ids).values_list('id', flat=True)):
+                    raise BiogpsPlugin.DoesNotExist('BiogpsPlugin matching query does not exist.')
+                BiogpsLayoutPlugin.objects.bulk_create([BiogpsLayoutPlugin(layout=self, plugin_id=int(d['id']), **_cvt_layout_attrs(d))
+                                                        for d in add])
+
+            #update lastmodified without a full save, which reindexes the layout.
+            BiogpsGenereportLayout.objects.filter(id=self.id).update(lastmodified=timezone.now())
+            self.lastmodified = BiogpsGenereportLayout.objects.values_list('lastmodified', flat=True).get(id=self.id)
+
+        invalidate_layout_cache(BiogpsGenereportLayout, instance=self)
+        invalidate_listing_cache(BiogpsGenereportLayout, instance=self)
 
     def clean_layout_data(self):
         '''remove all existing layout_data.'''
@@ -136,7 +206,21 @@ class BiogpsGenereportLayout(BioGPSModel):
 register(BiogpsGenereportLayout)
 
 
+def _cvt_layout_attrs(d):
+    '''return the attributes given in a layout_data item, with positions and
+       sizes as non-negative integers.
+    '''
+    attrs = {}
+    for attr in ['height', 'width', 'left', 'top']:
+        if attr in d:
+            attrs[attr] = None if d[attr] is None else max(0, int(d[attr]))
+    if 'useroptions' in d:
+        attrs['useroptions'] = d['useroptions']
+    return attrs
+
+
 set_on_the_fly_indexing(BiogpsGenereportLayout)
+set_listing_cache_invalidation(BiogpsGenereportLayout)
 
 
 class BiogpsLayoutPlugin(models.Model):
@@ -150,6 +234,9 @@ class BiogpsLayoutPlugin(models.Model):
     #extra options user specified for the container layout.
     useroptions = JSONField(blank=True, editable=False)
 
+    #the attributes saved from layout_data
+    LAYOUT_ATTRS = ('height', 'width', 'left', 'top', 'useroptions')
+
 #    class Meta:
         # set app_lable to www for back-compatibility
         # so that existing record in content-type table will match this model
@@ -159,3 +246,127 @@ class BiogpsLayoutPlugin(models.Model):
 
     def __unicode__(self):
         return u'plugin "%s" in layout "%s"' % (self.plugin.title, self.layout.layout_name)
+
+
+#==============================================================================
+# Cache of serialized layouts, as returned by /layout/<id>/ service.
+# Cache keys include a version per layout, replaced whenever the layout, its
+# plugins in layout_data, its permissions or its tags are changed. Plugin
+# details loaded with "loadplugin" are covered by one more version, replaced
+# whenever any plugin is changed. Versions never reset to a former value (see
+# get_cache_versions in utils/models.py), so a payload cached without expiry
+# can not be served again once its layout is changed.
+#==============================================================================
+LAYOUT_CACHE_TIMEOUT = getattr(settings, 'LAYOUT_CACHE_TIMEOUT', settings.CACHE_DAY)
+LAYOUT_PLUGIN_VERSION_KEY = 'layout_plugin_version'
+
+
+def _layout_version_key(layout_id):
+    return 'layout_version:{}'.format(layout_id)
+
+
+def _layout_cache_keys(layout_ids, loadplugin=False):
+    version_keys = [_layout_version_key(layout_id) for layout_id in layout_ids]
+    version_d = get_cache_versions(version_keys + ([LAYOUT_PLUGIN_VERSION_KEY] if loadplugin else []))
+    plugin_version = version_d[LAYOUT_PLUGIN_VERSION_KEY] if loadplugin else 0
+    return dict([(layout_id, 'layout_payload:{}:{}:{}:{}'.format(layout_id, version_d[version_key],
+                                                                 plugin_version, int(bool(loadplugin))))
+                 for layout_id, version_key in zip(layout_ids, version_keys)])
+
+
+def get_layouts_version(layout_ids, loadplugin=False):
+    '''return a string which changes whenever any of given layouts (or
+       their plugins if loadplugin is True) is changed.
+    '''
+    key_d = _layout_cache_keys(sorted(set([int(layout_id) for layout_id in layout_ids])), loadplugin)
+    return hashlib.md5('|'.join([key_d[layout_id] for layout_id in sorted(key_d)]).encode('utf-8')).hexdigest()
+
+
+def serialize_layouts(layout_ids, loadplugin=False):
+    '''return a list of (owner's user id, serialized layout) tuples for
+       given layout ids, ordered by layout_name. A serialized layout is the
+       same item JSONSerializer returns (see serialize_objects), including
+       "author" and "layout_data" fields. Layouts not existing are skipped.
+    '''
+    layout_li = list(BiogpsGenereportLayout.objects.filter(pk__in=layout_ids))
+    owner_d = get_owner_names(set([layout.ownerprofile_id for layout in layout_li]))
+    for layout in layout_li:
+        layout.author = owner_d[layout.ownerprofile_id][1]
+        layout.loadplugin = loadplugin
+    items = serialize_objects(layout_li, extra_itemfields=['author', 'layout_data'])
+    return [(owner_d[layout.ownerprofile_id][0], item) for layout, item in zip(layout_li, items)]
+
+
+def get_cached_layouts(layout_ids, loadplugin=False):
+    '''the same as serialize_layouts, but serve the layouts from cache
+       and only load and serialize the missing ones. The default shared
+       layouts, fetched by almost every visitor, never expire from cache
+       until they are changed.
+    '''
+    layout_ids = sorted(set([int(layout_id) for layout_id in layout_ids]))
+    try:
+        key_d = _layout_cache_keys(layout_ids, loadplugin)
+        cached = cache.get_many(list(key_d.values()))
+    except Exception as e:
+        log.warning('action=layout_cache error="%s"', e)
+        return serialize_layouts(layout_ids, loadplugin)
+
+    out = [cached[key_d[layout_id]] for layout_id in layout_ids if key_d[layout_id] in cached]
+    missing = [layout_id for layout_id in layout_ids if key_d[layout_id] not in cached]
+    if missing:
+        new_items = serialize_layouts(missing, loadplugin)
+        default_d, other_d = {}, {}
+        for owner_id, item in new_items:
+            _d = default_d if item['pk'] in GLOBAL_DEFAULT_SHARED_LAYOUT else other_d
+            _d[key_d[item['pk']]] = (owner_id, item)
+        try:
+            if default_d:
+                cache.set_many(default_d, None)
+            if other_d:
+                cache.set_many(other_d, LAYOUT_CACHE_TIMEOUT)
+        except Exception as e:
+            log.warning('action=layout_cache error="%s"', e)
+        out.extend(new_items)
+    out.sort(key=lambda x: x[1]['fields']['layout_name'])
+    return out
+
+
+def invalidate_layout_cache(sender, **kwargs):
+    '''Handle post-save and post-delete for Layout, LayoutPlugin, Plugin,
+       Permission and TaggedItem models, m2m_changed for Layout.plugins and
+       permission_changed for Layout. Drops the cached payloads of affected
+       layouts.
+    '''
+    instance = kwargs['instance']
+    layout_ids = []
+    if 'action' in kwargs:
+        #m2m_changed, sent with BiogpsLayoutPlugin as sender too
+        if kwargs['action'] in ['post_add', 'post_remove', 'post_clear']:
+            if isinstance(instance, BiogpsGenereportLayout):
+                layout_ids = [instance.id]
+            else:
+                layout_ids = kwargs['pk_set'] or []
+    elif sender is BiogpsGenereportLayout:
+        layout_ids = [instance.id]
+    elif sender is BiogpsLayoutPlugin:
+        layout_ids = [instance.layout_id]
+    elif sender is BiogpsPlugin:
+        bump_cache_version(LAYOUT_PLUGIN_VERSION_KEY)
+    elif sender is BiogpsPermission:
+        if instance.object_type == BiogpsGenereportLayout.object_type:
+            layout_ids = [instance.object_id]
+    elif sender is TaggedItem:
+        if instance.content_type_id == ContentType.objects.get_for_model(BiogpsGenereportLayout).id:
+            layout_ids = [instance.object_id]
+    for layout_id in layout_ids:
+        bump_cache_version(_layout_version_key(layout_id))
+
+for _sender in (BiogpsGenereportLayout, BiogpsLayoutPlugin, BiogpsPlugin, BiogpsPermission, TaggedItem):
+    models.signals.post_save.connect(invalidate_layout_cache, _sender,
+                                     dispatch_uid='{}_invalidate_layout_cache'.format(_sender.__name__))
+    models.signals.post_delete.connect(invalidate_layout_cache, _sender,
+                                       dispatch_uid='{}_invalidate_layout_cache_on_delete'.format(_sender.__name__))
+models.signals.m2m_changed.connect(invalidate_layout_cache, BiogpsGenereportLayout.plugins.through,
+                                   dispatch_uid='BiogpsLayoutPlugin_invalidate_layout_cache_on_m2m')
+permission_changed.connect(invalidate_layout_cache, BiogpsGenereportLayout,
+                           dispatch_uid='BiogpsGenereportLayout_invalidate_layout_cache_on_permission')
@@ -2,6 +2,7 @@ from django.test import Client
 from biogps.test.utils import (nottest, get_user_context,  _d, _e,
                                ok_, eq_,ext_ok, ext_fail)
 from biogps.layout.models import BiogpsGenereportLayout
+from biogps.plugin.models import BiogpsPlugin
 
 _test_layout_data = '''
     [{"width": 969, "useroptions": null, "top": 872, "left": 10, "id": 7, "height": 329},
@@ -153,3 +154,334 @@ def test_layout_delete():
     ext_ok(res)
 
     _cleanup_test_layout()
+
+
+def test_layout_renderurl_batch():
+    #/layout/renderurl/
+    c = Client()
+    res = c.get('/layout/renderurl/', dict(layoutid=83, geneid='1017,12566,x!,0'))
+    eq_(res.status_code, 200)
+    d = _d(res.content)
+    eq_(d['layout_id'], 83)
+    eq_(d['geneids'], ['1017', '12566', 'x!', '0'])
+    eq_(len(d['urls']), len(d['plugins']))
+    for row in d['urls']:
+        eq_(len(row), 4)
+        eq_(row[2], {'url': None, 'error': 'Invalid gene id.'})
+        ok_(row[3]['url'] is None)
+    ok_(d['urls'][0][0]['url'])
+
+    res = c.get('/layout/renderurl/', dict(pluginid='9,10', geneid='1017'))
+    d = _d(res.content)
+    eq_([p['id'] for p in d['plugins']], [9, 10])
+
+    res = c.get('/layout/renderurl/', dict(layoutid=83))
+    ext_fail(res)
+    res = c.get('/layout/renderurl/', dict(layoutid=83, geneid=','.join(['1017'] * 101)))
+    ext_fail(res)
+
+
+@nottest
+def _count_queries(fn, *args, **kwargs):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    with CaptureQueriesContext(connection) as ctx:
+        fn(*args, **kwargs)
+    return len(ctx.captured_queries)
+
+
+def test_layout_query_count():
+    #the number of queries should not grow with the number of plugins or layouts
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from biogps.layout.views import get_plugin_urls, layout_tree
+
+    new_layout_id = _create_test_layout()
+    layout = BiogpsGenereportLayout.objects.get(id=new_layout_id)
+    user = User.objects.get(username='cwudemo')
+    node = '/mylayout/layout_{}'.format(new_layout_id)
+
+    #layout_tree is not routed, call the view directly
+    def _tree(node):
+        request = APIRequestFactory().post('/layout/tree/', dict(node=node))
+        force_authenticate(request, user=user)
+        return layout_tree(request).render()
+
+    cnt_urls = _count_queries(get_plugin_urls, user, new_layout_id, '1017')
+    cnt_tree = _count_queries(_tree, node)
+    cnt_mylayout = _count_queries(_tree, '/mylayout')
+
+    layout.layout_data = _test_layout['layout_data'][:1]
+    eq_(_count_queries(get_plugin_urls, user, new_layout_id, '1017'), cnt_urls)
+    eq_(_count_queries(_tree, node), cnt_tree)
+
+    layout_2 = BiogpsGenereportLayout(layout_name=_test_layout['layout_name'],
+                                      ownerprofile=user.profile)
+    layout_2.save()
+    layout_2.share_to_public()
+    eq_(_count_queries(_tree, '/mylayout'), cnt_mylayout)
+
+    res = _tree(node)
+    d = _d(res.content)
+    eq_(len(d), 1)
+    eq_(d[0]['plugindata']['id'], 7)
+
+    _cleanup_test_layout()
+
+
+def test_layout_cache():
+    from biogps.layout.models import get_cached_layouts, serialize_layouts
+
+    new_layout_id = _create_test_layout()
+    layout = BiogpsGenereportLayout.objects.get(id=new_layout_id)
+
+    d = get_cached_layouts([new_layout_id], loadplugin=True)
+    eq_(d, serialize_layouts([new_layout_id], loadplugin=True))
+    eq_(len(d[0][1]['fields']['layout_data']), 4)
+    ok_(d[0][1]['fields']['author'])
+    #served from cache now
+    eq_(_count_queries(get_cached_layouts, [new_layout_id], loadplugin=True), 0)
+    eq_(get_cached_layouts([new_layout_id], loadplugin=True), d)
+
+    #invalidated by layout changes
+    layout.description = 'test description_2'
+    layout.save()
+    eq_(get_cached_layouts([new_layout_id])[0][1]['fields']['description'], 'test description_2')
+    layout.layout_data = _test_layout['layout_data'][:1]
+    eq_(len(get_cached_layouts([new_layout_id])[0][1]['fields']['layout_data']), 1)
+    layout.share_to_public()
+    eq_(get_cached_layouts([new_layout_id]), serialize_layouts([new_layout_id]))
+
+    #and by plugin changes
+    plugin = layout.plugins.all()[0]
+    plugin.save()
+    eq_(get_cached_layouts([new_layout_id], loadplugin=True)[0][1]['fields']['layout_data'][0]['lastmodified'],
+        serialize_layouts([new_layout_id], loadplugin=True)[0][1]['fields']['layout_data'][0]['lastmodified'])
+
+    #the same from /layout/<id>/ service
+    c = Client()
+    res = c.get('/layout/{}/'.format(new_layout_id))
+    d = _d(res.content)
+    eq_(d['totalCount'], 1)
+    eq_(d['items'][0]['fields']['is_shared'], True)
+    eq_(d['items'][0]['fields']['description'], 'test description_2')
+
+    #and by clearing its plugins (m2m_changed sent by BiogpsLayoutPlugin)
+    layout.plugins.clear()
+    eq_(get_cached_layouts([new_layout_id])[0][1]['fields']['layout_data'], [])
+
+    #an evicted version is never reused
+    from django.core.cache import cache
+    from biogps.layout.models import _layout_cache_keys, _layout_version_key
+    key_d = _layout_cache_keys([new_layout_id])
+    eq_(_layout_cache_keys([new_layout_id]), key_d)
+    cache.delete(_layout_version_key(new_layout_id))
+    ok_(_layout_cache_keys([new_layout_id])[new_layout_id] != key_d[new_layout_id])
+
+    _cleanup_test_layout()
+    eq_(get_cached_layouts([new_layout_id]), [])
+
+
+def test_layout_save_layout_data():
+    new_layout_id = _create_test_layout()
+    layout = BiogpsGenereportLayout.objects.get(id=new_layout_id)
+    layout_data = _test_layout['layout_data']
+    _key = lambda d: (d['top'], d['left'])
+    eq_(sorted(layout.layout_data, key=_key), sorted(layout_data, key=_key))
+    row_ids = sorted(layout.biogpslayoutplugin_set.values_list('id', flat=True))
+
+    #nothing changed, no write
+    cnt_nochange = _count_queries(setattr, layout, 'layout_data', layout_data)
+    eq_(sorted(layout.biogpslayoutplugin_set.values_list('id', flat=True)), row_ids)
+
+    #move all plugins, existing rows are updated in place with one query
+    moved_data = [dict(d, top=d['top'] + 10) for d in layout_data]
+    eq_(_count_queries(setattr, layout, 'layout_data', moved_data), cnt_nochange + 1)
+    eq_(sorted(layout.layout_data, key=_key), sorted(moved_data, key=_key))
+    eq_(sorted(layout.biogpslayoutplugin_set.values_list('id', flat=True)), row_ids)
+
+    #remove one, add one
+    new_data = moved_data[1:] + [{'id': 71, 'left': -1, 'top': 503, 'height': None, 'width': 350}]
+    layout.layout_data = new_data
+    d = layout.layout_data
+    eq_(len(d), 4)
+    eq_(set([x['id'] for x in d]), set([9, 10, 73, 71]))
+    eq_([x for x in d if x['id'] == 71][0]['left'], 0)
+    eq_([x for x in d if x['id'] == 71][0]['height'], None)
+
+    #unknown plugin leaves layout_data untouched
+    try:
+        layout.layout_data = new_data + [{'id': 0}]
+        ok_(False, 'DoesNotExist not raised')
+    except BiogpsPlugin.DoesNotExist:
+        pass
+    eq_(layout.layout_data, d)
+
+    layout.layout_data = []
+    eq_(layout.layout_data, [])
+
+    _cleanup_test_layout()
+
+
+def test_layout_patch():
+    import json
+    new_layout_id = _create_test_layout()
+    layout = BiogpsGenereportLayout.objects.get(id=new_layout_id)
+    url = '/layout/{}/'.format(new_layout_id)
+    c = get_user_context()
+
+    def _patch(**data):
+        return c.patch(url, json.dumps(data), content_type='application/json')
+
+    res = _patch(update=[{'id': 9, 'top': 50, 'left': -1}], remove=[7],
+                 add=[{'id': 71, 'top': 1700, 'left': 10, 'height': 300, 'width': 400}],
+                 lastmodified=layout.lastmodified.isoformat())
+    ext_ok(res)
+    lastmodified = _d(res.content)['lastmodified']
+    d = dict([(x['id'], x) for x in BiogpsGenereportLayout.objects.get(id=new_layout_id).layout_data])
+    eq_(sorted(d.keys()), [9, 10, 71, 73])
+    eq_((d[9]['top'], d[9]['left'], d[9]['height']), (50, 0, 829))
+    eq_((d[71]['top'], d[71]['height']), (1700, 300))
+
+    #a stale token is rejected and nothing changed
+    res = _patch(remove=[9], lastmodified=layout.lastmodified.isoformat())
+    eq_(res.status_code, 409)
+    eq_(_d(res.content)['lastmodified'], lastmodified)
+    eq_(len(BiogpsGenereportLayout.objects.get(id=new_layout_id).layout_data), 4)
+
+    #changes are all or nothing
+    ext_fail(_patch(remove=[9], update=[{'id': 7, 'top': 0}], lastmodified=lastmodified))
+    ext_fail(_patch(remove=[9], add=[{'id': 0}], lastmodified=lastmodified))
+    ext_fail(_patch(remove=[9]))
+    eq_(len(BiogpsGenereportLayout.objects.get(id=new_layout_id).layout_data), 4)
+
+    ext_ok(_patch(remove=[9], lastmodified=lastmodified))
+
+    _cleanup_test_layout()
+
+
+def test_layout_default_bundle():
+    import gzip
+    from biogps.auth2.models import DEFAULT_UIPROFILE
+    from biogps.layout.bundle import get_default_bundle
+
+    c = Client()
+    res = c.get('/layout/default/')
+    eq_(res.status_code, 200)
+    d = _d(res.content)
+    eq_(d['defaultlayout'], DEFAULT_UIPROFILE['defaultlayout'])
+    eq_([x['pk'] for x in d['layouts']['items']],
+        [x['pk'] for x in _d(c.get('/layout/{}/'.format(','.join([str(x) for x in DEFAULT_UIPROFILE['sharedlayouts']])),
+                                   dict(loadplugin=1)).content)['items']])
+    ok_('title' in d['layouts']['items'][0]['fields']['layout_data'][0])
+    etag = res['ETag']
+
+    res = c.get('/layout/default/', HTTP_ACCEPT_ENCODING='gzip')
+    eq_(res['Content-Encoding'], 'gzip')
+    eq_(_d(gzip.decompress(res.content)), d)
+    eq_(res['ETag'], etag)
+    eq_(c.get('/layout/default/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    #re-built when any default layout is changed
+    layout = BiogpsGenereportLayout.objects.get(id=DEFAULT_UIPROFILE['defaultlayout'])
+    layout.save()
+    ok_(c.get('/layout/default/')['ETag'] != etag)
+    eq_(c.get('/layout/default/')['ETag'], '"{}"'.format(get_default_bundle()[0]))
+
+
+def test_layout_serialize_objects():
+    import json
+    from rest_framework.renderers import JSONRenderer
+    from biogps.utils.jsonserializer import Serializer as JSONSerializer, serialize_objects
+
+    new_layout_id = _create_test_layout()
+    layout = BiogpsGenereportLayout.objects.get(id=new_layout_id)
+    layout.share_to_public()
+    layout.tags = 'nosetest_tag_2 nosetest_tag_1'
+    ids = list(BiogpsGenereportLayout.objects.exclude(id=new_layout_id).values_list('id', flat=True)[:10]) + [new_layout_id]
+
+    def _layouts():
+        layout_li = list(BiogpsGenereportLayout.objects.filter(id__in=ids))
+        for layout in layout_li:
+            layout.loadplugin = True
+        return layout_li
+
+    try:
+        #rendered the same as the items from JSONSerializer, including
+        #datetimes in layout_data
+        extra_itemfields = ['layout_data']
+        expected = json.loads(JSONSerializer().serialize(_layouts(), extra_itemfields=extra_itemfields))['items']
+        items = serialize_objects(_layouts(), extra_itemfields=extra_itemfields)
+        eq_(JSONRenderer().render(items), JSONRenderer().render(expected))
+        item = [x for x in items if x['pk'] == new_layout_id][0]
+        eq_(item['fields']['tags'], 'nosetest_tag_1 nosetest_tag_2')
+        eq_(item['fields']['permission'], {'R': ['BioGPS Users']})
+
+        #permissions and tags are loaded in bulk
+        serialize_objects(_layouts()[:1])
+        layout_li = _layouts()
+        eq_(_count_queries(serialize_objects, layout_li[:1]), _count_queries(serialize_objects, layout_li))
+    finally:
+        layout.tags = ''
+        _cleanup_test_layout()
+
+
+@nottest
+def benchmark_layout_serialization(n_layouts=500, repeat=10):
+    '''compare the layout list payload built by JSONSerializer (serialize,
+       json.loads, and encode again by Response) against serialize_objects,
+       for n_layouts layouts of four plugins each. Run it against a test
+       database, as all layouts created are removed afterward.
+    '''
+    import json
+    import time
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.contrib.auth.models import User
+    from rest_framework.renderers import JSONRenderer
+    from biogps.layout.models import BiogpsLayoutPlugin
+    from biogps.utils.jsonserializer import Serializer as JSONSerializer, serialize_objects
+
+    owner = User.objects.get(username='cwudemo')
+    mgr = BiogpsGenereportLayout.objects
+    mgr.bulk_create([BiogpsGenereportLayout(layout_name='benchmark_serialize_%d' % i, ownerprofile=owner.profile,
+                                            description='benchmark layout %d' % i)
+                     for i in range(n_layouts)])
+    ids = list(mgr.filter(layout_name__startswith='benchmark_serialize_').values_list('id', flat=True))
+    BiogpsLayoutPlugin.objects.bulk_create([BiogpsLayoutPlugin(layout_id=layout_id, plugin_id=d['id'], height=d['height'],
+                                                               width=d['width'], left=d['left'], top=d['top'])
+                                            for layout_id in ids for d in _test_layout['layout_data']])
+    for layout in mgr.filter(id__in=ids[:n_layouts // 2]):
+        layout.share_to_public()
+
+    extra_itemfields = ['author', 'is_shared', 'layout_data']
+
+    def _layouts():
+        layout_li = list(mgr.filter(id__in=ids))
+        for layout in layout_li:
+            layout.author = 'benchmark'
+            layout.is_shared = False
+        return layout_li
+
+    def _old(layout_li):
+        data = JSONSerializer().serialize(layout_li, extra_fields={'totalCount': len(layout_li)}, extra_itemfields=extra_itemfields)
+        return JSONRenderer().render(json.loads(data))
+
+    def _new(layout_li):
+        data = {'totalCount': len(layout_li),
+                'items': serialize_objects(layout_li, extra_itemfields=extra_itemfields)}
+        return JSONRenderer().render(data)
+
+    try:
+        eq_(json.loads(_old(_layouts()).decode('utf-8')), json.loads(_new(_layouts()).decode('utf-8')))
+        for name, fn in [('JSONSerializer', _old), ('serialize_objects', _new)]:
+            t = 0
+            for i in range(repeat):
+                layout_li = _layouts()
+                t0 = time.time()
+                with CaptureQueriesContext(connection) as ctx:
+                    fn(layout_li)
+                t += time.time() - t0
+            print('{:<18}  {:.1f} ms, {} queries'.format(name + ':', t / repeat * 1000, len(ctx.captured_queries)))
+    finally:
+        mgr.filter(id__in=ids).delete()
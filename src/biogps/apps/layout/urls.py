@@ -1,12 +1,13 @@
 from django.conf.urls import url
 
-from .views import LayoutViewSet, render_plugin_urls
+from .views import LayoutViewSet, render_plugin_urls, render_plugin_urls_batch, default_layout_bundle
 
 
 layout_save = LayoutViewSet.as_view({"post": "add_layout"})
 layout_view = LayoutViewSet.as_view({
     "get": "get_layout",
     "put": "update_layout",
+    "patch": "patch_layout",
     "delete": "delete_layout"
 })
 layoutlist_all = LayoutViewSet.as_view({
@@ -22,4 +23,6 @@ urlpatterns = [
     url(r'^list/$', layoutlist_view),
     url(r'^all/$', layoutlist_all),
     url(r'^(?P<layoutid>\d+)/renderurl/$', render_plugin_urls),
+    url(r'^renderurl/$', render_plugin_urls_batch),
+    url(r'^default/$', default_layout_bundle),
 ]
@@ -1,21 +1,29 @@
+import gzip
 import json
+from django.db import transaction
 from django.db.models import Q
 # from django.core.serializers import serialize, get_serializer_formats
 from django.utils.encoding import smart_text, smart_str
 from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
 
 from rest_framework.decorators import api_view
 from rest_framework import viewsets
 from rest_framework.response import Response
 
-from biogps.apps.layout.models import BiogpsGenereportLayout
+from biogps.apps.layout.models import BiogpsGenereportLayout, BiogpsLayoutPlugin, get_cached_layouts
+from biogps.apps.auth2.models import format_valid_name, get_owner_names
 from biogps.apps.plugin.models import BiogpsPlugin
 
 from biogps.utils import log, is_valid_geneid, formatDateTime, setObjectPermission, cvtPermission
 from biogps.utils.http import APIError, JSONResponse
-from biogps.utils.jsonserializer import Serializer as JSONSerializer
-from biogps.apps.plugin.models import PluginUrlRenderError
+from biogps.utils.jsonserializer import serialize_objects
+from biogps.utils.const import MAX_RENDERURL_GENES, MIMETYPE
+from biogps.utils.decorators import ANONYMOUS_USER_ERROR
+from biogps.apps.plugin.models import (PluginUrlRenderError, get_plugins_gene_fields,
+                                       get_plugin_urls_by_geneid)
 from biogps.apps.gene.boe import MyGeneInfo
+from biogps.apps.layout.bundle import get_default_bundle
 
 
 class LayoutViewSet(viewsets.ViewSet):
@@ -40,28 +48,25 @@ class LayoutViewSet(viewsets.ViewSet):
             except ValueError:
                 return APIError('Invalid input parameters!')
 
-            query_result = BiogpsGenereportLayout.objects.filter(pk__in=layout_id)
-
             loadplugin = (request.query_params.get('loadplugin', '').lower() in ['1', 'true'])
 
-            for layout in query_result:
-                layout.author = layout.owner.get_valid_name()
-                layout.is_shared = (layout.owner != request.user)
-                layout.loadplugin = loadplugin
-            extra_itemfields = ['author', 'is_shared', 'layout_data']
-            query_total_cnt = query_result.count()
+            #serialized layouts are served from cache, see layout/models.py
+            query_result = get_cached_layouts(layout_id, loadplugin=loadplugin)
+            for owner_id, item in query_result:
+                item['fields']['is_shared'] = (owner_id != request.user.id)
+            query_total_cnt = len(query_result)
 
             #logging layout access
             log.info('username=%s clientip=%s action=layout_query id=%s',
                      getattr(request.user, 'username', ''),
                      request.META.get('REMOTE_ADDR', ''),
-                     ','.join([str(layout.id) for layout in query_result]))
+                     ','.join([str(item['pk']) for owner_id, item in query_result]))
 
         else:
             return APIError('Missing required parameter.')
 
-        data = JSONSerializer().serialize(query_result, extra_fields={'totalCount': query_total_cnt}, extra_itemfields=extra_itemfields)
-        data = json.loads(data)
+        data = {'totalCount': query_total_cnt,
+                'items': [item for owner_id, item in query_result]}
         return Response(data)
         # format = request.GET.get('format', 'json')
         # if format not in get_serializer_formats():
@@ -80,6 +85,9 @@ class LayoutViewSet(viewsets.ViewSet):
     def delete_layout(self, request, layout_id):
         return _layout_delete(request)
 
+    def patch_layout(self, request, query):
+        return _layout_patch(request, query)
+
     def get_my_layoutlist(self, request):
         """
         A simplified and much faster handler for layoutlist/all/ service.
@@ -87,9 +95,8 @@ class LayoutViewSet(viewsets.ViewSet):
         URL: /layout/all/
         """
         user = request.user
-        layout_qs = BiogpsGenereportLayout.objects.get_available(user, excludemine=True)
-        layout_qs = layout_qs.order_by('-lastmodified')
-        layout_list = list(layout_qs.values('pk', 'layout_name'))
+        layout_list = BiogpsGenereportLayout.objects.get_shared_listing(user, ['pk', 'layout_name', 'lastmodified'],
+                                                                        ['-lastmodified'])
         for i, layout in enumerate(layout_list):
             layout = {'pk': layout['pk'],
                       'fields': {'layout_name': layout['layout_name'],
@@ -197,13 +204,15 @@ class LayoutViewSet(viewsets.ViewSet):
         else:
             return APIError('Missing required parameter.')
 
+        query_result = list(query_result)
+        owner_d = get_owner_names(set([layout.ownerprofile_id for layout in query_result]))
         for layout in query_result:
-            layout.author = layout.owner.get_valid_name()
-            layout.is_shared = (layout.owner != request.user)
+            owner_id, layout.author = owner_d[layout.ownerprofile_id][:2]
+            layout.is_shared = (owner_id != request.user.id)
         extra_itemfields = ['author', 'is_shared', 'layout_data']
 
-        data = JSONSerializer().serialize(query_result, extra_fields={'totalCount': query_total_cnt}, extra_itemfields=extra_itemfields)
-        data = json.loads(data)
+        data = {'totalCount': query_total_cnt,
+                'items': serialize_objects(query_result, extra_itemfields=extra_itemfields)}
         return Response(data)
         # format = request.GET.get('format', 'json')
         # if format not in get_serializer_formats():
@@ -241,12 +250,49 @@ def getall(user, userselectedonly=False):
     return query_result
 
 
-def getplugin(pid):
-    plugin = {'id': pid}
-    p = BiogpsPlugin.objects.get(pk=pid)
-    for attr in ('title', 'url', 'type', 'author', 'description', 'lastmodified', 'options', 'created'):
-        plugin[attr] = smart_str(getattr(p, attr))
-    return plugin
+def get_layout_plugins(layout_id):
+    """return layout_data of given layout with the details of each plugin,
+       all from one query.
+    """
+    plugin_attrs = ('title', 'url', 'type', 'author', 'description', 'lastmodified', 'options', 'created')
+    fields = ['plugin_id', 'height', 'width', 'left', 'top', 'useroptions'] + ['plugin__' + attr for attr in plugin_attrs]
+    layout_data = []
+    for d in BiogpsLayoutPlugin.objects.filter(layout_id=layout_id).order_by('top', 'left').values(*fields):
+        p = dict(id=d['plugin_id'], height=d['height'], width=d['width'],
+                 left=d['left'], top=d['top'], useroptions=d['useroptions'])
+        for attr in plugin_attrs:
+            p[attr] = smart_str(d['plugin__' + attr])
+        layout_data.append(p)
+    return layout_data
+
+
+def _layout_tree_nodes(query_result, scope):
+    """return the tree nodes of given layouts for layout_tree. The authors
+       and permissions of all layouts are fetched in two queries.
+    """
+    layout_li = list(query_result.values('id', 'layout_name', 'description', 'lastmodified', 'created',
+                                         'ownerprofile__user__username',
+                                         'ownerprofile__user__first_name',
+                                         'ownerprofile__user__last_name'))
+    perm_d = BiogpsGenereportLayout.objects.get_permissions([_layout['id'] for _layout in layout_li])
+    children = []
+    for _layout in layout_li:
+        child = dict(text=_layout['layout_name'],
+                     id='/{}layout/layout_{}'.format(scope, _layout['id']),
+                     cls='folder',
+                     layout_id=_layout['id'],
+                     layout_name=_layout['layout_name'],
+                     author=format_valid_name(_layout['ownerprofile__user__first_name'],
+                                              _layout['ownerprofile__user__last_name'],
+                                              _layout['ownerprofile__user__username']),
+                     description=_layout['description'],
+                     rolepermission=cvtPermission(perm_d.get(_layout['id'], [])).get('R', None),
+                     lastmodified=formatDateTime(_layout['lastmodified']),
+                     created=formatDateTime(_layout['created']),
+                     layout_scope=scope,
+                     )
+        children.append(child)
+    return children
 
 
 def _layout_name_exists(layout_name, user):
@@ -321,6 +367,55 @@ def _layout_update(request):
     return Response(data)
 
 
+def _layout_patch(request, layout_id):
+    """apply only changed plugins to a layout's layout_data, instead of
+       posting the entire layout_data. Accepts:
+         lastmodified: the layout's lastmodified as last loaded, required.
+         add:    a list of new plugins, e.g. [{"id": 10, "top": 28, "left": 10, "height": 435, "width": 838}]
+         update: a list of moved/resized plugins, e.g. [{"id": 10, "top": 50}]
+         remove: a list of plugin ids, e.g. [9]
+       "add", "update" and "remove" can also be passed as json strings.
+       If the layout has been modified since "lastmodified", nothing is
+       changed and an error is returned with status 409, along with the
+       current "lastmodified". Otherwise, the new "lastmodified" is returned.
+    """
+    if request.user.is_anonymous():
+        return APIError(ANONYMOUS_USER_ERROR, status=403)
+    token = request.data.get('lastmodified', None)
+    if not token:
+        return APIError('Missing required parameter.')
+
+    changes = {}
+    try:
+        for k in ['add', 'update', 'remove']:
+            v = request.data.get(k, None) or []
+            changes[k] = json.loads(v) if isinstance(v, str) else v
+    except ValueError:
+        return APIError('Passed "{}" is not a valid json string.'.format(k))
+
+    with transaction.atomic():
+        try:
+            layout = request.user.mylayouts.select_for_update().get(id=layout_id)
+        except BiogpsGenereportLayout.DoesNotExist:
+            return APIError("Layout does not exist.")
+        if layout.lastmodified.isoformat() != token:
+            return Response({'success': False,
+                             'error': 'Layout has been modified since it was loaded.',
+                             'lastmodified': layout.lastmodified.isoformat()}, status=409)
+        try:
+            layout.patch_layout_data(**changes)
+        except (BiogpsPlugin.DoesNotExist, BiogpsLayoutPlugin.DoesNotExist,
+                KeyError, TypeError, ValueError):
+            return APIError('Invalid input parameters!')
+
+    log.info('username=%s clientip=%s action=layout_patch id=%s',
+             getattr(request.user, 'username', ''),
+             request.META.get('REMOTE_ADDR', ''),
+             layout.id)
+    return Response({'success': True,
+                     'lastmodified': layout.lastmodified.isoformat()})
+
+
 def _layout_delete(request):
     layout_id = request.POST['layout_id']
     try:
@@ -357,48 +452,15 @@ def layout_tree(request):
                     dict(text='Shared Layouts', id='/sharedlayout', cls='folder')]
     elif node.split('/') == ['', 'mylayout']:
         #query_result = getall(request.adamuser)
-        query_result = get_my_layouts(request.user)
-        for _layout in query_result:
-            child = dict(text=_layout.layout_name,
-                         id='/mylayout/layout_' + str(_layout.id),
-                         cls='folder',
-                         layout_id=_layout.id,
-                         layout_name=_layout.layout_name,
-                         author=_layout.owner.get_valid_name(),
-                         description=_layout.description,
-                         rolepermission=cvtPermission(_layout.permission).get('R', None),
-                         lastmodified=formatDateTime(_layout.lastmodified),
-                         created=formatDateTime(_layout.created),
-                         layout_scope='my',
-                         #permission=_layout.permission,
-                         )
-            children.append(child)
+        children = _layout_tree_nodes(get_my_layouts(request.user), 'my')
     elif node.split('/') == ['', 'sharedlayout']:
-        query_result = get_shared_layouts(request.user, userselectedonly=True)
-        for _layout in query_result:
-            child = dict(text=_layout.layout_name,
-                         id='/sharedlayout/layout_' + str(_layout.id),
-                         cls='folder',
-                         layout_id=_layout.id,
-                         layout_name=_layout.layout_name,
-                         author=_layout.owner.get_valid_name(),
-                         description=_layout.description,
-                         rolepermission=cvtPermission(_layout.permission).get('R', None),
-                         lastmodified=formatDateTime(_layout.lastmodified),
-                         created=formatDateTime(_layout.created),
-                         layout_scope='shared',
-                         #permission=_layout.permission,
-                         )
-            children.append(child)
+        children = _layout_tree_nodes(get_shared_layouts(request.user, userselectedonly=True), 'shared')
 
     elif len(node.split('/')) == 3:
         root, parent, _node = node.split('/')
         if root == '' and parent in ['mylayout', 'sharedlayout'] and _node.split('/')[-1].startswith('layout_'):
             layout_id = _node[len('layout_'):]
-            _layout = BiogpsGenereportLayout.objects.get(id=layout_id)
-            #layout_data = json.loads(_layout.layout_data)
-            for i, p in enumerate(_layout.layout_data):
-                p.update(getplugin(p['id']))
+            for i, p in enumerate(get_layout_plugins(layout_id)):
                 child = dict(text=p['title'],
                              id='/'.join([root, parent, layout_id, 'plugin_' + str(i) + '_' + str(p['id'])]),
                              leaf=True,
@@ -415,6 +477,27 @@ def layout_tree(request):
     return Response(children)
 
 
+@api_view(["GET"])
+def default_layout_bundle(request):
+    '''
+    Return the default layouts for anonymous visitors with all their plugin
+    details in one (gzipped) response, see layout/bundle.py.
+    URL:  http://biogps.org/layout/default/
+    '''
+    etag, data = get_default_bundle()
+    etag = '"{}"'.format(etag)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponse(status=304)
+    elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(data, content_type=MIMETYPE['json'])
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(data), content_type=MIMETYPE['json'])
+    response['ETag'] = etag
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
 @api_view(["GET"])
 def render_plugin_urls(request, layoutid):
     '''
@@ -448,43 +531,116 @@ def get_plugin_urls(user, layoutid, geneid, speciesid=None, mobile=False):
         return APIError('Invalid input parameters!')
 
     available_layouts = get_my_layouts(user) | get_shared_layouts(user)
-
-    try:
-        layout = available_layouts.get(id=layoutid)
-    except BiogpsGenereportLayout.DoesNotExist:
+    layout_output = [{'id': lay['id'], 'title': lay['layout_name']}
+                     for lay in available_layouts.order_by('layout_name').values('id', 'layout_name')]
+
+    layout = None
+    for lay in layout_output:
+        if str(lay['id']) == str(layoutid):
+            layout = lay
+            break
+    if layout is None:
         return APIError("Layout does not exist or not belong to you.")
 
-    mg = MyGeneInfo()
-    g = mg.get_geneidentifiers(geneid)
-
-    if not g or len(g['SpeciesList']) == 0:
+    plugin_li = list(BiogpsPlugin.objects.filter(biogpslayoutplugin__layout_id=layout['id']).order_by('title'))
+    res_li = get_plugin_urls_by_geneid(plugin_li, geneid, MyGeneInfo().get_geneidentifiers, mobile=mobile)
+    if res_li is None:
         return APIError('Unknown gene id.')
 
     plugin_output = []
-    for plugin in layout.plugins.order_by('title'):
-        try:
-            url = plugin.geturl(g, mobile=mobile)
-            errmsg = None
-        except PluginUrlRenderError as err:
-            url = None
-            errmsg = err.args[0]
+    for plugin, res in zip(plugin_li, res_li):
         d = {'id': plugin.id,
              'title': plugin.title,
-             'url': url}
-        if errmsg:
-            d['error'] = errmsg
+             'url': res.get('url')}
+        if 'error' in res:
+            d['error'] = res['error']
         plugin_output.append(d)
 
-    layout_output = []
-    for lay in available_layouts.order_by('layout_name'):
-        d = {'id': lay.id,
-             'title': lay.layout_name}
-        layout_output.append(d)
-
     data = {'success': True,
-            'layout_id': layout.id,
-            'layout_name': layout.layout_name,
+            'layout_id': layout['id'],
+            'layout_name': layout['title'],
             'geneid': geneid,
             'plugins': plugin_output,
             'layouts': layout_output}
     return data
+
+
+def _render_plugin_url(plugin, gene, mobile=False):
+    '''return {"url": <rendered url>}, or {"url": None, "error": <errmsg>}
+       if plugin's url cannot be rendered for given gene.
+    '''
+    try:
+        return {'url': plugin.geturl(gene, mobile=mobile)}
+    except PluginUrlRenderError as err:
+        return {'url': None, 'error': err.args[0]}
+
+
+@api_view(["GET", "POST"])
+def render_plugin_urls_batch(request):
+    '''
+    Render the urls of a layout's plugins (or a list of plugins) for a list
+    of genes in one request.
+    URL:  http://biogps.org/layout/renderurl/?layoutid=159&geneid=1017,1018
+          http://biogps.org/layout/renderurl/?pluginid=9,10&geneid=1017,1018&mobile=1
+    "urls" in returned data is a matrix of plugins x genes, where any url
+    cannot be rendered (or an unknown gene) is returned as a cell with "url"
+    as None and an "error" message.
+    '''
+    params = request.query_params if request.method == 'GET' else request.data
+    geneid_li = [x.strip() for x in params.get('geneid', '').split(',') if x.strip()]
+    layoutid = params.get('layoutid', '').strip()
+    pluginid_li = [x.strip() for x in params.get('pluginid', '').split(',') if x.strip()]
+    mobile = params.get('mobile', '').lower() in ['1', 'true']
+
+    if not geneid_li or not (layoutid or pluginid_li):
+        return APIError('Missing required parameter.')
+    if len(geneid_li) > MAX_RENDERURL_GENES:
+        return APIError('Too many genes, up to {} genes are allowed.'.format(MAX_RENDERURL_GENES))
+    if (layoutid and not layoutid.isdigit()) or not all([x.isdigit() for x in pluginid_li]):
+        return APIError('Invalid input parameters!')
+
+    if layoutid:
+        available_layouts = get_my_layouts(request.user) | get_shared_layouts(request.user)
+        try:
+            layout = available_layouts.get(id=layoutid)
+        except BiogpsGenereportLayout.DoesNotExist:
+            return APIError("Layout does not exist or not belong to you.")
+        plugin_li = list(layout.plugins.order_by('title'))
+    else:
+        layout = None
+        plugin_d = BiogpsPlugin.objects.get_available(request.user).in_bulk([int(x) for x in pluginid_li])
+        plugin_li = [plugin_d[int(x)] for x in pluginid_li if int(x) in plugin_d]
+
+    #all gene identifiers resolved in one batch
+    valid_geneid_li = [geneid for geneid in geneid_li if is_valid_geneid(geneid)]
+    mg = MyGeneInfo()
+    gene_d = dict(zip(valid_geneid_li, mg.get_geneidentifiers_batch(
+        valid_geneid_li, fields=get_plugins_gene_fields(plugin_li, mobile=mobile))))
+
+    url_matrix = []
+    for plugin in plugin_li:
+        row = []
+        for geneid in geneid_li:
+            g = gene_d.get(geneid, None)
+            if not is_valid_geneid(geneid):
+                row.append({'url': None, 'error': 'Invalid gene id.'})
+            elif not g or len(g['SpeciesList']) == 0:
+                row.append({'url': None, 'error': 'Unknown gene id.'})
+            else:
+                row.append(_render_plugin_url(plugin, g, mobile=mobile))
+        url_matrix.append(row)
+
+    data = {'success': True,
+            'geneids': geneid_li,
+            'plugins': [{'id': plugin.id, 'title': plugin.title} for plugin in plugin_li],
+            'urls': url_matrix}
+    if layout:
+        data['layout_id'] = layout.id
+        data['layout_name'] = layout.layout_name
+
+    #logging batch rendering
+    log.info('username=%s clientip=%s action=plugin_urls_batch layout=%s num_plugins=%s num_genes=%s',
+             getattr(request.user, 'username', ''),
+             request.META.get('REMOTE_ADDR', ''),
+             layoutid, len(plugin_li), len(geneid_li))
+    return JSONResponse(data)
@@ -1,6 +1,11 @@
 '''Models definition for BioGPS plugins.'''
 
 import re
+import hashlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from django_extensions.db.fields import AutoSlugField
 from django.template.defaultfilters import slugify
@@ -9,9 +14,11 @@ from django.contrib.sites.models import Site
 from tagging.registry import register
 
 from biogps.apps.auth2.models import UserProfile
+from biogps.utils import log
 from biogps.utils.models import BioGPSModel, Species
 from biogps.utils.fields.jsonfield import JSONField
 from biogps.apps.search.build_index import set_on_the_fly_indexing
+from biogps.apps.gene.boe import get_geneobj_fields
 
 from biogps.apps.plugin.fields import SpeciesField
 
@@ -150,11 +157,20 @@ class BiogpsPlugin(BioGPSModel):
     def getKeywords(self, url=None):
         url = url or self.url
         if url:
-            kwd_list = re.findall('(\{\{[\s\w|:.]+\}\})', url)
-            return kwd_list
+            return list(_get_url_template(self.id, self.lastmodified, url).keywords)
         else:
             return []
 
+    def get_url_template(self, mobile=False):
+        '''return the compiled PluginUrlTemplate of this plugin's url (or
+           its alt. mobile_url if mobile is True), cached per plugin revision.
+        '''
+        if mobile and self.options and self.options.get('mobile_url', None):
+            url = self.options['mobile_url']
+        else:
+            url = self.url
+        return _get_url_template(self.id, self.lastmodified, url or '')
+
     def geturl(self, gene, mobile=False):
         '''rendering actual url given input gene
            gene is a object returned by DataService.GetGeneIdentifiers
@@ -162,6 +178,22 @@ class BiogpsPlugin(BioGPSModel):
         '''
         return _plugin_geturl(self, gene, mobile=mobile)
 
+    def geturl_by_geneid(self, geneid, get_geneidentifiers, mobile=False):
+        '''same as geturl, but for given geneid, with the rendered url cached
+           by (plugin id, lastmodified, geneid, mobile), so that a repeat
+           call skips both get_geneidentifiers and rendering.
+           get_geneidentifiers is called on a cache miss only, e.g.
+           MyGeneInfo().get_geneidentifiers, as get_geneidentifiers(geneid,
+           fields) with only the gene fields used by this plugin's url.
+           Return None if geneid is unknown.
+        '''
+        res_li = get_plugin_urls_by_geneid([self], geneid, get_geneidentifiers, mobile=mobile)
+        if res_li is None:
+            return None
+        if 'error' in res_li[0]:
+            raise PluginUrlRenderError(res_li[0]['error'])
+        return res_li[0]['url']
+
     def update_options(self, **kwargs):
         _options = self.options or {}
         _options.update(kwargs)
@@ -240,75 +272,150 @@ class PluginUrlRenderError(Exception):
     pass
 
 
-def _get_value(kwd, gene,
-               idx_filter_separator='.',       # e.g., {{MGI.1}}
-               value_field_separator=':',      # e.g., "MGI:104772"
-               list_separator=','):            # if matching values are a list
+IDX_FILTER_SEPARATOR = '.'       # e.g., {{MGI.1}}
+VALUE_FIELD_SEPARATOR = ':'      # e.g., "MGI:104772"
+LIST_SEPARATOR = ','             # if matching values are a list
+
+
+def _parse_keyword(kwd):
+    '''parse one keyword (without {{ }}) into a tuple of (key, idx_filter).
+       key is None if the idx_filter is invalid, so it never matches.
+    '''
     k = kwd.strip().lower()
     _idx_filter = None
-    if len(k.split(idx_filter_separator)) == 2:
+    if len(k.split(IDX_FILTER_SEPARATOR)) == 2:
         #support for something like "{{MGI:2}}"
         #will take only "104772" part of "MGI:104772" value
-        k, _idx_filter = k.split(idx_filter_separator)
+        k, _idx_filter = k.split(IDX_FILTER_SEPARATOR)
         try:
             _idx_filter = int(_idx_filter)     # _idx_filter starts from 0
         except ValueError:
-            return None
+            return None, None
+    return k, _idx_filter
+
 
+def _lookup_value(k, _idx_filter, gene):
+    if k is None:
+        return None
     value = gene.get(k, None)
     if value:
         if isinstance(value, (list, tuple)):
             if _idx_filter:
                 try:
-                    value = [v.split(value_field_separator)[_idx_filter] for v in value]
+                    value = [v.split(VALUE_FIELD_SEPARATOR)[_idx_filter] for v in value]
                 except IndexError:
                     return None
-            value = list_separator.join(value)
+            value = LIST_SEPARATOR.join(value)
         else:
             if _idx_filter:
                 try:
-                    value = value.split(value_field_separator)[_idx_filter]
+                    value = value.split(VALUE_FIELD_SEPARATOR)[_idx_filter]
                 except IndexError:
                     return None
 
         return str(value)
 
 
+def _get_value(kwd, gene):
+    k, _idx_filter = _parse_keyword(kwd)
+    return _lookup_value(k, _idx_filter, gene)
+
+
+class PluginUrlTemplate(object):
+    '''A plugin url template compiled into a list of literal segments and
+       keyword slots, e.g. "http://www.google.com/search?q={{Symbol|MGI.1}}"
+       is compiled to:
+           ['http://www.google.com/search?q=',
+            ('{{Symbol|MGI.1}}', [('symbol', None), ('mgi', 1)])]
+       A slot can have alternative keywords ("kwd1|kwd2"), the first one
+       available in the gene is used.
+    '''
+    keyword_pattern = re.compile(r'(\{\{[\s\w|:.]+\}\})')
+
+    def __init__(self, url):
+        self.url = url
+        self.segments = []
+        self.keywords = []
+        self.keys = set()     # all gene attributes used, e.g. "symbol", "mgi"
+        pos = 0
+        for mat in self.keyword_pattern.finditer(url):
+            if mat.start() > pos:
+                self.segments.append(url[pos:mat.start()])
+            kwd = mat.group(1)
+            #kwd[2:-2] can be in the form of 'kwd1|kwd2". If kwd1 is not available, use kwd2 instead
+            alternatives = [_parse_keyword(k) for k in kwd[2:-2].split('|')]
+            self.segments.append((kwd, alternatives))
+            self.keywords.append(kwd)
+            self.keys.update([k for k, _idx_filter in alternatives if k is not None])
+            pos = mat.end()
+        if pos < len(url):
+            self.segments.append(url[pos:])
+
+    def render(self, gene):
+        '''render url in one pass for given gene, a gene object in the
+           output of get_geneidentifiers for one species.
+           return a tuple of (url, complete), where unresolved keywords are
+           left as is in url and complete is False.
+        '''
+        out = []
+        complete = True
+        for segment in self.segments:
+            if isinstance(segment, str):
+                out.append(segment)
+                continue
+            kwd, alternatives = segment
+            value = None
+            if gene:
+                for k, _idx_filter in alternatives:
+                    value = _lookup_value(k, _idx_filter, gene)
+                    if value:
+                        break
+            if value:
+                out.append(value)
+            else:
+                out.append(kwd)
+                complete = False
+        return ''.join(out), complete
+
+
+@lru_cache(maxsize=5000)
+def _get_url_template(plugin_id, lastmodified, url):
+    '''return the compiled PluginUrlTemplate, cached by (plugin_id,
+       lastmodified), together with url itself in case of unsaved changes.
+    '''
+    return PluginUrlTemplate(url)
+
+
+def get_plugins_gene_fields(plugin_li, mobile=False):
+    '''return the list of gene fields needed to render urls of given
+       plugins, to be passed as "fields" to MyGeneInfo.get_geneidentifiers.
+       Return None if full gene docs are needed.
+    '''
+    keys = set()
+    for plugin in plugin_li:
+        keys.update(plugin.get_url_template(mobile=mobile).keys)
+    return get_geneobj_fields(keys)
+
+
 def _plugin_geturl(plugin, gene, mobile=False):
     '''rendering plugin's actual url given input gene
        gene is a object returned by DataService.GetGeneIdentifiers
        if mobile is True and plugin has a "mobile_url" parameter in plugin.options,
        use alt. mobile_url instead.
     '''
-    if mobile and plugin.options and plugin.options.get('mobile_url', None):
-        _url = plugin.options['mobile_url']
-    else:
-        _url = plugin.url
-
-    kwd_list = plugin.getKeywords()
-    if len(kwd_list) > 0:
-        if gene:
-            allowedspecies = plugin.species
-            gene_species_list = gene['SpeciesList']
-            species = None
-            for s in allowedspecies:
-                if s in gene_species_list:
-                    species = s
-                    break
-
-            if species:
-                current_gene = gene[species][0]
-                if current_gene:
-                    for kwd in kwd_list:
-                        _kwd = kwd[2:-2]  # without {{ }}
-                        #_kwd can be in the form of 'kwd1|kwd2". If kwd1 is not available, use kwd2 instead
-                        for k in _kwd.split('|'):
-                            value = _get_value(k, current_gene)
-                            if value:
-                                _url = _url.replace(kwd, str(value))
-                                break
-
-    if len(plugin.getKeywords(_url)) > 0:
+    template = plugin.get_url_template(mobile=mobile)
+
+    current_gene = None
+    if template.keywords and gene:
+        allowedspecies = plugin.species
+        gene_species_list = gene['SpeciesList']
+        for s in allowedspecies:
+            if s in gene_species_list:
+                current_gene = gene[s][0]
+                break
+
+    _url, complete = template.render(current_gene)
+    if not complete:
         raise PluginUrlRenderError('Fail to render plugin url.\n"%s"' % _url)
     else:
         if mobile and _url.startswith('/'):
@@ -317,6 +424,84 @@ def _plugin_geturl(plugin, gene, mobile=False):
         return _url
 
 
+PLUGIN_URL_CACHE_TIMEOUT = getattr(settings, 'PLUGIN_URL_CACHE_TIMEOUT', settings.CACHE_DAY)
+
+
+def _plugin_url_version_key(plugin_id):
+    return 'plugin_url_version:{}'.format(plugin_id)
+
+
+def _plugin_url_cache_keys(plugin_li, geneid, mobile):
+    version_d = cache.get_many([_plugin_url_version_key(plugin.id) for plugin in plugin_li if plugin.id])
+    key_li = []
+    for plugin in plugin_li:
+        if plugin.id:
+            _plugin_key = '{}:{}:{}'.format(plugin.id, version_d.get(_plugin_url_version_key(plugin.id), 0),
+                                            plugin.lastmodified.isoformat() if plugin.lastmodified else '')
+        else:
+            #an unsaved plugin, e.g. in test_plugin_url view
+            _plugin_key = hashlib.md5('{}|{}|{}'.format(plugin.url, plugin.options, plugin.species).encode('utf-8')).hexdigest()
+        key_li.append('plugin_url:{}:{}:{}'.format(_plugin_key, geneid, int(bool(mobile))))
+    return key_li
+
+
+def get_plugin_urls_by_geneid(plugin_li, geneid, get_geneidentifiers, mobile=False):
+    '''return a list of {"url": <rendered url>} or {"error": <errmsg>}
+       for each of given plugins and geneid, or None if geneid is unknown.
+       Cached urls are fetched at once, and get_geneidentifiers is called
+       at most once, with the gene fields used by the plugins not cached
+       yet (or by none if plugin_li is empty, to check geneid only).
+    '''
+    try:
+        key_li = _plugin_url_cache_keys(plugin_li, geneid, mobile)
+        cached_d = cache.get_many(key_li)
+    except Exception as e:
+        log.warning('action=plugin_url_cache error="%s"', e)
+        key_li = None
+        cached_d = {}
+
+    res_li = [cached_d.get(key) for key in key_li] if key_li else [None] * len(plugin_li)
+    missing = [i for i, res in enumerate(res_li) if res is None]
+    if missing or not plugin_li:
+        #a url is only cached for a known geneid
+        g = get_geneidentifiers(geneid, get_plugins_gene_fields([plugin_li[i] for i in missing], mobile=mobile))
+        if not g or len(g['SpeciesList']) == 0:
+            return None
+        new_d = {}
+        for i in missing:
+            try:
+                res_li[i] = {'url': _plugin_geturl(plugin_li[i], g, mobile=mobile)}
+            except PluginUrlRenderError as err:
+                #rendering errors are deterministic as well
+                res_li[i] = {'error': err.args[0]}
+            if key_li:
+                new_d[key_li[i]] = res_li[i]
+        if new_d:
+            try:
+                cache.set_many(new_d, PLUGIN_URL_CACHE_TIMEOUT)
+            except Exception as e:
+                log.warning('action=plugin_url_cache error="%s"', e)
+    return res_li
+
+
+def invalidate_plugin_urls(sender, **kwargs):
+    '''Handle post-save for Plugin model.
+       Drops all cached rendered urls of given plugin, by bumping the
+       version included in their cache keys.
+    '''
+    key = _plugin_url_version_key(kwargs['instance'].id)
+    try:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+    except Exception as e:
+        log.warning('action=plugin_url_cache error="%s"', e)
+
+models.signals.post_save.connect(invalidate_plugin_urls, BiogpsPlugin,
+                                 dispatch_uid='BiogpsPlugin_invalidate_plugin_urls')
+
+
 class BiogpsPluginPopularity(models.Model):
     plugin = models.OneToOneField(BiogpsPlugin, related_name='popularity')
     score = models.FloatField()
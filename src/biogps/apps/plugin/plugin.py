@@ -132,6 +132,7 @@ def plugin(request, query=None):
             return HttpResponseBadRequest('Missing required parameter.')
 
         # Append extra attributes to each object, to be passed down in the JSON stream.
+        query_result = BiogpsPlugin.objects.prefetch_permissions(query_result)
         for p in query_result:
             p.author = p.owner.get_valid_name()        # although plugin object has author field, but here we get author name from user table on the fly
             p.author_url = p.owner.get_absolute_url()
@@ -1,6 +1,6 @@
 from django.test import Client
 from biogps.test.utils import (nottest, istest, get_user_context,
-                               eq_, _d, ext_ok, ext_fail)
+                               ok_, eq_, _d, ext_ok, ext_fail)
 from biogps.plugin.models import BiogpsPlugin
 
 
@@ -139,6 +139,61 @@ def test_plugin_delete():
     ext_ok(res)
 
 
+def test_plugin_url_template():
+    from biogps.plugin.models import PluginUrlRenderError, get_plugins_gene_fields
+    plugin = BiogpsPlugin(url='http://x.org/?q={{Symbol}}&id={{MGI.1|EntrezGene}}&s={{Symbol}}',
+                          species=['mouse', 'human'])
+    eq_(plugin.getKeywords(), ['{{Symbol}}', '{{MGI.1|EntrezGene}}', '{{Symbol}}'])
+    gene = {'SpeciesList': ['human', 'mouse'],
+            'human': [{'symbol': 'CDK2', 'entrezgene': '1017'}],
+            'mouse': [{'symbol': 'Cdk2', 'mgi': 'MGI:104772', 'entrezgene': '12566'}]}
+    eq_(plugin.geturl(gene), 'http://x.org/?q=Cdk2&id=104772&s=Cdk2')
+    # compiled once per plugin revision
+    ok_(plugin.get_url_template() is plugin.get_url_template())
+    eq_(get_plugins_gene_fields([plugin]), ['MGI', 'entrezgene', 'symbol'])
+    eq_(get_plugins_gene_fields([plugin, BiogpsPlugin(url='/?q={{unknown}}')]), None)
+
+    plugin.species = ['human']
+    eq_(plugin.geturl(gene), 'http://x.org/?q=CDK2&id=1017&s=CDK2')
+    del gene['human'][0]['entrezgene']
+    try:
+        plugin.geturl(gene)
+        ok_(False)
+    except PluginUrlRenderError as err:
+        ok_('{{MGI.1|EntrezGene}}' in str(err))
+
+
+def test_plugin_url_cache():
+    from biogps.plugin.models import invalidate_plugin_urls
+    calls = []
+    gene = {'SpeciesList': ['mouse'], 'mouse': [{'symbol': 'Cdk2'}]}
+
+    def get_geneidentifiers(geneid, fields=None):
+        calls.append(geneid)
+        eq_(fields, ['symbol'])
+        return gene if geneid == '12566' else None
+
+    plugin = BiogpsPlugin.objects.get(id=_create_test_plugin())
+    eq_(plugin.geturl_by_geneid('12566', get_geneidentifiers), 'http://www.google.com/search?q=Cdk2')
+    eq_(plugin.geturl_by_geneid('12566', get_geneidentifiers), 'http://www.google.com/search?q=Cdk2')
+    eq_(calls, ['12566'])
+    eq_(plugin.geturl_by_geneid('1', get_geneidentifiers), None)
+
+    # dropped after the plugin is saved
+    invalidate_plugin_urls(BiogpsPlugin, instance=plugin)
+    plugin.geturl_by_geneid('12566', get_geneidentifiers)
+    eq_(calls, ['12566', '1', '12566'])
+
+    # a list of plugins, served from cache with no gene lookup
+    from biogps.plugin.models import get_plugin_urls_by_geneid
+    eq_(get_plugin_urls_by_geneid([plugin, plugin], '12566', get_geneidentifiers),
+        [{'url': 'http://www.google.com/search?q=Cdk2'}] * 2)
+    eq_(calls, ['12566', '1', '12566'])
+    # an unknown gene is reported with no plugins too
+    eq_(get_plugin_urls_by_geneid([], '1', lambda geneid, fields=None: None), None)
+    _cleanup_test_plugin()
+
+
 def test_plugin_usage():
     #/plugin_v1/<id>/usage/
     c = Client()
@@ -161,7 +216,7 @@ def test_plugin_flag():
     res = c.post('/plugin_v1/%s/flag/' % test_plugin_id, dict(reason="broken", comment="This plugin is broken"))
     ext_ok(res)
     c = get_user_context()
-    print c.session.values()
+    print(c.session.values())
     res = c.post('/plugin_v1/%s/flag/' % test_plugin_id, dict(reason="inappropriate", comment=""))
     ext_ok(res)
 
@@ -290,15 +290,12 @@ class PluginViewSet(viewsets.ViewSet):
         plugin = BiogpsPlugin(url=url, species=species)
 
         mg = MyGeneInfo()
-        g = mg.get_geneidentifiers(geneid)
-
-        if not g or len(g['SpeciesList']) == 0:
-            return api_error('Unknown gene id.')
-
         try:
-            url = plugin.geturl(g)
+            url = plugin.geturl_by_geneid(geneid, mg.get_geneidentifiers)
         except PluginUrlRenderError as err:
             return api_error(err.args[0], status=400)
+        if url is None:
+            return api_error('Unknown gene id.')
 
         data = {'success': True,
                 'geneid': geneid,
@@ -320,15 +317,12 @@ class PluginViewSet(viewsets.ViewSet):
             return api_error('Invalid input parameters!')
 
         mg = MyGeneInfo()
-        g = mg.get_geneidentifiers(geneid)
-
-        if not g or len(g['SpeciesList']) == 0:
-            return api_error('Unknown gene id.')
-
         try:
-            url = plugin.geturl(g, mobile=flag_mobile)
+            url = plugin.geturl_by_geneid(geneid, mg.get_geneidentifiers, mobile=flag_mobile)
         except PluginUrlRenderError as err:
             return api_error(err.args[0])
+        if url is None:
+            return api_error('Unknown gene id.')
 
         #goto url directly if "redirect" is passed
         if 'redirect' in request.query_params:
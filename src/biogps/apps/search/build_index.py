@@ -26,7 +26,7 @@ from django.db.models.signals import post_save, post_delete
 #                            ElasticSearchException, TypeMissingException)
 
 from biogps.utils import ask
-from biogps.utils.models import queryset_iterator
+from biogps.utils.models import queryset_iterator, permission_changed
 
 #from .es_lib import get_es_conn
 
@@ -386,8 +386,11 @@ def on_the_fly_es_update_handler(sender, **kwargs):
                              dispatch_uid="some_unique_id")
 
     '''
+    object = kwargs['instance']
+    if object.pk is None:
+        #e.g. permission_changed sent for a deleted object
+        return
     if not getattr(settings, "SUSPEND_ES_UPDATE", None):
-        object = kwargs['instance']
         es_indexer = BiogpsModelESIndexer()
         doc = object.object_cvt(mode='es')
         res = es_indexer.index(doc, object.short_name, object.id)
@@ -413,10 +416,13 @@ def on_the_fly_es_delete_handler(sender, **kwargs):
 def set_on_the_fly_indexing(biogpsmodel):
     '''set input biogpsmodel for on the fly indexing:
           * add to index when a new object is created
-          * update index when an object is updated
+          * update index when an object or its permissions are updated
           * delete from index when an object is deleted
     '''
     post_save.connect(on_the_fly_es_update_handler, sender=biogpsmodel,
                       dispatch_uid=biogpsmodel.__name__ + 'update_indexer')
     post_delete.connect(on_the_fly_es_delete_handler, sender=biogpsmodel,
                       dispatch_uid=biogpsmodel.__name__ + 'delete_indexer')
+    #permissions are part of the indexed doc (e.g. permission_style)
+    permission_changed.connect(on_the_fly_es_update_handler, sender=biogpsmodel,
+                               dispatch_uid=biogpsmodel.__name__ + 'permission_indexer')
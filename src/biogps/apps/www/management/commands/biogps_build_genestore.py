@@ -0,0 +1,38 @@
+'''
+Build (or refresh) the local gene store used by MyGeneInfo, see
+biogps.apps.gene.localstore.
+'''
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from biogps.apps.gene.boe import MyGeneInfo
+from biogps.apps.gene.localstore import SNAPSHOT_FIELDS, build_store
+from biogps.utils.const import taxid_d
+
+
+class Command(BaseCommand):
+    help = "Snapshot the gene identifiers of all BioGPS species from BOESERVICE_URL into a local store. It should be scheduled after each mygene.info release."
+    requires_system_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', '-p',
+            dest='path',
+            default=None,
+            help='Path of the store file (default: settings.BOE_LOCAL_STORE).',
+        )
+
+    def handle(self, **options):
+        path = options.get('path', None) or getattr(settings, 'BOE_LOCAL_STORE', None)
+        if not path:
+            raise CommandError('Either set BOE_LOCAL_STORE in settings or pass --path.')
+
+        mg = MyGeneInfo()
+        build_version = str(mg.metadata.get('build_version', ''))
+        t0 = time.time()
+        print('Building local gene store "{}" (build_version={})...'.format(path, build_version))
+        cnt = build_store(path, mg.fetch_all(list(taxid_d.values()), SNAPSHOT_FIELDS),
+                          build_version=build_version)
+        print('Done. [{} genes, {:.1f}s]'.format(cnt, time.time() - t0))
@@ -0,0 +1,20 @@
+'''
+Build (or refresh) the cached bundle of default layouts served to anonymous
+visitors, see biogps.apps.layout.bundle.
+'''
+import time
+
+from django.core.management.base import BaseCommand
+
+from biogps.apps.layout.bundle import get_default_bundle
+
+
+class Command(BaseCommand):
+    help = "Pre-build the cached bundle of default layouts and their plugins served by /layout/default/. It can be run after each deployment."
+    requires_system_checks = True
+
+    def handle(self, **options):
+        t0 = time.time()
+        print('Building default layouts bundle...')
+        etag, data = get_default_bundle(rebuild=True)
+        print('Done. [etag={}, {} bytes, {:.1f}s]'.format(etag, len(data), time.time() - t0))
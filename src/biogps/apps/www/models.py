@@ -33,8 +33,13 @@ class BiogpsPermission(models.Model):
                                        choices=PERMISSION_TYPE_CHOICES)
     permission_value = models.CharField(max_length=100)
 
-#    class Meta:
+    class Meta:
 #        unique_together = (('object_type', 'object_id'),)
+        #the first one covers the lookups by roles/username (see PermissionManager),
+        #the second one covers the lookups of the permissions of given objects.
+        #For an existing database, create them from "python manage.py sqlindexes www".
+        index_together = [('object_type', 'permission_type', 'permission_value', 'object_id'),
+                          ('object_type', 'object_id')]
 
     @staticmethod
     def get_model(object_type):
@@ -170,6 +170,25 @@ CACHES = {
 CACHE_DAY = 86400
 CACHE_WEEK = 604800
 
+# Settings for MyGeneInfo calls to BOESERVICE_URL, see biogps.apps.gene.boe and biogps.apps.gene.cache
+BOE_CACHE_SIZE = 10000              # max. number of items cached in each process
+BOE_CACHE_TIMEOUT = CACHE_DAY
+BOE_CACHE_NOTFOUND_TIMEOUT = 3600   # cache time for genes not found (404)
+BOE_CACHE_VERSION_TIMEOUT = 600     # how often to check for a new build version
+BOE_CACHE_VERSION_RETRY = 5         # first retry delay after a failed build version check, doubled up to BOE_CACHE_VERSION_TIMEOUT
+BOE_POOL_SIZE = 20                  # size of the thread pool for concurrent BOESERVICE_URL calls
+BOE_MAX_WORKERS = 8                 # max. concurrent calls made by a single MyGeneInfo request
+BOE_MAX_INFLIGHT_CHUNKS = 2         # max. chunks of a large querymany request fetched at once
+BOE_POOL_CONNECTIONS = 10           # number of connection pools kept by the shared session
+BOE_POOL_MAXSIZE = 20               # max. keep-alive connections per host, match the number of server threads
+BOE_TIMEOUT = (3.05, 30)            # (connect, read) timeout in seconds for each request
+BOE_RETRY_TOTAL = 3
+BOE_RETRY_BACKOFF = 0.2             # sleep 0.2s, 0.4s, 0.8s... between retries
+BOE_LOCAL_STORE = None              # path to local gene store built by "biogps_build_genestore" command, see biogps.apps.gene.localstore
+BOE_QUERY_CACHE_SIZE = 1000         # max. number of search results cached in each process
+BOE_QUERY_CACHE_TIMEOUT = 600       # cache time for search results
+BOE_QUERY_CACHE_MAX_TERMS = 100     # id queries with more terms than this are not cached
+
 
 BOT_HTTP_USER_AGENT = ('Googlebot', 'msnbot', 'Yahoo! Slurp')    #The string appearing in HTTP_USER_AGENT header to indicate it is from a web crawler.
 
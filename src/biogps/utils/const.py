@@ -1,4 +1,5 @@
 MAX_QUERY_LENGTH = 10*1000       # A rough upper limit for length of input gene query.
+MAX_RENDERURL_GENES = 100        # Max. number of genes in one batch plugin url rendering request.
 
 SPECIES_LIST = [
     dict(name='human',
@@ -1,7 +1,10 @@
 import json
 from django.core.serializers.json import Serializer as JSONSerializer
 from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import smart_text
+from tagging.models import TaggedItem
+from tagging.registry import registry as tagging_registry
 from . import cvtPermission
 
 
@@ -58,3 +61,98 @@ class Serializer(JSONSerializer):
         self.options.pop('extra_itemfields', None)
 
         json.dump(self.objects, self.stream, cls=DjangoJSONEncoder, **self.options)
+
+
+#==============================================================================
+# Single-pass serialization
+# serialize_objects builds the same items as Serializer does (as returned by
+# json.loads), directly from the objects, so that views can pass them to
+# Response for the one and only encoding step.
+#==============================================================================
+_field_plans = {}
+_encoder = DjangoJSONEncoder()
+
+
+def _jsonify(value):
+    '''convert values not native to JSON (e.g. datetime) as DjangoJSONEncoder
+       does, so that the result is rendered the same as by Serializer with
+       any JSON encoder.
+    '''
+    if isinstance(value, dict):
+        return dict([(k, _jsonify(v)) for k, v in value.items()])
+    elif isinstance(value, (list, tuple)):
+        return [_jsonify(v) for v in value]
+    elif value is None or isinstance(value, (str, int, float)):
+        return value
+    return _encoder.default(value)
+
+
+def _get_field_plan(model):
+    '''return a list of (name, field, is_fk) tuples of the fields Serializer
+       outputs for given model class, computed once per class.
+    '''
+    plan = _field_plans.get(model, None)
+    if plan is None:
+        plan = [(field.name, field, field.rel is not None)
+                for field in model._meta.concrete_model._meta.local_fields
+                if field.serialize and field.name not in ('authorid', 'ownerprofile')]
+        _field_plans[model] = plan
+    return plan
+
+
+def get_tags(model, object_ids):
+    '''return a dictionary of {object_id: [tag_name, ...]} for given objects
+       of a tagged model, all from one query. Tag names are sorted, the same
+       as obj.tags returns.
+    '''
+    tag_d = {}
+    if object_ids:
+        ctype = ContentType.objects.get_for_model(model)
+        tag_qs = TaggedItem.objects.filter(content_type=ctype, object_id__in=object_ids)
+        for object_id, name in tag_qs.order_by('tag__name').values_list('object_id', 'tag__name'):
+            tag_d.setdefault(object_id, []).append(name)
+    return tag_d
+
+
+def serialize_objects(object_li, extra_itemfields=None):
+    '''return a list of dictionaries for given objects (all of the same
+       model), the same as the "items" from Serializer, but without encoding
+       and decoding JSON. Permissions and tags of all objects are loaded in
+       bulk, so the number of queries does not grow with the objects (except
+       for those made by extra_itemfields).
+    '''
+    object_li = list(object_li)
+    if not object_li:
+        return []
+    model = object_li[0].__class__
+    plan = _get_field_plan(model)
+    model_name = smart_text(model._meta)
+    extra_itemfields = extra_itemfields or []
+
+    if hasattr(model.objects, 'prefetch_permissions'):
+        object_li = model.objects.prefetch_permissions(object_li)
+    tag_d = get_tags(model, [obj.pk for obj in object_li]) if model in tagging_registry else {}
+
+    items = []
+    for obj in object_li:
+        fields = {}
+        for name, field, is_fk in plan:
+            if is_fk:
+                value = getattr(obj, field.get_attname())
+                fields[name] = value if value is None or isinstance(value, int) else field.value_to_string(obj)
+            else:
+                fields[name] = smart_text(field.value_to_string(obj), strings_only=True)
+
+        permission = getattr(obj, 'permission', None)
+        if permission:
+            fields['permission'] = cvtPermission(permission)
+        if tag_d.get(obj.pk, None):
+            fields['tags'] = ' '.join(tag_d[obj.pk])
+        for field in extra_itemfields:
+            if hasattr(obj, field):
+                fields[field] = _jsonify(getattr(obj, field))
+        #keys in the same order as from Serializer
+        items.append({'model': model_name,
+                      'fields': fields,
+                      'pk': obj.pk})
+    return items
@@ -0,0 +1,135 @@
+'''
+An incremental JSON decoder for large web service responses, which yields
+the items of a JSON array one by one as the data arrive, instead of
+buffering and decoding the whole response at once.
+
+e.g.
+    res = requests.get(url, stream=True)
+    for hit in JSONItemStream(res.iter_content(chunk_size=65536), close=res.close):
+        ...
+'''
+import codecs
+import json
+
+
+class JSONItemStream(object):
+    '''Iterate over the items of a JSON document from an iterable of byte
+       chunks (utf-8 encoded):
+           * if the document is an array, each element is yielded;
+           * if the document is an object, each element of its "items_key"
+             array is yielded, and all other key/value pairs are collected
+             in self.meta (available after the iteration).
+       Each item is decoded as soon as it is complete, so only one item and
+       one chunk of raw data are held in memory at any time.
+    '''
+    _whitespace = ' \t\n\r'
+    _number_chars = '.eE+-0123456789'
+
+    def __init__(self, chunks, items_key='hits', close=None):
+        self.items_key = items_key
+        self.meta = {}
+        self.is_list = None
+        self._chunks = iter(chunks)
+        self._close = close
+        self._textdecoder = codecs.getincrementaldecoder('utf-8')()
+        self._jsondecoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def close(self):
+        if self._close:
+            self._close()
+            self._close = None
+
+    def _fill(self):
+        '''read next chunk into buffer, return False at the end of data.'''
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            text = self._textdecoder.decode(chunk)
+            if text:
+                self._buf = self._buf[self._pos:] + text
+                self._pos = 0
+                return True
+        self._buf = self._buf[self._pos:] + self._textdecoder.decode(b'', final=True)
+        self._pos = 0
+        self._eof = True
+        return False
+
+    def _peek(self):
+        '''return next non-whitespace char without consuming it.'''
+        while True:
+            buf, pos = self._buf, self._pos
+            while pos < len(buf) and buf[pos] in self._whitespace:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON data')
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise ValueError('Expecting "%s" at char %d' % (c, self._pos))
+        self._pos += 1
+
+    def _decode_value(self):
+        '''decode next complete JSON value, reading more data when needed.'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._jsondecoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            if isinstance(value, (int, float)) and \
+               (end == len(self._buf) or self._buf[end] in self._number_chars) and self._fill():
+                # a number at (or split right before a ".", "e" or sign near)
+                # the end of buffer might be incomplete
+                continue
+            self._pos = end
+            return value
+
+    def _iter_array(self):
+        self._expect('[')
+        while True:
+            c = self._peek()
+            if c == ']':
+                self._pos += 1
+                return
+            if c == ',':
+                self._pos += 1
+                continue
+            yield self._decode_value()
+
+    def __iter__(self):
+        try:
+            c = self._peek()
+            if c == '[':
+                self.is_list = True
+                for item in self._iter_array():
+                    yield item
+            elif c == '{':
+                self.is_list = False
+                self._pos += 1
+                while True:
+                    c = self._peek()
+                    if c == '}':
+                        self._pos += 1
+                        break
+                    if c == ',':
+                        self._pos += 1
+                        continue
+                    key = self._decode_value()
+                    self._expect(':')
+                    if key == self.items_key and self._peek() == '[':
+                        for item in self._iter_array():
+                            yield item
+                    else:
+                        self.meta[key] = self._decode_value()
+            else:
+                raise ValueError('Expecting a JSON array or object.')
+        finally:
+            self.close()
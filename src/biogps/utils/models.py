@@ -2,8 +2,14 @@
 A collection of common classes/functions for BioGPS models.
 '''
 import types
-
-from django.db import models
+import json
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.dispatch import Signal
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 #from friends.models import friend_set_for
@@ -14,7 +20,7 @@ from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from biogps.apps.rating.models import Rating
 from biogps.apps.favorite.models import Favorite
-from biogps.utils import dotdict
+from biogps.utils import dotdict, alwayslist, log
 
 
 def queryset_iterator(model, batch_size=100):
@@ -35,6 +41,114 @@ def get_role_shortnames(role_list):
     return [ROLEPERMISSION_SHORTNAMES.get(r, r) for r in role_list]
 
 
+#==============================================================================
+# Cache versions
+# Entries cached from permission-filtered data (see get_shared_listing) carry
+# a version per object_type in their keys, replaced by any change on
+# BiogpsPermission. A version is a random token rather than a counter, and a
+# missing (never set or evicted) version is replaced by a new one, so that
+# entries cached under an older version can never be served again.
+#==============================================================================
+def _new_version():
+    return uuid.uuid4().hex[:16]
+
+
+def get_cache_versions(keys):
+    '''return a dictionary of the versions stored at given keys, setting
+       a new one for each missing key. Cache errors are raised.
+    '''
+    version_d = cache.get_many(keys)
+    for key in keys:
+        if version_d.get(key) is None:
+            version = _new_version()
+            if not cache.add(key, version, None):
+                #set by another process meanwhile
+                version = cache.get(key) or version
+            version_d[key] = version
+    return version_d
+
+
+def get_cache_version(key):
+    '''return the version stored at given key, set to a new one if missing.
+       Return None if the cache is not available.
+    '''
+    try:
+        return get_cache_versions([key])[key]
+    except Exception as e:
+        log.warning('action=cache_version error="%s"', e)
+
+
+def bump_cache_version(key):
+    '''replace the version stored at given key, invalidating all entries
+       cached under the current one.
+    '''
+    try:
+        cache.set(key, _new_version(), None)
+    except Exception as e:
+        log.warning('action=cache_version error="%s"', e)
+
+
+def _acl_version_key(object_type):
+    return 'acl_version:{}'.format(object_type)
+
+
+#sent once after the permissions of an object are changed by
+#ModelWithPermission.set_permission or clean_permission, with the object as
+#"instance". Bulk changes do not send post_save signals of BiogpsPermission.
+permission_changed = Signal(providing_args=['instance'])
+
+
+def invalidate_acl_index(sender, **kwargs):
+    '''Handle post-save and post-delete for BiogpsPermission model, and
+       permission_changed for any model with permission.
+    '''
+    bump_cache_version(_acl_version_key(kwargs['instance'].object_type))
+
+models.signals.post_save.connect(invalidate_acl_index, BiogpsPermission,
+                                 dispatch_uid='BiogpsPermission_invalidate_acl_index')
+models.signals.post_delete.connect(invalidate_acl_index, BiogpsPermission,
+                                   dispatch_uid='BiogpsPermission_invalidate_acl_index_on_delete')
+permission_changed.connect(invalidate_acl_index, dispatch_uid='permission_changed_invalidate_acl_index')
+
+
+#==============================================================================
+# Shared listings
+# The rows of the objects shared to a role signature, as used by list views,
+# are cached per object_type and role signature, and merged at request time
+# with the rows shared to the username. Cache keys include the ACL version
+# and a listing version per object_type, replaced by any change on the
+# objects (see set_listing_cache_invalidation).
+#==============================================================================
+LISTING_CACHE_TIMEOUT = getattr(settings, 'LISTING_CACHE_TIMEOUT', settings.CACHE_DAY)
+
+
+def _listing_version_key(object_type):
+    return 'listing_version:{}'.format(object_type)
+
+
+def invalidate_listing_cache(sender, **kwargs):
+    '''Handle post-save and post-delete for models with shared listings.'''
+    bump_cache_version(_listing_version_key(kwargs['instance'].object_type))
+
+
+def set_listing_cache_invalidation(biogpsmodel):
+    '''drop the cached shared listings of input biogpsmodel whenever any of
+       its objects is created, updated or deleted.
+    '''
+    models.signals.post_save.connect(invalidate_listing_cache, sender=biogpsmodel,
+                                     dispatch_uid=biogpsmodel.__name__ + '_invalidate_listing_cache')
+    models.signals.post_delete.connect(invalidate_listing_cache, sender=biogpsmodel,
+                                       dispatch_uid=biogpsmodel.__name__ + '_invalidate_listing_cache_on_delete')
+
+
+def _sort_rows(rows, order_by):
+    '''sort a list of dictionaries in place, the same as QuerySet.order_by.'''
+    for field in reversed(order_by):
+        desc = field.startswith('-')
+        field = field.lstrip('-')
+        rows.sort(key=lambda row: row[field], reverse=desc)
+
+
 #==============================================================================
 # Customized Manager
 #==============================================================================
@@ -48,28 +162,79 @@ class PermissionManager(models.Manager):
         authorid = user.sid if isinstance(user, User) else user
         return self.filter(ownerprofile__sid=authorid)
 
+    def _shared_id_qs(self, permission_type, values):
+        '''return a subquery of the ids of objects shared by given permission
+           type to any of given values.
+        '''
+        perm_qs = BiogpsPermission.objects.filter(object_type=self.model.object_type,
+                                                  permission_type=permission_type,
+                                                  permission_value__in=values)
+        return perm_qs.values('object_id')
+
+    def get_shared_ids(self, roles=None, username=None):
+        '''return a sorted list of ids of objects shared to any of given roles
+           or to given username (not including the objects owned by the user).
+        '''
+        ids = set()
+        if roles:
+            ids.update([d['object_id'] for d in self._shared_id_qs('R', alwayslist(roles))])
+        if username:
+            ids.update([d['object_id'] for d in self._shared_id_qs('U', [username])])
+        return sorted(ids)
+
+    def get_shared_listing(self, user, fields, order_by):
+        '''return a list of dictionaries of given fields plus "ownerprofile"
+           (as values() does) for the objects shared with given user, not
+           including user's own objects, ordered by order_by (a list of
+           fields, which must be in fields as well).
+           The rows shared to user's roles are cached for all users with the
+           same roles, only the rows shared to the username are queried per
+           user.
+        '''
+        roles = [ModelWithPermission.PUBLIC_ROLE] if user.is_anonymous() else user.roles
+        _fields = list(fields) + ['ownerprofile']
+        object_type = self.model.object_type
+        role_qs = self.get_available_by_role(roles)
+        key = rows = None
+        acl_version = get_cache_version(_acl_version_key(object_type))
+        listing_version = get_cache_version(_listing_version_key(object_type))
+        if acl_version and listing_version:
+            signature = hashlib.md5(json.dumps([sorted(set(alwayslist(roles))), _fields, order_by]).encode('utf-8')).hexdigest()
+            key = 'listing:{}:{}:{}:{}'.format(object_type, acl_version, listing_version, signature)
+            try:
+                rows = cache.get(key)
+            except Exception as e:
+                log.warning('action=listing_cache error="%s"', e)
+                key = None
+
+        if rows is None:
+            rows = list(role_qs.order_by(*order_by).values(*_fields))
+            if key:
+                try:
+                    cache.set(key, rows, LISTING_CACHE_TIMEOUT)
+                except Exception as e:
+                    log.warning('action=listing_cache error="%s"', e)
+
+        if not user.is_anonymous():
+            user_rows = list(self.get_available_by_username(user.username).exclude(
+                pk__in=self._shared_id_qs('R', alwayslist(roles))).values(*_fields))
+            if user_rows:
+                rows = rows + user_rows
+                _sort_rows(rows, order_by)
+            rows = [row for row in rows if row['ownerprofile'] != user.sid]
+        return rows
+
     def get_available_by_role(self, roles):
         available_objects_byrole = self.none()
         if roles:
-            if isinstance(roles, str):
-                roles = [roles]
-            object_type = self.model.object_type
-            perm_qs = BiogpsPermission.objects.filter(object_type=object_type,
-                                                      permission_type='R',
-                                                      permission_value__in=roles)
-            available_objects_byrole = self.filter(pk__in=perm_qs.values('object_id'))
-
+            available_objects_byrole = self.filter(pk__in=self._shared_id_qs('R', alwayslist(roles)))
         return available_objects_byrole
 
     def get_available_by_username(self, username):
-        object_type = self.model.object_type
         shared_objects_byusername = self.none()
         if username:
             #Check if the object is shared with me by username
-            perm_qs = BiogpsPermission.objects.filter(object_type=object_type,
-                                                      permission_type='U',
-                                                      permission_value=username)
-            shared_objects_byusername = self.filter(pk__in=perm_qs.values('object_id'))
+            shared_objects_byusername = self.filter(pk__in=self._shared_id_qs('U', [username]))
         return shared_objects_byusername
 
     def get_available_by_friendship(self, user):
@@ -111,6 +276,32 @@ class PermissionManager(models.Manager):
         #BiogpsPlugin.objects.get_available(uu).filter(popularity__score__isnull=False).order_by('-popularity__score')
         return query_result
 
+    def get_permissions(self, object_ids):
+        '''return the permissions of given objects in one query, as a
+           dictionary of {object_id: [{'permission_type': ..., 'permission_value': ...}, ...]},
+           the same as each object's get_permission() returns. Objects
+           without any permission are not included.
+        '''
+        perm_d = {}
+        if object_ids:
+            perm_qs = BiogpsPermission.objects.filter(object_type=self.model.object_type,
+                                                      object_id__in=object_ids)
+            for perm in perm_qs.values('object_id', 'permission_type', 'permission_value'):
+                perm_d.setdefault(perm.pop('object_id'), []).append(perm)
+        return perm_d
+
+    def prefetch_permissions(self, object_li):
+        '''load the permissions of all given objects (a QuerySet or a list)
+           in one query, and memoize them on each object for get_permission
+           and all the properties based on it. Return a list of the objects.
+           Useful before rendering a list of objects.
+        '''
+        object_li = list(object_li)
+        perm_d = self.get_permissions([obj.id for obj in object_li])
+        for obj in object_li:
+            obj._permission_cache = perm_d.get(obj.id, [])
+        return object_li
+
     def get_available_from(self, owner, viewer):
         ''' return all available objects owned by a given user, that are
             accessible by the calling user. used for the profile pages.
@@ -146,29 +337,55 @@ class ModelWithPermission(models.Model):
                                                permission_type='U')
 
     def get_permission(self):
-        return BiogpsPermission.objects.filter(object_type=self.object_type,
-                                               object_id=self.id).values('permission_type', 'permission_value')
+        '''return a list of {'permission_type': ..., 'permission_value': ...}.
+           It is loaded once and memoized on the object (or prefetched by
+           PermissionManager.prefetch_permissions), so that is_public,
+           is_private, permission_style etc. do not query again.
+        '''
+        if getattr(self, '_permission_cache', None) is None:
+            self._permission_cache = list(BiogpsPermission.objects.filter(object_type=self.object_type,
+                                                                          object_id=self.id).values('permission_type', 'permission_value'))
+        return self._permission_cache
 
     def set_permission(self, data, append=False):
         """data is a list of dictionaries like (same as that returned from get_permission):
            [{'permission_type': 'R', 'permission_value': 'GNF Users'},
             {'permission_type': 'U', 'permission_value': 'cwutest'}]
+           Only the difference from existing permissions is written, in one
+           transaction: new ones are bulk-created, and unless append is True,
+           those not in data are removed with one delete.
         """
-        if not append:
-            self.clean_permission()
-
-        for d in data:
-            d.update(dict(object_type=self.object_type, object_id=self.id))
-            try:
-                existing_item = BiogpsPermission.objects.get(**d)
-            except BiogpsPermission.DoesNotExist:
-                new_item = BiogpsPermission(**d)
-                new_item.save()
+        wanted = set([(d['permission_type'], d['permission_value']) for d in data])
+        with transaction.atomic():
+            existing_qs = BiogpsPermission.objects.filter(object_type=self.object_type, object_id=self.id)
+            existing, removed_ids = set(), []
+            for _id, permission_type, permission_value in existing_qs.values_list('id', 'permission_type', 'permission_value'):
+                if (permission_type, permission_value) in existing or \
+                   (not append and (permission_type, permission_value) not in wanted):
+                    removed_ids.append(_id)
+                else:
+                    existing.add((permission_type, permission_value))
+            if removed_ids:
+                BiogpsPermission.objects.filter(id__in=removed_ids).delete()
+            new_li = [BiogpsPermission(object_type=self.object_type, object_id=self.id,
+                                       permission_type=permission_type, permission_value=permission_value)
+                      for permission_type, permission_value in sorted(wanted - existing)]
+            if new_li:
+                BiogpsPermission.objects.bulk_create(new_li)
+        self._permission_cache = None
+        if removed_ids or new_li:
+            permission_changed.send(sender=self.__class__, instance=self)
 
     def clean_permission(self):
         """clean all permission and make it visible to author only."""
+        self._permission_cache = None
+        if self.pk is None:
+            #already deleted, e.g. "del plugin.permission" after plugin.delete()
+            return
         existing_objs = BiogpsPermission.objects.filter(object_type=self.object_type, object_id=self.id)
-        existing_objs.delete()
+        if existing_objs.exists():
+            existing_objs.delete()
+            permission_changed.send(sender=self.__class__, instance=self)
 
     permission = property(get_permission, set_permission, clean_permission)
 
@@ -23,3 +23,305 @@ def test_species_list():
     eq_( sl['fruitfly'].genus, 'Drosophila melanogaster' )
     eq_( sl['nematode'].sample_gene, 172677 )
     eq_( sl[7955].name, 'zebrafish' )
+
+
+def test_jsonstream():
+    import json
+    from .jsonstream import JSONItemStream
+
+    hits = [{'_id': str(i), 'name': u'gene \u00e9 %d' % i, 'score': i * 1.5} for i in range(100)]
+    data = json.dumps({'took': 3, 'total': 100, 'hits': hits, 'max_score': 123}).encode('utf-8')
+    #feed the data in tiny chunks, splitting values and utf-8 chars across chunks
+    for size in (1, 7, 64, len(data)):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        res = JSONItemStream(chunks)
+        eq_(list(res), hits)
+        eq_(res.meta, {'took': 3, 'total': 100, 'max_score': 123})
+
+    res = JSONItemStream([b'[1, 23', b'45, {"a": [1]}] '])
+    eq_(list(res), [1, 2345, {'a': [1]}])
+    eq_(res.is_list, True)
+
+    #numbers split across chunks after ".", "e" or a sign
+    eq_(list(JSONItemStream([b'[1.', b'5]'])), [1.5])
+    eq_(list(JSONItemStream([b'[1e', b'5]'])), [1e5])
+    eq_(list(JSONItemStream([b'[-2.5e', b'-', b'3, 1', b'0]'])), [-2.5e-3, 10])
+    res = JSONItemStream([b'{"max_score": 3.', b'2, "hits": [{"_score": 0.', b'75}]}'])
+    eq_(list(res), [{'_score': 0.75}])
+    eq_(res.meta, {'max_score': 3.2})
+
+    res = JSONItemStream([b'{"success": false, "error": "timeout"}'])
+    eq_(list(res), [])
+    eq_(res.meta['error'], 'timeout')
+
+
+def test_acl_index():
+    from django.contrib.auth.models import User, AnonymousUser
+    from biogps.layout.models import BiogpsGenereportLayout
+
+    owner = User.objects.get(username='cwudemo')
+    layout = BiogpsGenereportLayout(layout_name='nosetest_acl_layout', ownerprofile=owner.profile)
+    layout.save()
+    mgr = BiogpsGenereportLayout.objects
+    anonymous = AnonymousUser()
+    try:
+        ok_(layout.id not in mgr.get_shared_ids(roles=['BioGPS Users']))
+        ok_(not mgr.get_available(anonymous).filter(id=layout.id).exists())
+
+        #the shared ids follow permission changes
+        layout.share_to_public()
+        ok_(layout.id in mgr.get_shared_ids(roles=['BioGPS Users']))
+        ok_(mgr.get_available(anonymous).filter(id=layout.id).exists())
+        layout.make_private()
+        ok_(layout.id not in mgr.get_shared_ids(roles=['BioGPS Users']))
+
+        layout.set_permission([{'permission_type': 'U', 'permission_value': 'nosetest_acl_user'}])
+        eq_(mgr.get_shared_ids(username='nosetest_acl_user'), [layout.id])
+        ok_(layout.id in mgr.get_shared_ids(roles=['BioGPS Users'], username='nosetest_acl_user'))
+        ok_(layout.id not in mgr.get_shared_ids(roles=['BioGPS Users'], username='cwudemo'))
+
+        #the same results as from the permission table directly
+        for roles in [['BioGPS Users'], ['BioGPS Users', 'GNF Users']]:
+            eq_(mgr.get_shared_ids(roles=roles),
+                sorted(set(BiogpsPermission.objects.filter(object_type='L', permission_type='R',
+                                                           permission_value__in=roles).values_list('object_id', flat=True))))
+    finally:
+        layout.delete()
+
+
+def test_cache_version():
+    from django.core.cache import cache
+    from .models import get_cache_version, bump_cache_version, _acl_version_key
+
+    key = _acl_version_key('nosetest')
+    cache.delete(key)
+    try:
+        v1 = get_cache_version(key)
+        ok_(v1)
+        eq_(get_cache_version(key), v1)
+        bump_cache_version(key)
+        v2 = get_cache_version(key)
+        ok_(v2 not in [None, v1])
+
+        #a missing (evicted) version never falls back to a former one
+        cache.delete(key)
+        ok_(get_cache_version(key) not in [None, v1, v2])
+    finally:
+        cache.delete(key)
+
+
+@nottest
+def benchmark_acl_index(n_objects=10 ** 5, n_perms=10 ** 6, n_users=10 ** 4, repeat=20):
+    '''compare layout listings from get_available, filtered by subqueries
+       on BiogpsPermission, against the same listings filtered by a list of
+       shared ids fetched beforehand (as if cached), with n_objects layouts
+       and n_perms permission rows. Run it against a test database, as all
+       layouts created are removed afterward.
+    '''
+    import random
+    import time
+    from django.db import connection
+    from django.contrib.auth.models import User
+    from biogps.layout.models import BiogpsGenereportLayout
+    from .models import invalidate_acl_index
+
+    owner = User.objects.get(username='cwudemo')
+    user = User.objects.exclude(id=owner.id)[0]
+    mgr = BiogpsGenereportLayout.objects
+    roles = ['BioGPS Users', 'GNF Users', 'Novartis Users']
+
+    t0 = time.time()
+    BiogpsGenereportLayout.objects.bulk_create([BiogpsGenereportLayout(layout_name='benchmark_acl_%d' % i,
+                                                                       ownerprofile=owner.profile)
+                                                for i in range(n_objects)], batch_size=10000)
+    ids = list(mgr.filter(layout_name__startswith='benchmark_acl_').values_list('id', flat=True))
+    perms = []
+    for i in range(n_perms):
+        if i % 10 == 0:
+            perms.append(BiogpsPermission(object_type='L', object_id=random.choice(ids),
+                                          permission_type='R', permission_value=random.choice(roles)))
+        else:
+            perms.append(BiogpsPermission(object_type='L', object_id=random.choice(ids),
+                                          permission_type='U', permission_value='benchmark_acl_user_%d' % random.randint(0, n_users)))
+    BiogpsPermission.objects.bulk_create(perms, batch_size=10000)
+    print('data loaded:  {:.1f} s ({} layouts, {} permissions)'.format(time.time() - t0, n_objects, n_perms))
+
+    shared_ids = mgr.get_shared_ids(user.roles, user.username)
+
+    def _get_available_by_ids(user):
+        return mgr.filter(pk__in=shared_ids) | mgr.get_available_by_friendship(user) | mgr.get_mine(user.sid)
+
+    def _listing(qs):
+        return (qs.count(), list(qs.order_by('-lastmodified')[:50].values_list('id', flat=True)))
+
+    try:
+        _listing(mgr.get_available(user))       # warm up
+        t0 = time.time()
+        for i in range(repeat):
+            sub = _listing(mgr.get_available(user))
+        t_sub = (time.time() - t0) / repeat
+
+        t0 = time.time()
+        for i in range(repeat):
+            by_ids = _listing(_get_available_by_ids(user))
+        t_ids = (time.time() - t0) / repeat
+
+        eq_(sub[0], by_ids[0])
+        print('visible:      {} ({} shared ids)'.format(sub[0], len(shared_ids)))
+        print('subqueries:   {:.1f} ms'.format(t_sub * 1000))
+        print('id list:      {:.1f} ms'.format(t_ids * 1000))
+    finally:
+        #raw deletes, skipping per-object signals
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM {} WHERE object_type=%s AND object_id IN ({})'.format(
+            BiogpsPermission._meta.db_table, ','.join([str(x) for x in ids])), ['L'])
+        cursor.execute('DELETE FROM {} WHERE layout_name LIKE %s'.format(
+            BiogpsGenereportLayout._meta.db_table), ['benchmark_acl_%'])
+        invalidate_acl_index(BiogpsPermission, instance=BiogpsPermission(object_type='L'))
+
+
+def test_prefetch_permissions():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.contrib.auth.models import User
+    from biogps.layout.models import BiogpsGenereportLayout
+
+    owner = User.objects.get(username='cwudemo')
+    layout_li = []
+    for i in range(3):
+        layout = BiogpsGenereportLayout(layout_name='nosetest_perm_layout_%d' % i, ownerprofile=owner.profile)
+        layout.save()
+        layout_li.append(layout)
+    layout_li[0].share_to_public()
+    layout_li[1].share_to_user(User.objects.exclude(id=owner.id)[0])
+    attrs = ['is_public', 'is_private', 'permission_style', 'role_permission', 'user_permission']
+    try:
+        qs = BiogpsGenereportLayout.objects.filter(layout_name__startswith='nosetest_perm_layout_').order_by('layout_name')
+        expected = [[getattr(x, attr) for attr in attrs] for x in qs]
+        eq_([x[2] for x in expected], ['public', 'restricted', 'private'])
+
+        with CaptureQueriesContext(connection) as ctx:
+            object_li = BiogpsGenereportLayout.objects.prefetch_permissions(qs)
+            eq_([[getattr(x, attr) for attr in attrs] for x in object_li], expected)
+        eq_(len(ctx.captured_queries), 2)
+
+        #memoized without prefetch as well
+        layout = qs[2]
+        with CaptureQueriesContext(connection) as ctx:
+            layout.permission_style
+            layout.is_public
+        eq_(len(ctx.captured_queries), 1)
+
+        #and refreshed after changes
+        layout.share_to_public()
+        eq_(layout.permission_style, 'public')
+        layout.make_private()
+        eq_(layout.permission_style, 'private')
+    finally:
+        for layout in layout_li:
+            layout.delete()
+
+
+def test_set_permission():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.contrib.auth.models import User
+    from biogps.layout.models import BiogpsGenereportLayout
+    from .models import permission_changed
+
+    owner = User.objects.get(username='cwudemo')
+    layout = BiogpsGenereportLayout(layout_name='nosetest_perm_layout', ownerprofile=owner.profile)
+    layout.save()
+    sent = []
+    def _on_changed(sender, **kwargs):
+        sent.append(kwargs['instance'].id)
+    permission_changed.connect(_on_changed, BiogpsGenereportLayout, dispatch_uid='test_set_permission')
+
+    def _perms(obj):
+        return sorted([(x.permission_type, x.permission_value) for x in
+                       BiogpsPermission.objects.filter(object_type=obj.object_type, object_id=obj.id)])
+
+    try:
+        #the number of queries does not grow with the number of entries
+        for n in (1, 50):
+            data = [{'permission_type': 'U', 'permission_value': 'nosetest_user_%d' % i} for i in range(n)]
+            with CaptureQueriesContext(connection) as ctx:
+                layout.set_permission(data)
+            ok_(len(ctx.captured_queries) <= 6, len(ctx.captured_queries))
+            eq_(_perms(layout), sorted([('U', d['permission_value']) for d in data]))
+
+        #only the difference is written, and the signal sent once
+        del sent[:]
+        layout.set_permission([{'permission_type': 'R', 'permission_value': 'BioGPS Users'},
+                               {'permission_type': 'U', 'permission_value': 'nosetest_user_1'}])
+        eq_(_perms(layout), [('R', 'BioGPS Users'), ('U', 'nosetest_user_1')])
+        eq_(sent, [layout.id])
+        layout.set_permission([{'permission_type': 'U', 'permission_value': 'nosetest_user_2'},
+                               {'permission_type': 'U', 'permission_value': 'nosetest_user_2'}], append=True)
+        eq_(_perms(layout), [('R', 'BioGPS Users'), ('U', 'nosetest_user_1'), ('U', 'nosetest_user_2')])
+        ok_(layout.is_public)
+        del sent[:]
+        layout.set_permission([{'permission_type': 'U', 'permission_value': 'nosetest_user_2'}], append=True)
+        eq_(sent, [])
+        ok_(layout.id in BiogpsGenereportLayout.objects.get_shared_ids(username='nosetest_user_2'))
+        layout.make_private()
+        eq_(_perms(layout), [])
+        ok_(layout.id not in BiogpsGenereportLayout.objects.get_shared_ids(username='nosetest_user_2'))
+
+        #nothing to clean, or already deleted, no signal sent
+        del sent[:]
+        layout.make_private()
+        layout.delete()
+        del layout.permission
+        eq_(sent, [])
+    finally:
+        permission_changed.disconnect(dispatch_uid='test_set_permission')
+        if layout.pk:
+            layout.delete()
+
+
+def test_shared_listing():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.contrib.auth.models import User, AnonymousUser
+    from biogps.layout.models import BiogpsGenereportLayout
+
+    owner = User.objects.get(username='cwudemo')
+    other = User.objects.exclude(id=owner.id)[0]
+    anonymous = AnonymousUser()
+    mgr = BiogpsGenereportLayout.objects
+    layout_li = []
+    for i in range(3):
+        layout = BiogpsGenereportLayout(layout_name='nosetest_listing_layout_%d' % i, ownerprofile=owner.profile)
+        layout.save()
+        layout_li.append(layout)
+    layout_li[0].share_to_public()
+    layout_li[1].share_to_user(other)
+
+    def _listing(user):
+        return [row['pk'] for row in mgr.get_shared_listing(user, ['pk', 'lastmodified'], ['-lastmodified', 'pk'])]
+
+    try:
+        #the same as from get_available
+        for user in (anonymous, owner, other):
+            eq_(_listing(user),
+                list(mgr.get_available(user, excludemine=True).order_by('-lastmodified', 'pk').values_list('pk', flat=True)))
+        ok_(layout_li[1].id in _listing(other))
+        ok_(layout_li[1].id not in _listing(anonymous))
+        ok_(layout_li[0].id not in _listing(owner))
+
+        #role part is cached
+        _listing(anonymous)
+        with CaptureQueriesContext(connection) as ctx:
+            _listing(anonymous)
+        eq_(len(ctx.captured_queries), 0)
+
+        #and refreshed after changes on objects or permissions
+        layout_li[0].layout_name = 'nosetest_listing_layout_renamed'
+        layout_li[0].save()
+        eq_(_listing(anonymous)[0], layout_li[0].id)
+        layout_li[0].make_private()
+        ok_(layout_li[0].id not in _listing(anonymous))
+    finally:
+        for layout in layout_li:
+            layout.delete()